@@ -0,0 +1,450 @@
+import numpy as np
+import pandas as pd
+
+import constants
+from sketches import QuantileSketch
+from timeseries import TimeSeriesAggregator
+
+# Columns of a JMeter JTL/CSV result that are summarised before prompting
+METRIC_COLUMNS = ['elapsed', 'Latency', 'Connect']
+PERCENTILES = [0.5, 0.9, 0.95, 0.99, 0.999]
+REQUIRED_COLUMNS = {'label', 'elapsed'}
+# Columns of the sample rows shown to the model next to the aggregates
+SAMPLE_COLUMNS = ['timeStamp', 'label', 'elapsed', 'Latency', 'Connect', 'responseCode', 'success', 'failureMessage',
+                  'bytes', 'allThreads']
+SAMPLE_KEY = '_sample_key'
+
+
+def is_jtl(contents):
+    """
+    checks whether the uploaded data looks like a JMeter result
+    :param contents:    pandas DataFrame of the uploaded file
+    :return:            True if the frame can be aggregated, else False
+    """
+    return isinstance(contents, pd.DataFrame) and REQUIRED_COLUMNS.issubset(contents.columns)
+
+
+def percentile_name(q):
+    """
+    :param q:   quantile between 0 and 1
+    :return:    column suffix of the percentile, e.g. p95 or p99.9
+    """
+    return f'p{q * 100:g}'
+
+
+def summarize_upload(contents):
+    """
+    :param contents:    parsed upload, as returned by ingest.read_upload
+    :return:            summary of a JMeter result, or None for any other data
+    """
+    if isinstance(contents, dict):
+        return contents
+    return summarize_results(contents) if is_jtl(contents) else None
+
+
+def _success_mask(contents):
+    """
+    normalizes the JTL success column to a boolean array
+    :param contents:    pandas DataFrame of the uploaded file
+    :return:            numpy boolean array, True for successful samples
+    """
+    if 'success' not in contents.columns:
+        return np.ones(len(contents), dtype=bool)
+    success = contents['success']
+    if success.dtype == bool:
+        return success.to_numpy()
+    return success.astype(str).str.strip().str.lower().eq('true').to_numpy()
+
+
+def _duration_seconds(frame):
+    """
+    wall clock span covered by the samples, used for the throughput
+    :param frame:   pandas DataFrame with timeStamp and elapsed columns
+    :return:        duration in seconds, or None if unknown
+    """
+    if 'timeStamp' not in frame.columns or frame.empty:
+        return None
+    start = frame['timeStamp'].min()
+    end = (frame['timeStamp'] + frame['elapsed']).max()
+    duration = (end - start) / 1000
+    return duration if duration > 0 else None
+
+
+def sample_rows(contents, size, random_state=None):
+    """
+    draws a uniform random sample of up to size rows per label (bottom-k sampling on a random key)
+    rows of each label come out in key order, so any prefix per label is itself a uniform sample
+    :param contents:        pandas DataFrame of JTL rows, optionally already holding a SAMPLE_KEY column
+    :param size:            number of rows kept per label
+    :param random_state:    numpy random Generator
+    :return:                sampled rows with their SAMPLE_KEY column
+    """
+    columns = [column for column in SAMPLE_COLUMNS + [SAMPLE_KEY] if column in contents.columns]
+    frame = contents[columns]
+    if SAMPLE_KEY not in frame.columns:
+        # A fixed seed keeps the sample, and so the result cache key, identical for identical uploads
+        random_state = random_state or np.random.default_rng(0)
+        frame = frame.assign(**{SAMPLE_KEY: random_state.random(len(frame))})
+    return frame.sort_values(SAMPLE_KEY, kind='stable').groupby('label', sort=False, observed=True).head(size)
+
+
+def _prepare_frame(contents):
+    """
+    selects and coerces the columns used by the aggregations
+    :param contents:    pandas DataFrame of the uploaded file (or a chunk of it)
+    :return:            tuple of the numeric frame and the metric columns present
+    """
+    metrics = [column for column in METRIC_COLUMNS if column in contents.columns]
+    frame = contents[metrics].apply(pd.to_numeric, errors='coerce')
+    # Categorical labels (see schema.py) are grouped on their codes, without converting every row to a string
+    label = contents['label']
+    frame['label'] = label if isinstance(label.dtype, pd.CategoricalDtype) else label.astype(str)
+    frame['error'] = ~_success_mask(contents)
+    if 'timeStamp' in contents.columns:
+        frame['timeStamp'] = pd.to_numeric(contents['timeStamp'], errors='coerce')
+        frame['end'] = frame['timeStamp'] + frame['elapsed']
+    if 'allThreads' in contents.columns:
+        frame['allThreads'] = pd.to_numeric(contents['allThreads'], errors='coerce')
+    for column in ['bytes', 'sentBytes']:
+        if column in contents.columns:
+            # Summed over the whole file, so not kept in 32 bits
+            frame[column] = pd.to_numeric(contents[column], errors='coerce').astype('float64')
+    return frame, metrics
+
+
+def _response_code_counts(contents):
+    """
+    :param contents:    pandas DataFrame of JTL rows
+    :return:            dict of the response code (as a string) to its number of samples
+    """
+    counts = contents['responseCode'].value_counts(dropna=False)
+    return {str(code): int(count) for code, count in counts.items() if count}
+
+
+def order_columns(per_label, metrics):
+    """
+    orders the per-label table the same way for exact and streamed summaries
+    :param per_label:   pandas DataFrame indexed by label
+    :param metrics:     metric columns present
+    :return:            reordered DataFrame
+    """
+    columns = ['count', 'errors', 'error_rate', 'throughput']
+    for metric in metrics:
+        columns += [f'{metric}_{stat}' for stat in ['min', 'max', 'mean', 'std']]
+        columns += [f'{metric}_{percentile_name(q)}' for q in PERCENTILES]
+    columns += ['bytes', 'sentBytes']
+    return per_label[[column for column in columns if column in per_label.columns]]
+
+
+def summarize_results(contents):
+    """
+    computes the overall and per-label statistics of a JTL in one vectorized groupby pass
+    :param contents:    pandas DataFrame of the uploaded file
+    :return:            dict with the overall totals, response code breakdown and the per-label table
+    """
+    frame, metrics = _prepare_frame(contents)
+    grouped = frame.groupby('label', sort=True, observed=True)
+
+    aggregations = {'count': ('elapsed', 'size'), 'errors': ('error', 'sum')}
+    for metric in metrics:
+        aggregations[f'{metric}_min'] = (metric, 'min')
+        aggregations[f'{metric}_max'] = (metric, 'max')
+        aggregations[f'{metric}_mean'] = (metric, 'mean')
+        aggregations[f'{metric}_std'] = (metric, 'std')
+    if 'timeStamp' in frame.columns:
+        aggregations['start'] = ('timeStamp', 'min')
+        aggregations['end'] = ('end', 'max')
+    for column in ['bytes', 'sentBytes']:
+        if column in frame.columns:
+            aggregations[column] = (column, 'sum')
+    per_label = grouped.agg(**aggregations)
+    per_label.index = per_label.index.astype(str)
+    for column in ['bytes', 'sentBytes']:
+        if column in per_label.columns:
+            per_label[column] = per_label[column].astype('int64')
+
+    quantiles = grouped[metrics].quantile(PERCENTILES).unstack()
+    quantiles.columns = [f'{metric}_{percentile_name(q)}' for metric, q in quantiles.columns]
+    quantiles.index = quantiles.index.astype(str)
+    per_label = per_label.join(quantiles)
+
+    per_label['error_rate'] = per_label['errors'] / per_label['count'] * 100
+    if 'start' in per_label.columns:
+        duration = (per_label.pop('end') - per_label.pop('start')) / 1000
+        per_label['throughput'] = per_label['count'] / duration.where(duration > 0)
+
+    per_label = order_columns(per_label, metrics)
+
+    overall = {
+        'samples': int(len(frame)),
+        'errors': int(frame['error'].sum()),
+        'labels': int(len(per_label)),
+    }
+    overall['error_rate'] = overall['errors'] / overall['samples'] * 100 if overall['samples'] else 0.0
+    duration = _duration_seconds(frame)
+    overall['duration'] = duration
+    overall['throughput'] = overall['samples'] / duration if duration else None
+    for metric in metrics:
+        values = frame[metric].to_numpy(dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            continue
+        overall[f'{metric}_min'] = values.min()
+        overall[f'{metric}_max'] = values.max()
+        overall[f'{metric}_mean'] = values.mean()
+        overall[f'{metric}_std'] = values.std(ddof=1) if values.size > 1 else 0.0
+        for q, value in zip(PERCENTILES, np.percentile(values, [q * 100 for q in PERCENTILES])):
+            overall[f'{metric}_{percentile_name(q)}'] = value
+    for column in ['bytes', 'sentBytes']:
+        if column in frame.columns:
+            overall[column] = int(frame[column].sum())
+
+    response_codes = {}
+    if 'responseCode' in contents.columns:
+        response_codes = _response_code_counts(contents)
+
+    timeseries = TimeSeriesAggregator().update(frame)
+    # Exact percentiles above, the sketches are kept to merge this run with others later
+    sketches = {}
+    for label, values in grouped['elapsed']:
+        sketches[str(label)] = QuantileSketch(constants.SKETCH_RELATIVE_ACCURACY)
+        sketches[str(label)].add_many(values.to_numpy(dtype=float))
+    return {'overall': overall, 'response_codes': response_codes, 'per_label': per_label,
+            'timeseries': timeseries if timeseries.windows is not None else None, 'sketches': sketches}
+
+
+def _combine_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """
+    merges count, mean and sum of squared deviations of two partitions (Chan et al.)
+    :return:    tuple of the merged count, mean and m2
+    """
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (n_a * mean_a + n_b * mean_b) / n
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+class ResultsAggregator:
+    """
+    Running per-label aggregates of a JTL, folded chunk by chunk.
+
+    Only counts, sums, moments, extremes and quantile sketches are kept, so
+    memory depends on the number of labels rather than the number of samples.
+    """
+
+    def __init__(self, relative_accuracy=constants.SKETCH_RELATIVE_ACCURACY,
+                 sample_size=constants.SAMPLE_ROWS_PER_LABEL, seed=0):
+        self.relative_accuracy = relative_accuracy
+        self.sample_size = sample_size
+        self.labels = None
+        self.sketches = {}
+        self.response_codes = {}
+        self.metrics = []
+        self.samples = None
+        self.timeseries = TimeSeriesAggregator()
+        self._random = np.random.default_rng(seed)
+
+    def update(self, chunk):
+        """
+        folds a chunk of samples into the running aggregates
+        :param chunk:   pandas DataFrame holding a slice of the JTL
+        :return:        self
+        """
+        frame, metrics = _prepare_frame(chunk)
+        self.metrics = self.metrics or metrics
+        grouped = frame.groupby('label', sort=False, observed=True)
+
+        aggregations = {'count': ('elapsed', 'size'), 'errors': ('error', 'sum')}
+        for metric in self.metrics:
+            aggregations[f'{metric}_n'] = (metric, 'count')
+            aggregations[f'{metric}_mean'] = (metric, 'mean')
+            aggregations[f'{metric}_m2'] = (metric, 'var')
+            aggregations[f'{metric}_min'] = (metric, 'min')
+            aggregations[f'{metric}_max'] = (metric, 'max')
+        if 'timeStamp' in frame.columns:
+            aggregations['start'] = ('timeStamp', 'min')
+            aggregations['end'] = ('end', 'max')
+        for column in ['bytes', 'sentBytes']:
+            if column in frame.columns:
+                aggregations[column] = (column, 'sum')
+        partial = grouped.agg(**aggregations)
+        partial.index = partial.index.astype(str)
+        for metric in self.metrics:
+            partial[f'{metric}_m2'] = partial[f'{metric}_m2'].fillna(0) * (partial[f'{metric}_n'] - 1).clip(lower=0)
+        self._merge_labels(partial.astype(float))
+
+        for metric in self.metrics:
+            for label, values in grouped[metric]:
+                self._sketch(str(label), metric).add_many(values.to_numpy(dtype=float))
+
+        if 'responseCode' in chunk.columns:
+            for code, count in _response_code_counts(chunk).items():
+                self.response_codes[code] = self.response_codes.get(code, 0) + count
+
+        self._merge_samples(sample_rows(chunk, self.sample_size, self._random))
+        self.timeseries.update(frame)
+        return self
+
+    def merge(self, other):
+        """
+        merges the aggregates of another aggregator into this one
+        :param other:   ResultsAggregator
+        :return:        self
+        """
+        self.metrics = self.metrics or other.metrics
+        if other.labels is not None:
+            self._merge_labels(other.labels)
+        for key, sketch in other.sketches.items():
+            self._sketch(*key).merge(sketch)
+        for code, count in other.response_codes.items():
+            self.response_codes[code] = self.response_codes.get(code, 0) + count
+        if other.samples is not None:
+            self._merge_samples(other.samples)
+        self.timeseries.merge(other.timeseries)
+        return self
+
+    def _merge_samples(self, samples):
+        if self.samples is not None:
+            samples = sample_rows(pd.concat([self.samples, samples], ignore_index=True), self.sample_size)
+        self.samples = samples
+
+    def _sketch(self, label, metric):
+        key = (label, metric)
+        if key not in self.sketches:
+            self.sketches[key] = QuantileSketch(self.relative_accuracy)
+        return self.sketches[key]
+
+    def _merge_labels(self, partial):
+        if self.labels is None:
+            self.labels = partial
+            return
+        left, right = self.labels.align(partial, join='outer')
+        merged = pd.DataFrame(index=left.index)
+        for column in left.columns:
+            if column in ['count', 'errors', 'bytes', 'sentBytes']:
+                merged[column] = left[column].fillna(0) + right[column].fillna(0)
+            elif column == 'start' or column.endswith('_min'):
+                merged[column] = np.fmin(left[column], right[column])
+            elif column == 'end' or column.endswith('_max'):
+                merged[column] = np.fmax(left[column], right[column])
+        for metric in self.metrics:
+            n, mean, m2 = _combine_moments(*[frame[f'{metric}_{stat}'].fillna(0)
+                                             for frame in (left, right) for stat in ['n', 'mean', 'm2']])
+            merged[f'{metric}_n'], merged[f'{metric}_mean'], merged[f'{metric}_m2'] = n, mean, m2
+        self.labels = merged
+
+    def summary(self):
+        """
+        builds the same summary structure as summarize_results from the running aggregates
+        :return:    dict with the overall totals, response code breakdown and the per-label table
+        """
+        labels = self.labels if self.labels is not None else pd.DataFrame(columns=['count', 'errors'])
+        labels = labels.sort_index()
+        per_label = labels[[column for column in labels.columns
+                            if column in ['count', 'errors', 'bytes', 'sentBytes']
+                            or column.endswith('_min') or column.endswith('_max')]].copy()
+        per_label['error_rate'] = labels['errors'] / labels['count'] * 100
+        if 'start' in labels.columns:
+            duration = (labels['end'] - labels['start']) / 1000
+            per_label['throughput'] = labels['count'] / duration.where(duration > 0)
+        for metric in self.metrics:
+            n = labels[f'{metric}_n']
+            per_label[f'{metric}_mean'] = labels[f'{metric}_mean']
+            per_label[f'{metric}_std'] = np.sqrt(labels[f'{metric}_m2'] / (n - 1).where(n > 1))
+            quantiles = np.array([self._sketch(label, metric).quantiles(PERCENTILES) for label in labels.index],
+                                 dtype=float).reshape(len(labels), len(PERCENTILES))
+            # a sketch estimate is only accurate up to its bucket width, it is kept within the exact extremes
+            quantiles = np.clip(quantiles, labels[f'{metric}_min'].to_numpy(dtype=float)[:, None],
+                                labels[f'{metric}_max'].to_numpy(dtype=float)[:, None])
+            for i, q in enumerate(PERCENTILES):
+                per_label[f'{metric}_{percentile_name(q)}'] = quantiles[:, i]
+        for column in ['count', 'errors', 'bytes', 'sentBytes']:
+            if column in per_label.columns:
+                per_label[column] = per_label[column].astype('int64')
+        per_label = order_columns(per_label, self.metrics)
+
+        samples = int(labels['count'].sum())
+        errors = int(labels['errors'].sum())
+        overall = {'samples': samples, 'errors': errors, 'labels': int(len(labels)),
+                   'error_rate': errors / samples * 100 if samples else 0.0}
+        duration = None
+        if 'start' in labels.columns and samples:
+            duration = (labels['end'].max() - labels['start'].min()) / 1000
+            duration = duration if duration > 0 else None
+        overall['duration'] = duration
+        overall['throughput'] = samples / duration if duration else None
+        for metric in self.metrics:
+            n, mean, m2 = 0.0, 0.0, 0.0
+            for label in labels.index[labels[f'{metric}_n'] > 0]:
+                n, mean, m2 = _combine_moments(n, mean, m2, labels.at[label, f'{metric}_n'],
+                                               labels.at[label, f'{metric}_mean'], labels.at[label, f'{metric}_m2'])
+            if not n:
+                continue
+            overall[f'{metric}_min'] = labels[f'{metric}_min'].min()
+            overall[f'{metric}_max'] = labels[f'{metric}_max'].max()
+            overall[f'{metric}_mean'] = mean
+            overall[f'{metric}_std'] = np.sqrt(m2 / (n - 1)) if n > 1 else 0.0
+            combined = QuantileSketch(self.relative_accuracy)
+            for label in labels.index:
+                combined.merge(self._sketch(label, metric))
+            for q, value in zip(PERCENTILES, combined.quantiles(PERCENTILES)):
+                overall[f'{metric}_{percentile_name(q)}'] = min(max(value, overall[f'{metric}_min']),
+                                                                overall[f'{metric}_max'])
+        for column in ['bytes', 'sentBytes']:
+            if column in labels.columns:
+                overall[column] = int(labels[column].sum())
+
+        response_codes = dict(sorted(self.response_codes.items(), key=lambda item: item[1], reverse=True))
+        return {'overall': overall, 'response_codes': response_codes, 'per_label': per_label,
+                'samples': self.samples,
+                'timeseries': self.timeseries if self.timeseries.windows is not None else None,
+                'sketches': {label: self._sketch(label, 'elapsed') for label in labels.index}}
+
+
+def _format_value(value):
+    """
+    formats a statistic for the prompt, keeping it short
+    :param value:   number
+    :return:        string representation
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return '-'
+    if isinstance(value, (float, np.floating)):
+        return f'{value:.2f}'.rstrip('0').rstrip('.')
+    return str(value)
+
+
+def format_files_html(files):
+    """
+    renders the merged files of an upload as an HTML table, with the clock shift applied to each of them
+    :param files:   list of {'file', 'samples', 'clock_offset'} dicts, as listed by ingest.read_files
+    :return:        HTML text
+    """
+    table = pd.DataFrame(files, columns=['file', 'samples', 'clock_offset'])
+    table['clock_offset'] = [f'{-offset:+g} s' if offset else '-' for offset in table['clock_offset']]
+    table.columns = ['File', 'Samples', 'Clock shift']
+    return table.to_html(classes='table table-sm', index=False)
+
+
+def format_summary(summary):
+    """
+    renders the aggregated statistics as compact text for the prompt
+    :param summary: dict returned by summarize_results
+    :return:        summary text
+    """
+    overall = summary['overall']
+    lines = ['Aggregated performance test results (times in ms, throughput in requests/sec, bytes in total).',
+             'Overall: ' + ', '.join(f'{key}={_format_value(value)}' for key, value in overall.items())]
+    if summary['response_codes']:
+        lines.append('Response codes: ' + ', '.join(f'{code}={count}'
+                                                     for code, count in summary['response_codes'].items()))
+    if summary.get('files'):
+        lines.append('Files merged: ' + ', '.join(
+            f"{source['file']} ({source['samples']} samples" +
+            (f", clock shifted by {-source['clock_offset']:g} s)" if source['clock_offset'] else ')')
+            for source in summary['files']))
+    lines.append('Per label:')
+    lines.append(summary['per_label'].to_csv(float_format='%.2f', na_rep='-').strip())
+    return '\n'.join(lines)
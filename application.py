@@ -1,10 +1,29 @@
+import hmac
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import openai
-import pandas as pd
-from flask import Flask, request, render_template, redirect, url_for
+from flask import Flask, request, render_template, redirect, url_for, jsonify, Response
+from flask import before_render_template, g, template_rendered
 from flask import send_from_directory
 from flask_dance.contrib.github import make_github_blueprint
 
+import aggregation
+import cache
+import comparison
 import constants
+import ingest
+import jobs
+import metrics
+import prompt_builder
+import startup
+import timeseries
+import tokenizer
 from integrations.slack import slack
 import version
 from utils import *
@@ -19,13 +38,20 @@ application = Flask(__name__)
 # Load all env variables
 _vars = load_env_vars(application)
 
-sentry_sdk.init(
-    dsn=_vars['SENTRY_KEY'],
-    integrations=[
-        FlaskIntegration(),
-    ],
-    traces_sample_rate=1.0
-)
+
+def init_sentry():
+    # Runs once per process, during the warm-up
+    if sentry_sdk.Hub.current.client is not None:
+        return
+    sentry_sdk.init(
+        dsn=_vars['SENTRY_KEY'],
+        integrations=[
+            FlaskIntegration(),
+        ],
+        traces_sampler=metrics.TracesSampler(
+            rate=float(os.getenv('SENTRY_TRACES_SAMPLE_RATE', constants.SENTRY_TRACES_SAMPLE_RATE)))
+    )
+
 
 logging.basicConfig(level=logging.INFO)
 
@@ -54,13 +80,77 @@ def login_required(func):
     return wrapper
 
 
-mp = Mixpanel(_vars['MIXPANEL_US'])
+mp = startup.LazyClient(lambda: Mixpanel(_vars['MIXPANEL_US']))
+
+
+def refund_abandoned_job(job):
+    """
+    gives back the upload credit of a background job that will never finish
+    :param job: abandoned job record
+    :return:    None
+    """
+    if job.get('credit'):
+        refund_upload_credit(job['username'])
+
+
+job_runner = jobs.JobRunner(on_abandoned=refund_abandoned_job)
+readiness = startup.Readiness()
+
+
+def warm_up():
+    """
+    warms up this process in the background: Sentry, the DynamoDB connections and the homepage analytics
+    only DynamoDB is needed to report ready, the analytics gateway being down must not take the app out of service
+    :return:    None
+    """
+    readiness.start({
+        'sentry': (init_sentry, False),
+        'dynamodb': (warm_dynamodb, True),
+        'analytics': (lambda: analytics_cache.refresh(constants.ANALYTICS_REQUEST_TIMEOUT), False),
+    })
+
+
+warm_up()
 github_bp = make_github_blueprint()
 
 application.config.update(dict(PREFERRED_URL_SCHEME='https'))
 application.wsgi_app = ReverseProxied(application.wsgi_app)
 application.register_blueprint(github_bp, url_prefix="/login")
 
+
+@application.cli.command('rebuild-analytics')
+def rebuild_analytics():
+    """Backfill the analytics counters and the users index from the usage records, once after upgrading."""
+    counters = rebuild_analytics_counters()
+    print(f"Rebuilt the analytics counters: {counters}")
+
+
+@application.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@application.after_request
+def record_request_duration(response):
+    if 'request_started' in g:
+        metrics.request_seconds.observe(time.perf_counter() - g.request_started,
+                                        endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+def record_render_duration(sender, template, context, **extra):
+    if 'render_started' in g:
+        metrics.stage_seconds.observe(time.perf_counter() - g.pop('render_started'),
+                                      stage='render', operation=template.name)
+
+
+before_render_template.connect(start_render_timer, application)
+template_rendered.connect(record_render_duration, application)
+
 # Images
 IMAGES_FOLDER = os.path.join('static', 'images')
 application.config['UPLOAD_FOLDER'] = IMAGES_FOLDER
@@ -88,6 +178,9 @@ def index():
 
         with start_transaction(op="task", name="Home Page"):
             get_analytics_response = get_analytics_data()
+            if get_analytics_response is None:
+                return render_template("index.html", image=hero_image, auth=check_authorized_status(),
+                                       version=version.__version__)
             return render_template("index.html", image=hero_image,
                                    total_tokens=get_analytics_response['total_tokens'],
                                    total_users=get_analytics_response['total_users'],
@@ -127,8 +220,7 @@ def github_sign():
     username = get_username()
     log_db(username=username)
 
-    if check_user_in_settings_db(username=username):
-        insert_initial_upload_quota_db(username)
+    ensure_user_settings(username)
 
     mp.track(username, 'User signed up')
     return redirect('/')
@@ -140,13 +232,12 @@ def upload():
     try:
         mp.track(get_username(), 'Users in Upload page')
         with start_transaction(op="task", name="Upload Page"):
-            if check_user_in_settings_db(username=get_username()):
-                insert_initial_upload_quota_db(get_username())
-
-            upload_count = get_upload_count(get_username())
+            settings = ensure_user_settings(get_username())
+            upload_count = settings.upload_quota
 
             return render_template('upload.html', auth=check_authorized_status(),
                                    upload_count=upload_count,
+                                   runs=get_analysis(get_username()),
                                    response=None,
                                    version=version.__version__)
     except Exception as e:
@@ -156,6 +247,34 @@ def upload():
                                auth=check_authorized_status(), version=version.__version__)
 
 
+@application.route('/ready')
+def ready():
+    """
+    readiness probe, healthy once the connections of this worker are warm
+    :return:    warm-up status, 200 if ready else 503
+    """
+    warm_up()
+    return jsonify(readiness.report()), 200 if readiness.ready else 503
+
+
+@application.route('/metrics')
+def prometheus_metrics():
+    """
+    metrics of this worker process in the Prometheus text format
+    :return:    stage and request latency histograms, and OpenAI token counters
+    """
+    token = _vars.get('METRICS_TOKEN')
+    if token:
+        authorized = hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    else:
+        # without a token only a scraper on the host itself is served, never a request relayed by a proxy
+        authorized = request.remote_addr in constants.METRICS_LOCAL_ADDRESSES and \
+            'X-Forwarded-For' not in request.headers
+    if not authorized:
+        return Response('Forbidden\n', status=403, content_type='text/plain')
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @application.route('/about')
 @application.route('/debug-sentry')
 def about():
@@ -196,13 +315,14 @@ def account():
     """
     try:
         username = get_username()
-        get_analysis(username)
+        runs = get_analysis(username)
         webhook = get_webhook()
         slack_notification_status = get_slack_notification_status()
 
         mp.track(username, "Users in Settings page")
         return render_template("account.html",
                                webhook=webhook,
+                               runs=runs,
                                settings_saved=None,
                                slack_notification_status=slack_notification_status,
                                auth=check_authorized_status(), version=version.__version__)
@@ -213,61 +333,485 @@ def account():
                                auth=check_authorized_status(), version=version.__version__)
 
 
-def fetch_performance_results(contents, filename, username):
+# Below prompts dict has the results title and the prompt for GPT to process
+PROMPTS = {
+    "High level Summary": "Act like a performance engineer. Please analyse this performance test results and give "
+                          "me a high level summary. Beautify the response in a HTML format.",
+    "Detailed Summary": "Act like a performance engineer and write a detailed summary from this raw performance "
+                        "results without a title. You need to identify the anomalies, standard deviations, "
+                        "minimum and maximum response"
+                        "time, number of errors, and number of transactions. Help me identifying potential "
+                        "bottlenecks as well. Beautify the response in a HTML list format."
+}
+
+# Below prompt narrates the comparison against a baseline run, whose verdicts are computed locally
+COMPARISON_PROMPTS = {
+    "Regression Summary": "Act like a performance engineer. Below is the comparison of a performance test run "
+                          "against its baseline run. The verdicts and flags were computed with significance tests, "
+                          "do not recompute or contradict them. Explain the regressions and improvements, which "
+                          "transactions they affect and what to investigate first. Beautify the response in a HTML "
+                          "list format."
+}
+
+
+def fetch_performance_results(contents, filename, username, prompts=PROMPTS):
     """Fetch the performance results from OpenAI
-    :param contents: contents of uploaded file
-    :param file: uploaded filename
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :param filename: uploaded filename
     :param username: logged in username
-    :return: response from OpenAI
+    :param prompts: results titles and their prompts
+    :return: response from OpenAI, and whether every result was served from the cache
     """
-    # Below prompts dict has the results title and the prompt for GPT to process
-    prompts = {
-        "High level Summary": "Act like a performance engineer. Please analyse this performance test results and give "
-                              "me a high level summary. Beautify the response in a HTML format.",
-        "Detailed Summary": "Act like a performance engineer and write a detailed summary from this raw performance "
-                            "results without a title. You need to identify the anomalies, standard deviations, "
-                            "minimum and maximum response"
-                            "time, number of errors, and number of transactions. Help me identifying potential "
-                            "bottlenecks as well. Beautify the response in a HTML list format."
-    }
+    # Resolve the Slack settings once, the prompts and background jobs run outside the request context
+    settings = get_user_settings(username)
+    webhook = settings.slack_webhook if settings is not None and settings.send_notifications == 'true' else None
+
+    with ThreadPoolExecutor(max_workers=constants.PROMPT_WORKERS) as executor:
+        futures = {title: executor.submit(analyze_prompt, title, prompt, contents, username)
+                   for title, prompt in prompts.items()}
 
     results = {}
-    for title, prompt in prompts.items():
-        response = openai.ChatCompletion.create(
-            model=constants.openai_model,
-            messages=[
-                {"role": "system", "content": f"{prompt}"},
-                {"role": "user", "content": f"{contents}"},
-            ],
-            temperature=constants.temperature,
-            top_p=constants.top_p,
-            max_tokens=constants.max_tokens,
-            presence_penalty=constants.presence_penalty,
-            frequency_penalty=constants.frequency_penalty,
-        )
-
-        log_db(username=username, openai_id=response['id'],
-               openai_prompt_tokens=response['usage']['prompt_tokens'],
-               openai_completion_tokens=response['usage']['completion_tokens'],
-               openai_total_tokens=response['usage']['total_tokens'],
-               openai_created=response['created'])
-
-        # Send Slack Notifications if enabled
-        if get_slack_notification_status() == 'true':
+    errors = []
+    cached = []
+    for title, future in futures.items():
+        try:
+            results[title], from_cache = future.result()
+            cached.append(from_cache)
+        except Exception as e:
+            capture_exception(e)
+            errors.append(e)
+            results[title] = f"Could not generate the {title.lower()}: {e}"
+
+    # Do not charge the upload if no prompt succeeded
+    if len(errors) == len(prompts):
+        raise errors[0]
+
+    notify_slack({title: results[title] for title, future in futures.items() if future.exception() is None},
+                 filename, webhook)
+
+    return results, bool(cached) and all(cached) and not errors
+
+
+def prompt_messages(prompt, contents):
+    """Chat messages of an analysis prompt
+    :param prompt: system prompt for GPT
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :return: list of chat messages
+    """
+    return [
+        {"role": "system", "content": f"{prompt}"},
+        {"role": "user", "content": f"{contents}"},
+    ]
+
+
+def chat_completion(prompt, contents, **kwargs):
+    """Call the OpenAI chat completion API with the model parameters from constants
+    :param prompt: system prompt for GPT
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :param kwargs: extra parameters, e.g. stream=True
+    :return: response from OpenAI
+    """
+    messages = prompt_messages(prompt, contents)
+    return openai.ChatCompletion.create(
+        model=constants.openai_model,
+        messages=messages,
+        temperature=constants.temperature,
+        top_p=constants.top_p,
+        max_tokens=prompt_builder.completion_token_limit(messages),
+        presence_penalty=constants.presence_penalty,
+        frequency_penalty=constants.frequency_penalty,
+        **kwargs
+    )
+
+
+def analyze_prompt(title, prompt, contents, username):
+    """Run a single analysis prompt against OpenAI
+    :param title: results title
+    :param prompt: system prompt for GPT
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :param username: logged in username
+    :return: response content from OpenAI, and whether it was served from the cache
+    """
+    cache_key = cache.make_key(contents, prompt)
+    content = cache.results_cache.get(cache_key)
+    if content is not None:
+        return content, True
+
+    with metrics.timed('openai', title):
+        response = chat_completion(prompt, contents)
+    metrics.record_openai_usage(response['usage']['prompt_tokens'], response['usage']['completion_tokens'])
+
+    log_db(username=username, openai_id=response['id'],
+           openai_prompt_tokens=response['usage']['prompt_tokens'],
+           openai_completion_tokens=response['usage']['completion_tokens'],
+           openai_total_tokens=response['usage']['total_tokens'],
+           openai_created=response['created'])
+
+    content = response['choices'][0]['message']['content']
+    cache.results_cache.set(cache_key, content)
+
+    # response = beautify_response(response['choices'][0]['message']['content'])
+
+    return content, False
+
+
+def stream_prompt(title, prompt, contents, username, events):
+    """Stream a single analysis prompt from OpenAI, putting its tokens on the events queue
+    :param title: results title
+    :param prompt: system prompt for GPT
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :param username: logged in username
+    :param events: queue receiving the (event, data) tuples to send to the browser
+    :return: response content from OpenAI, and whether it was served from the cache
+    """
+    cache_key = cache.make_key(contents, prompt)
+    content = cache.results_cache.get(cache_key)
+    if content is not None:
+        events.put(('token', {'title': title, 'text': content}))
+        return content, True
+
+    parts = []
+    openai_id = openai_created = None
+    with metrics.timed('openai', title):
+        for chunk in chat_completion(prompt, contents, stream=True):
+            openai_id, openai_created = chunk['id'], chunk['created']
+            text = chunk['choices'][0]['delta'].get('content')
+            if text:
+                parts.append(text)
+                events.put(('token', {'title': title, 'text': text}))
+    content = ''.join(parts)
+
+    # Streamed completions do not report their usage, so it is counted locally
+    prompt_tokens = tokenizer.count_message_tokens(prompt_messages(prompt, contents))
+    completion_tokens = tokenizer.count_tokens(content)
+    metrics.record_openai_usage(prompt_tokens, completion_tokens)
+    log_db(username=username, openai_id=openai_id,
+           openai_prompt_tokens=prompt_tokens,
+           openai_completion_tokens=completion_tokens,
+           openai_total_tokens=prompt_tokens + completion_tokens,
+           openai_created=openai_created)
+
+    cache.results_cache.set(cache_key, content)
+    return content, False
+
+
+def server_sent_event(event, data):
+    """Format a Server-Sent Event
+    :param event: event name
+    :param data: JSON serializable payload
+    :return: SSE message
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_performance_results(contents, filename, username, upload_count, prompts=PROMPTS, local_results=None,
+                               run_record=None):
+    """Stream the performance results from OpenAI as Server-Sent Events, token by token
+    :param contents: aggregated summary (or raw contents) of uploaded file
+    :param filename: uploaded filename
+    :param username: logged in username
+    :param upload_count: uploads left after the credit reserved for this one
+    :param prompts: results titles and their prompts
+    :param local_results: results computed without OpenAI by title, sent first
+    :param run_record: run record saved to the history once a result is analyzed, None to record nothing
+    :return: generator of SSE messages
+    """
+    settings = get_user_settings(username)
+    webhook = settings.slack_webhook if settings is not None and settings.send_notifications == 'true' else None
+    events = queue.Queue()
+
+    def run(title, prompt):
+        try:
+            return stream_prompt(title, prompt, contents, username, events)
+        finally:
+            events.put(('end', title))
+
+    executor = ThreadPoolExecutor(max_workers=constants.PROMPT_WORKERS)
+    futures = {title: executor.submit(run, title, prompt) for title, prompt in prompts.items()}
+    executor.shutdown(wait=False)
+
+    def settle():
+        # Waits for every prompt, then charges the upload, records the run and sends the Slack notification
+        results, errors, cached = {}, {}, []
+        for title, future in futures.items():
             try:
-                slack.send_slack_notifications(msg=response['choices'][0]['message']['content'],
-                                               filename=filename,
-                                               title=title,
-                                               webhook=get_webhook())
+                results[title], from_cache = future.result()
+                cached.append(from_cache)
             except Exception as e:
                 capture_exception(e)
-                pass
+                errors[title] = f"Could not generate the {title.lower()}: {e}"
+        uploads_left = upload_count
+        if not results or (all(cached) and constants.FREE_CACHED_ANALYSIS):
+            uploads_left = refund_upload_credit(username)
+        if results and run_record is not None:
+            save_run(username, run_record)
+        notify_slack(results, filename, webhook)
+        return errors, uploads_left
+
+    settled = False
+    try:
+        for title, text in (local_results or {}).items():
+            yield server_sent_event('section', {'title': title})
+            yield server_sent_event('token', {'title': title, 'text': text})
+        for title in prompts:
+            yield server_sent_event('section', {'title': title})
+        pending = len(futures)
+        while pending:
+            event, data = events.get()
+            if event == 'end':
+                pending -= 1
+                continue
+            yield server_sent_event(event, data)
+
+        settled = True
+        errors, upload_count = settle()
+        for title, error in errors.items():
+            yield server_sent_event('error', {'title': title, 'error': error})
+        yield server_sent_event('done', {'upload_count': upload_count})
+    finally:
+        # The browser went away, still settle the reserved credit once the prompts are done
+        if not settled:
+            threading.Thread(target=settle, daemon=True).start()
+
+
+def notify_slack(results, filename, webhook=None):
+    """Send Slack Notifications if enabled, as a single message delivered in the background
+    :param results: analysis results by title
+    :param filename: uploaded filename
+    :param webhook: Slack webhook, if notifications are enabled
+    """
+    if webhook and results:
+        try:
+            slack.notifier.enqueue(webhook=webhook, sections=results, filename=filename)
+        except Exception as e:
+            capture_exception(e)
+            pass
+
+
+def prepare_analysis(contents, filename, username, test_name=None, baseline_id=None):
+    """Build the prompt input of the parsed upload
+    JMeter results are compared against a baseline run, the chosen one or else the latest run of the same test,
+    and GPT only narrates the locally computed diff. Without a baseline the aggregates and samples are sent.
+    :param contents: parsed upload, as returned by ingest.read_upload
+    :param filename: uploaded filename
+    :param username: logged in username
+    :param test_name: test name the run is recorded under, defaults to the filename
+    :param baseline_id: run id of the baseline, 'none' to skip the comparison, automatic if empty
+    :return: prompts, prompt input, run record to save once analyzed (None if not a JMeter result or already
+             recorded) and the local results by title
+    """
+    summary = aggregation.summarize_upload(contents)
+    if summary is None:
+        with metrics.timed('prompt_build'):
+            return PROMPTS, prompt_builder.build_prompt_input(contents, PROMPTS.values()), None, {}
+
+    local_results = {}
+    run = comparison.make_run(summary, comparison.test_name_of(test_name, filename))
+    run['digest'] = cache.make_key(aggregation.format_summary(summary), run['test_name'])
+    latest = get_latest_run(username, run['test_name'])
+    # The same results uploaded again, e.g. a resubmitted form, are compared like the first time, so the prompt
+    # input and its cached analysis are the same, and they are not recorded twice
+    repeated = latest is not None and latest.get('digest') == run['digest']
+    if repeated and not baseline_id:
+        baseline_id = latest.get('baseline') or 'none'
+        latest = None
+    baseline = None
+    if baseline_id != 'none':
+        baseline = (get_run(username, baseline_id) if baseline_id else None) or latest
+    if baseline is None:
+        prompts = PROMPTS
+        with metrics.timed('prompt_build'):
+            prompt_input = prompt_builder.build_prompt_input(contents, prompts.values(), summary)
+    else:
+        prompts = COMPARISON_PROMPTS
+        with metrics.timed('compare'):
+            diff = comparison.compare_runs(run['labels'], baseline['labels'])
+        run.update(verdict=comparison.verdict_of(diff), baseline=baseline['run_id'])
+        with metrics.timed('prompt_build'):
+            prompt_input = prompt_builder.build_comparison_input(diff, prompts.values())
+        local_results["Baseline Comparison"] = comparison.format_comparison_html(diff, baseline)
+    if summary.get('files'):
+        local_results["Files Merged"] = aggregation.format_files_html(summary['files'])
+    if summary.get('timeseries') is not None:
+        local_results["Over Time"] = timeseries.chart_html(summary['timeseries'])
+    return prompts, prompt_input, None if repeated else run, local_results
+
+
+def analyze_contents(contents, filename, username, test_name=None, baseline_id=None, upload_count=None):
+    """Analyze the parsed upload, charging it to the user's quota
+    The credit is reserved atomically up front and refunded if the analysis fails or is served from the cache
+    :param contents: parsed upload, as returned by ingest.read_upload
+    :param filename: uploaded filename
+    :param username: logged in username
+    :param test_name: test name the run is recorded under, defaults to the filename
+    :param baseline_id: run id of the baseline, 'none' to skip the comparison, automatic if empty
+    :param upload_count: uploads left after a credit the caller already reserved, reserved here if None
+    :raises QuotaExceededError: no upload credit left
+    :return: results by title, and the uploads left
+    """
+    reserved = upload_count is not None
+    try:
+        prompts, prompt_input, run, local_results = prepare_analysis(contents, filename, username, test_name,
+                                                                     baseline_id)
+    except Exception:
+        if reserved:
+            refund_upload_credit(username)
+        raise
+    if not reserved:
+        upload_count = reserve_upload_credit(username)
+    try:
+        results, from_cache = fetch_performance_results(prompt_input, filename, username, prompts)
+    except Exception:
+        refund_upload_credit(username)
+        raise
+    # Only analyzed runs are recorded, a failed one would become the baseline of its own retry
+    if run is not None:
+        save_run(username, run)
+    if from_cache and constants.FREE_CACHED_ANALYSIS:
+        upload_count = refund_upload_credit(username)
+    return {**local_results, **results}, upload_count
+
+
+def run_analysis_job(directory, uploads, filename, username, test_name=None, baseline_id=None, align_clocks=False,
+                     upload_count=None):
+    """Background job running the whole analysis pipeline of a saved upload
+    :param directory: directory of the saved upload, removed once done
+    :param uploads: list of (path, filename) tuples of the saved files, as returned by ingest.save_uploads
+    :param filename: uploaded filename
+    :param username: logged in username
+    :param test_name: test name the run is recorded under, defaults to the filename
+    :param baseline_id: run id of the baseline, 'none' to skip the comparison, automatic if empty
+    :param align_clocks: align the clocks of the generators of several files, see ingest.clock_offsets
+    :param upload_count: uploads left after the credit reserved when the job was queued, refunded if it fails
+    :return: results by title, and the uploads left
+    """
+    try:
+        try:
+            contents = ingest.read_files(uploads, align_clocks)
+        except Exception as e:
+            if upload_count is not None:
+                refund_upload_credit(username)
+            if isinstance(e, ingest.FileTooLargeError):
+                raise jobs.JobError("File size too large.")
+            capture_exception(e)
+            raise jobs.JobError("Cannot read file data. Please make sure the file is not empty and is in one of "
+                                "the supported formats.")
+
+        try:
+            results, upload_count = analyze_contents(contents, filename, username, test_name, baseline_id,
+                                                     upload_count)
+        except QuotaExceededError as e:
+            raise jobs.JobError(str(e))
+        return {'results': results, 'upload_count': upload_count}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def uploaded_files():
+    """
+    :return:    the files of the upload form, several results files or zip archives may be sent at once
+    """
+    return [file for file in request.files.getlist('file') if file.filename]
+
+
+@application.route('/analyze/async', methods=['POST'])
+@login_required
+def askgpt_upload_async():
+    """
+    queue the analysis of the upload as a background job
+    :return:    job id and the status url to poll
+    """
+    username = get_username()
+    if 'OPENAI_API_KEY' not in _vars:
+        return jsonify(error="API key not set. Please contact the administrator."), 503
+    files = uploaded_files()
+    if not files:
+        return jsonify(error="Please upload a valid file."), 400
+
+    openai.api_key = _vars['OPENAI_API_KEY']
+    directory = tempfile.mkdtemp()
+    try:
+        uploads = ingest.save_uploads(files, directory)
+    except ingest.FileTooLargeError:
+        shutil.rmtree(directory, ignore_errors=True)
+        return jsonify(error="File size too large."), 413
+    except Exception as e:
+        capture_exception(e)
+        shutil.rmtree(directory, ignore_errors=True)
+        return jsonify(error="Cannot read file data. Please make sure the file is not empty and is in one of the "
+                             "supported formats."), 400
+
+    # The credit is taken before queuing, the job refunds it if the analysis fails
+    try:
+        upload_count = reserve_upload_credit(username)
+    except QuotaExceededError as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        return jsonify(error=str(e)), 403
+    job_id = job_runner.submit(username, run_analysis_job, directory, uploads, files[0].filename, username,
+                               request.form.get('test_name'), request.form.get('baseline'),
+                               bool(request.form.get('align_clocks')), upload_count, credit=True)
+    return jsonify(job_id=job_id, status='queued', status_url=url_for('analysis_job', job_id=job_id)), 202
+
+
+@application.route('/analyze/stream', methods=['POST'])
+@login_required
+def askgpt_upload_stream():
+    """
+    analyze the upload and stream the GPT output as Server-Sent Events
+    :return:    text/event-stream response
+    """
+    username = get_username()
+    if 'OPENAI_API_KEY' not in _vars:
+        return jsonify(error="API key not set. Please contact the administrator."), 503
+    files = uploaded_files()
+    if not files:
+        return jsonify(error="Please upload a valid file."), 400
+
+    openai.api_key = _vars['OPENAI_API_KEY']
+    filename = files[0].filename
+    try:
+        contents = ingest.read_uploads(files, bool(request.form.get('align_clocks')))
+    except ingest.FileTooLargeError:
+        return jsonify(error="File size too large."), 413
+    except Exception as e:
+        capture_exception(e)
+        return jsonify(error="Cannot read file data. Please make sure the file is not empty and is in one of the "
+                             "supported formats."), 400
+
+    prompts, prompt_input, run, local_results = prepare_analysis(contents, filename, username,
+                                                                 request.form.get('test_name'),
+                                                                 request.form.get('baseline'))
+    try:
+        upload_count = reserve_upload_credit(username)
+    except QuotaExceededError as e:
+        return jsonify(error=str(e)), 403
+    stream = stream_performance_results(prompt_input, filename, username, upload_count, prompts,
+                                        local_results, run)
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-        # response = beautify_response(response['choices'][0]['message']['content'])
 
-        results[title] = response['choices'][0]['message']['content']
+@application.route('/analyze/jobs/<job_id>')
+@login_required
+def analysis_job(job_id):
+    """
+    status of a background analysis job
+    :param job_id:  job id
+    :return:        job status, with the rendered results once done
+    """
+    job = job_runner.get(job_id)
+    if job is None or job.get('username') != get_username():
+        return jsonify(error="Job not found."), 404
 
-    return results
+    response = {'job_id': job_id, 'status': job['status']}
+    if job['status'] == 'done':
+        response['results'] = job['result']['results']
+        response['upload_count'] = job['result']['upload_count']
+        response['html'] = render_template('includes/results.html', response=job['result']['results'])
+    elif job['status'] == 'failed':
+        response['error'] = job['error']
+        response['html'] = render_template('includes/results.html', response=job['error'])
+    return jsonify(response)
 
 
 @application.route('/analyze', methods=['POST'])
@@ -280,70 +824,66 @@ def askgpt_upload():
     """
     try:
         username = get_username()
+        # Shown on the page only, the credit is taken atomically by analyze_contents
         upload_count = get_upload_count(username)
+        if upload_count is None:
+            upload_count = constants.upload_quota
+
+        try:
+            openai.api_key = _vars['OPENAI_API_KEY']
+        except KeyError:
+            return render_template("upload.html", response="API key not set. Please contact the "
+                                                           "administrator.",
+                                   auth=check_authorized_status(),
+                                   upload_count=upload_count,
+                                   version=version.__version__)
 
-        if 1 <= upload_count <= constants.upload_quota:
+        if request.files:
+            files = uploaded_files()
+            if not files:
+                return render_template('upload.html', response="Please upload a valid file.",
+                                       auth=check_authorized_status(),
+                                       upload_count=upload_count,
+                                       version=version.__version__)
             try:
-                openai.api_key = _vars['OPENAI_API_KEY']
-            except KeyError:
-                return render_template("upload.html", response="API key not set. Please contact the "
-                                                               "administrator.",
+                contents = ingest.read_uploads(files, bool(request.form.get('align_clocks')))
+            except ingest.FileTooLargeError:
+                return render_template('upload.html', response="File size too large.",
+                                       auth=check_authorized_status(),
+                                       upload_count=upload_count,
+                                       version=version.__version__)
+            except Exception as e:
+                capture_exception(e)
+
+                return render_template('upload.html', response="Cannot read file data. Please make sure "
+                                                               "the file is not empty and is in one of "
+                                                               "the"
+                                                               " supported formats.",
                                        auth=check_authorized_status(),
                                        upload_count=upload_count,
                                        version=version.__version__)
 
-            if request.files:
-                if request.files['file'].filename == '':
-                    return render_template('upload.html', response="Please upload a valid file.",
-                                           auth=check_authorized_status(),
-                                           upload_count=upload_count,
-                                           version=version.__version__)
-                file = request.files['file']
-                try:
-                    if file.filename.endswith('.csv') or file.filename.endswith('.jtl'):
-                        contents = pd.read_csv(file)
-                    elif file.filename.endswith('.json'):
-                        contents = pd.read_json(file)
-                    else:
-                        raise Exception('Invalid file type.')
-                except Exception as e:
-                    capture_exception(e)
-
-                    return render_template('upload.html', response="Cannot read file data. Please make sure "
-                                                                   "the file is not empty and is in one of "
-                                                                   "the"
-                                                                   " supported formats.",
-                                           auth=check_authorized_status(),
-                                           upload_count=upload_count,
-                                           version=version.__version__)
-
-                if contents.memory_usage().sum() > constants.FILE_SIZE:
-                    return render_template('upload.html', response="File size too large.",
-                                           auth=check_authorized_status(),
-                                           upload_count=upload_count,
-                                           version=version.__version__)
-                try:
-                    results = fetch_performance_results(contents, file.filename, username)
-                    upload_count -= 1
-                    update_upload_count(username, upload_count)
-
-                    return render_template("upload.html", response=results,
-                                           auth=check_authorized_status(),
-                                           upload_count=upload_count,
-                                           version=version.__version__)
-                except Exception as e:
-                    return render_template("upload.html", response=e,
-                                           auth=check_authorized_status(),
-                                           upload_count=upload_count,
-                                           version=version.__version__)
-            else:
-                return render_template('upload.html', response="Upload a valid file",
+            try:
+                results, upload_count = analyze_contents(contents, files[0].filename, username,
+                                                         request.form.get('test_name'),
+                                                         request.form.get('baseline'))
+
+                return render_template("upload.html", response=results,
+                                       auth=check_authorized_status(),
+                                       upload_count=upload_count,
+                                       version=version.__version__)
+            except QuotaExceededError as e:
+                return render_template("upload.html", response=str(e),
+                                       auth=check_authorized_status(),
+                                       upload_count=0,
+                                       version=version.__version__)
+            except Exception as e:
+                return render_template("upload.html", response=e,
                                        auth=check_authorized_status(),
                                        upload_count=upload_count,
                                        version=version.__version__)
         else:
-            return render_template('upload.html', response="You do not have enough credits. Please wait for the "
-                                                           "next month credit or upgrade now.",
+            return render_template('upload.html', response="Upload a valid file",
                                    auth=check_authorized_status(),
                                    upload_count=upload_count,
                                    version=version.__version__)
@@ -356,6 +896,23 @@ def askgpt_upload():
                                version=version.__version__)
 
 
+@application.route('/account/history/delete', methods=['POST'])
+@login_required
+def delete_history():
+    """
+    deletes the run history of the user
+    :return:    redirect to the account page
+    """
+    username = get_username()
+    deleted = delete_run_history(username)
+    mp.track(username, "Users deleted their run history")
+    if deleted is None:
+        return render_template("invalid.html", image=invalid_image,
+                               response="Could not delete your run history. Please try again.",
+                               auth=check_authorized_status(), version=version.__version__)
+    return redirect('/account')
+
+
 @application.route('/saveslack', methods=['POST'])
 @application.route('/debug-sentry')
 @login_required
@@ -0,0 +1,301 @@
+"""
+Offline load test of PerfGPT.
+
+Runs the application in process behind a threaded WSGI server, with OpenAI, GitHub, Slack, Mixpanel and the
+analytics gateway replaced by local fakes (benchmarks/fakes.py) and AWS emulated by moto. Concurrent clients
+drive the home page, the upload page and the analysis endpoints with synthetic JMeter results of increasing
+size, and every scenario reports latency percentiles, throughput, peak RSS and outbound calls per request.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python -m benchmarks.bench --requests 40 --concurrency 8 --rows 1000 10000 100000
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+from benchmarks import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_RESULTS = os.path.join(ROOT, 'samples', 'jmeter', 'run.csv')
+REGION = 'us-east-2'
+PERFGPT_TABLE = 'perfgpt-bench'
+SETTINGS_TABLE = 'perfgpt-settings-bench'
+# Large enough that no benchmark user runs out of credits
+BENCH_QUOTA = 1_000_000
+
+
+def configure_environment(env, services):
+    """
+    sets the variables read at import time by utils and application, pointing every service at the fakes
+    :param env:         development or production
+    :param services:    running FakeServices
+    :return:            None
+    """
+    os.environ.update({
+        'FLASK_ENV': env,
+        'FLASK_SECRET_KEY': 'bench-secret-key',
+        'ARN': 'arn:aws:iam::123456789012:role/perfgpt-bench',
+        'AWS_DYNAMODB_KEY': 'bench',
+        'AWS_DYNAMODB_SECRET': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': REGION,
+        'DYNAMODB_PERFGPT_TABLE': PERFGPT_TABLE,
+        'DYNAMODB_SETTINGS_TABLE': SETTINGS_TABLE,
+        'GITHUB_OAUTH_CLIENT_ID': 'bench',
+        'GITHUB_OAUTH_CLIENT_SECRET': 'bench',
+        'MIXPANEL_US': 'bench',
+        'OPENAI_API_KEY': 'sk-bench',
+        'SENTRY_KEY': '',
+        'AWS_GATEWAY_URL': f'{services.url}/analytics',
+        # The fake GitHub API is served over plain HTTP
+        'OAUTHLIB_INSECURE_TRANSPORT': '1',
+    })
+
+
+def create_aws_resources(services):
+    """
+    creates the DynamoDB tables and the production secrets in moto
+    :param services:    running FakeServices
+    :return:            None
+    """
+    import boto3
+
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    dynamodb.create_table(TableName=PERFGPT_TABLE,
+                          KeySchema=[{'AttributeName': 'username', 'KeyType': 'HASH'},
+                                     {'AttributeName': 'datetime', 'KeyType': 'RANGE'}],
+                          AttributeDefinitions=[{'AttributeName': 'username', 'AttributeType': 'S'},
+                                                {'AttributeName': 'datetime', 'AttributeType': 'S'}],
+                          BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName=SETTINGS_TABLE,
+                          KeySchema=[{'AttributeName': 'username', 'KeyType': 'HASH'}],
+                          AttributeDefinitions=[{'AttributeName': 'username', 'AttributeType': 'S'}],
+                          BillingMode='PAY_PER_REQUEST')
+
+    secrets = boto3.client('secretsmanager', region_name=REGION)
+    values = {'GITHUB_OAUTH_CLIENT_ID': 'bench', 'GITHUB_OAUTH_CLIENT_SECRET': 'bench', 'MIXPANEL_US': 'bench',
+              'OPENAI_API_KEY': 'sk-bench', 'ANALYTICS_URL': f'{services.url}/analytics', 'SENTRY_KEY': ''}
+    # Every secret is a JSON object holding one key named like the secret
+    for name, value in values.items():
+        secrets.create_secret(Name=name, SecretString=json.dumps({name: value}))
+
+
+def load_application(services, users):
+    """
+    imports the application and wires it to the fakes
+    :param services:    running FakeServices
+    :param users:       number of benchmark users to seed in the settings table
+    :return:            Flask application
+    """
+    sys.path.insert(0, ROOT)
+    import openai
+
+    import application
+    import constants
+    import utils
+    from integrations.slack import slack
+
+    constants.upload_quota = BENCH_QUOTA
+    openai.api_base = f'{services.url}/v1'
+    slack.SLACK_WEBHOOK_URL = services.url + '/slack/{webhook}'
+    application.github_bp.base_url = f'{services.url}/'
+    application.mp.get()._consumer = fakes.FakeMixpanelConsumer()
+
+    utils.init_dynamodb()
+    for user in range(users):
+        utils.settings_table.put_item(Item={'username': f'bench-user-{user}',
+                                            'initial_upload_quota': BENCH_QUOTA,
+                                            'slack_webhook': f'bench/{user}',
+                                            'send_notifications': 'true'})
+    application.readiness.wait(constants.STARTUP_TIMEOUT)
+    return application.application
+
+
+def serve(app):
+    """
+    serves the application on a free localhost port from a background thread
+    :param app: Flask application
+    :return:    base URL
+    """
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='perfgpt-bench', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def session_cookie(app, user):
+    """
+    signs a Flask session holding a GitHub OAuth token, as left behind by a completed login
+    :param app:     Flask application
+    :param user:    benchmark user number
+    :return:        session cookie value
+    """
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'github_oauth_token': {'access_token': f'{fakes.TOKEN_PREFIX}{user}',
+                                                    'token_type': 'bearer'}})
+
+
+def synthetic_results(rows):
+    """
+    repeats the sample JMeter results to the requested number of rows, advancing the timestamps
+    :param rows:    number of rows
+    :return:        CSV text
+    """
+    sample = pd.read_csv(SAMPLE_RESULTS)
+    repeats = -(-rows // len(sample))
+    frames = []
+    span = int(sample['timeStamp'].max() - sample['timeStamp'].min()) + 1
+    for repeat in range(repeats):
+        frame = sample.copy()
+        frame['timeStamp'] += repeat * span
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True).head(rows).to_csv(index=False)
+
+
+# Uploads of every scenario are numbered apart, so no two of them share a cached result
+upload_numbers = itertools.count()
+
+
+def unique_upload(csv_text, request_number):
+    """
+    appends one slow sample so every upload summarizes differently and misses the result cache
+    :param csv_text:        synthetic results
+    :param request_number:  request number
+    :return:                CSV bytes
+    """
+    last = csv_text.rstrip('\n').rsplit('\n', 1)[-1].split(',')
+    last[1] = str(100_000 + request_number)
+    return (csv_text + ','.join(last) + '\n').encode('utf-8')
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def run_scenario(name, base_url, app, args, request):
+    """
+    sends args.requests requests from args.concurrency clients and prints the measurements
+    :param name:        scenario name
+    :param base_url:    URL of the application
+    :param app:         Flask application
+    :param args:        command line arguments
+    :param request:     function(session, number) sending one request and returning the response
+    :return:            None
+    """
+    import utils
+
+    sessions = []
+    for user in range(args.concurrency):
+        session = requests.Session()
+        # Same domain as the cookie the application sets back, so the updated session replaces it
+        session.cookies.set(app.config['SESSION_COOKIE_NAME'], session_cookie(app, user), domain='127.0.0.1')
+        sessions.append(session)
+
+    latencies, failures = [], []
+    lock = threading.Lock()
+
+    def send(number):
+        started = time.perf_counter()
+        response = request(sessions[number % args.concurrency], base_url, number)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                failures.append(f'{response.status_code} {response.text[:200]}')
+
+    before = fakes.calls.snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.requests)))
+    duration = time.perf_counter() - started
+    # Usage records are written in the background, count them against this scenario
+    utils.usage_writer.flush()
+    outbound = fakes.calls.snapshot()
+    outbound.subtract(before)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<28} p50 {percentile(latencies, 50) * 1000:8.1f} ms  p95 {percentile(latencies, 95) * 1000:8.1f} ms"
+          f"  p99 {percentile(latencies, 99) * 1000:8.1f} ms  mean {statistics.mean(latencies) * 1000:8.1f} ms"
+          f"  {args.requests / duration:7.2f} req/s  errors {len(failures)}  peak RSS {peak_rss:7.1f} MB")
+    per_request = ', '.join(f'{service} {count / args.requests:.2f}'
+                            for service, count in sorted(outbound.items()) if count)
+    print(f"{'':<28} outbound calls per request: {per_request or 'none'}")
+    if failures:
+        print(f"{'':<28} first error: {failures[0]}")
+
+
+def analyze(path, csv_text=None, unique=True):
+    def request(session, base_url, number):
+        data = unique_upload(csv_text, next(upload_numbers)) if unique else csv_text.encode('utf-8')
+        response = session.post(f'{base_url}{path}', files={'file': ('results.csv', io.BytesIO(data), 'text/csv')})
+        # Read streamed responses to the end
+        response.content
+        return response
+
+    return request
+
+
+def page(path):
+    def request(session, base_url, number):
+        return session.get(f'{base_url}{path}')
+
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients, each a different user')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='rows of the synthetic results uploaded by the analysis scenarios')
+    parser.add_argument('--env', choices=['development', 'production'], default='development',
+                        help='production also reads every secret from Secrets Manager')
+    parser.add_argument('--openai-latency', type=float, default=0.5, help='seconds per fake chat completion')
+    parser.add_argument('--stream', action='store_true', help='also benchmark /analyze/stream')
+    args = parser.parse_args()
+
+    from moto import mock_aws
+
+    services = fakes.FakeServices(openai_latency=args.openai_latency).start()
+    configure_environment(args.env, services)
+    aws = mock_aws()
+    aws.start()
+    try:
+        create_aws_resources(services)
+        fakes.count_aws_calls()
+        started = time.perf_counter()
+        app = load_application(services, args.concurrency)
+        print(f"Application loaded in {(time.perf_counter() - started) * 1000:.0f} ms")
+        base_url = serve(app)
+
+        run_scenario('GET /', base_url, app, args, page('/'))
+        run_scenario('GET /upload', base_url, app, args, page('/upload'))
+        for rows in args.rows:
+            csv_text = synthetic_results(rows)
+            run_scenario(f'POST /analyze {rows} rows', base_url, app, args, analyze('/analyze', csv_text))
+            if args.stream:
+                run_scenario(f'POST /analyze/stream {rows} rows', base_url, app, args,
+                             analyze('/analyze/stream', csv_text))
+        cached = synthetic_results(args.rows[0])
+        run_scenario('POST /analyze cached', base_url, app, args, analyze('/analyze', cached, unique=False))
+    finally:
+        aws.stop()
+        services.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Local stand-ins for the services the application talks to, so it can be benchmarked offline.
+
+FakeServices serves the OpenAI chat completion API, GitHub's /user, the analytics gateway and a Slack
+webhook sink over HTTP on localhost, and counts every call. AWS (STS, DynamoDB and Secrets Manager) is
+emulated in memory by moto, and every botocore API call is counted as well.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import botocore.client
+
+# Usernames handed out by the fake GitHub, derived from the access token
+TOKEN_PREFIX = 'bench-token-'
+
+
+class CallCounter:
+    """
+    Thread-safe counter of outbound calls per service.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, service):
+        with self._lock:
+            self.counts[service] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.counts)
+
+
+calls = CallCounter()
+
+
+def count_aws_calls():
+    """
+    counts every botocore API call as an outbound AWS call, per service
+    :return:    None
+    """
+    make_api_call = botocore.client.BaseClient._make_api_call
+
+    def counted(self, operation_name, api_params):
+        calls.add(f"aws.{self.meta.service_model.service_name}")
+        return make_api_call(self, operation_name, api_params)
+
+    botocore.client.BaseClient._make_api_call = counted
+
+
+class FakeMixpanelConsumer:
+    """
+    Replaces the Mixpanel consumer, events are only counted.
+    """
+
+    def send(self, endpoint, json_message, *args, **kwargs):
+        calls.add('mixpanel')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        services = self.server.services
+        if self.path.startswith('/user'):
+            calls.add('github')
+            token = self.headers.get('Authorization', '').split(' ')[-1]
+            self._json({'login': token.replace(TOKEN_PREFIX, 'bench-user-')})
+        elif self.path.startswith('/analytics'):
+            calls.add('analytics')
+            time.sleep(services.analytics_latency)
+            self._json({'total_tokens': 123456, 'total_users': 789, 'total_uploads': 4242})
+        else:
+            self._json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        services = self.server.services
+        body = self._read_body()
+        if self.path.startswith('/v1/chat/completions'):
+            calls.add('openai')
+            self._chat_completion(services, json.loads(body))
+        elif self.path.startswith('/slack/'):
+            calls.add('slack')
+            time.sleep(services.slack_latency)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        else:
+            self._json({'error': 'not found'}, status=404)
+
+    def _chat_completion(self, services, request):
+        created = int(time.time())
+        content = '<ul>' + '<li>Benchmark finding</li>' * max(1, services.completion_tokens // 6) + '</ul>'
+        if not request.get('stream'):
+            time.sleep(services.openai_latency)
+            self._json({
+                'id': f'chatcmpl-bench-{time.time_ns()}',
+                'object': 'chat.completion',
+                'created': created,
+                'model': request['model'],
+                'usage': {'prompt_tokens': services.prompt_tokens,
+                          'completion_tokens': services.completion_tokens,
+                          'total_tokens': services.prompt_tokens + services.completion_tokens},
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        completion_id = f'chatcmpl-bench-{time.time_ns()}'
+        pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+        delay = services.openai_latency / max(1, len(pieces))
+        for piece in pieces + [None]:
+            delta = {'content': piece} if piece is not None else {}
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                     'model': request['model'],
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': None if piece else 'stop'}]}
+            self._chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            time.sleep(delay)
+        self._chunk(b'data: [DONE]\n\n')
+        self._chunk(b'')
+
+    def _chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of concurrent clients must not be refused by a short listen backlog
+    request_queue_size = 128
+
+
+class FakeServices:
+    """
+    HTTP server on localhost emulating OpenAI, GitHub, the analytics gateway and Slack.
+    """
+
+    def __init__(self, openai_latency=0.5, prompt_tokens=1500, completion_tokens=400, analytics_latency=0.05,
+                 slack_latency=0.05):
+        self.openai_latency = openai_latency
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.analytics_latency = analytics_latency
+        self.slack_latency = slack_latency
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.services = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-services', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from sentry_sdk import capture_exception
+
+import constants
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after a TTL.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return:    cached value, or None if missing or expired
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key:     cache key
+        :param value:   value to cache
+        :param ttl:     optional TTL in seconds overriding the default
+        :return:        None
+        """
+        with self._lock:
+            self._items[key] = (time.time() + (ttl or self.ttl), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """
+        :param key: cache key
+        :return:    None
+        """
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class DiskCache:
+    """
+    Persistent cache tier storing one JSON file per key, expired on read or purge.
+    Writes start a background purge of the expired entries at most once per purge interval.
+    """
+
+    def __init__(self, directory, ttl, purge_interval=constants.DISK_CACHE_PURGE_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.purged_at = time.time()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return:    cached value, or None if missing or expired
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item['created'] + self.ttl < time.time():
+            self.delete(key)
+            return None
+        return item['value']
+
+    def set(self, key, value):
+        """
+        :param key:     cache key
+        :param value:   JSON serializable value
+        :return:        None
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'created': time.time(), 'value': value}, f)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._purge_if_due()
+
+    def delete(self, key):
+        """
+        :param key: cache key
+        :return:    None
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def purge_expired(self):
+        """
+        removes all the expired entries
+        :return:    number of removed entries
+        """
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') and self.get(name[:-len('.json')]) is None:
+                removed += 1
+            elif not name.endswith('.json'):
+                # temporary files left behind by a writer killed between the dump and the rename, or markers
+                try:
+                    if os.path.getmtime(os.path.join(self.directory, name)) + self.ttl < time.time():
+                        os.remove(os.path.join(self.directory, name))
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def _purge_if_due(self):
+        with self._lock:
+            if time.time() - self.purged_at < self.purge_interval:
+                return
+            self.purged_at = time.time()
+        threading.Thread(target=self._purge, daemon=True).start()
+
+    def _purge(self):
+        try:
+            removed = self.purge_expired()
+            logging.info(f"Purged {removed} expired entries from {self.directory}")
+        except Exception as e:
+            logging.error(f"Could not purge {self.directory}: {e}")
+            capture_exception(e)
+
+
+class ResultCache:
+    """
+    Two tier (memory, then disk) cache for GPT analysis results.
+    """
+
+    def __init__(self, maxsize=constants.RESULT_CACHE_SIZE, ttl=constants.RESULT_CACHE_TTL,
+                 directory=constants.RESULT_CACHE_DIR):
+        self.memory = TTLCache(maxsize, ttl)
+        self.disk = None
+        try:
+            self.disk = DiskCache(directory, ttl)
+        except OSError as e:
+            logging.error(f"Result cache directory not available, caching in memory only: {e}")
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return:    cached result, or None on a miss
+        """
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        :param key:     cache key
+        :param value:   JSON serializable result
+        :return:        None
+        """
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except OSError as e:
+                logging.error(f"Could not persist cached result: {e}")
+
+
+class StaleWhileRevalidateCache:
+    """
+    Serves the last loaded value immediately and reloads it in a background thread once it is older than the interval.
+    Only the very first load is waited for, and never longer than wait_timeout.
+    """
+
+    def __init__(self, loader, interval, wait_timeout):
+        self.loader = loader
+        self.interval = interval
+        self.wait_timeout = wait_timeout
+        self.value = None
+        self.checked_at = 0
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+
+        :return:    the last loaded value, or None if nothing could be loaded in time
+        """
+        if time.time() - self.checked_at >= self.interval:
+            self.refresh_async()
+        refreshed = self._refreshed
+        if self.value is None and refreshed is not None:
+            refreshed.wait(self.wait_timeout)
+        return self.value
+
+    def refresh_async(self):
+        """
+        starts a background reload unless one is already running
+        :return:    None
+        """
+        with self._lock:
+            if self._refreshed is not None and not self._refreshed.is_set():
+                return
+            self.checked_at = time.time()
+            refreshed = self._refreshed = threading.Event()
+        threading.Thread(target=self._refresh, args=(refreshed,), daemon=True).start()
+
+    def refresh(self, timeout=None):
+        """
+        reloads the value unless a reload is already running, and waits for it
+        :param timeout: seconds to wait
+        :return:        the last loaded value
+        """
+        self.refresh_async()
+        self._refreshed.wait(timeout)
+        return self.value
+
+    def _refresh(self, refreshed):
+        try:
+            value = self.loader()
+            if value is not None:
+                self.value = value
+        except Exception as e:
+            logging.error(f"Background refresh failed: {e}")
+            capture_exception(e)
+        finally:
+            refreshed.set()
+
+
+def make_key(contents, prompt):
+    """
+    content address of an analysis: the normalized upload, the prompt and the model parameters
+    :param contents:    prompt input built from the uploaded file
+    :param prompt:      system prompt
+    :return:            hex digest
+    """
+    parameters = [constants.openai_model, constants.temperature, constants.top_p, constants.max_tokens,
+                  constants.presence_penalty, constants.frequency_penalty]
+    normalized = '\n'.join(line.rstrip() for line in f"{contents}".strip().splitlines())
+    digest = hashlib.sha256()
+    for part in [normalized, prompt, json.dumps(parameters)]:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+results_cache = ResultCache()
@@ -0,0 +1,210 @@
+import html
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import constants
+
+# Per-label statistics kept in the run history, enough to compare two runs
+RUN_COLUMNS = ['count', 'errors', 'throughput', 'elapsed_mean', 'elapsed_std', 'elapsed_p50', 'elapsed_p90',
+               'elapsed_p95', 'elapsed_p99', 'elapsed_p99.9']
+LATENCY_STATS = ['p50', 'p95', 'p99', 'mean']
+# Row of the run-wide statistics, compared like any label
+OVERALL_LABEL = '(overall)'
+VERDICT_ORDER = {'regression': 0, 'improvement': 1, 'new': 2, 'missing': 3, 'unchanged': 4, 'inconclusive': 5}
+
+
+def test_name_of(test_name, filename):
+    """
+    cleans the test name given with the upload, defaulting to the uploaded file name
+    :param test_name:   test name from the form, may be empty
+    :param filename:    uploaded filename
+    :return:            test name, without the '#' separating it from the timestamp in the run id
+    """
+    name = (test_name or '').strip() or (filename or '').rsplit('/', 1)[-1].rsplit('.', 1)[0] or 'test'
+    return name.replace('#', '-')[:constants.HISTORY_TEST_NAME_LENGTH]
+
+
+def run_labels(summary):
+    """
+    compact per-label table of a summary, with the overall statistics as one more row
+    :param summary: dict returned by summarize_results or ResultsAggregator.summary
+    :return:        pandas DataFrame indexed by label with the RUN_COLUMNS present
+    """
+    per_label = summary['per_label']
+    columns = [column for column in RUN_COLUMNS if column in per_label.columns]
+    # The labels with the most samples, as an item holds at most 400 KB
+    labels = per_label.nlargest(constants.HISTORY_MAX_LABELS, 'count')[columns].astype(float)
+    overall = summary['overall']
+    totals = {'count': overall['samples'], 'errors': overall['errors'], 'throughput': overall.get('throughput')}
+    totals.update({column: overall.get(column) for column in columns if column.startswith('elapsed_')})
+    labels.loc[OVERALL_LABEL] = pd.Series(totals, dtype=float)
+    return labels
+
+
+def make_run(summary, test_name):
+    """
+    builds the history record of an analyzed run
+    :param summary:     dict returned by summarize_results or ResultsAggregator.summary
+    :param test_name:   cleaned test name
+    :return:            dict with the run id, test name, creation time, the per-label table and the per-label
+                        elapsed sketches
+    """
+    created = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    return {'run_id': f'{test_name}#{created}', 'test_name': test_name, 'created': created,
+            'samples': int(summary['overall']['samples']), 'labels': run_labels(summary),
+            'sketches': summary.get('sketches') or {}}
+
+
+def encode_labels(labels):
+    """
+    :param labels:  per-label table of a run
+    :return:        JSON text, DynamoDB does not store floats
+    """
+    return labels.to_json(orient='split', double_precision=6)
+
+
+def decode_labels(text):
+    """
+    :param text:    JSON text written by encode_labels
+    :return:        per-label table of a run
+    """
+    data = json.loads(text)
+    return pd.DataFrame(data['data'], index=data['index'], columns=data['columns'], dtype=float)
+
+
+def _rate_z(events_a, time_a, events_b, time_b):
+    # z statistic of the difference of two Poisson rates, events per unit of time
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_a, rate_b = events_a / time_a, events_b / time_b
+        return (rate_b - rate_a) / np.sqrt(rate_a / time_a + rate_b / time_b)
+
+
+def compare_runs(current, baseline):
+    """
+    diffs the per-label statistics of two runs and flags the significant changes, one vectorized pass over labels
+    latency means are compared with Welch's t statistic, error rates with a two-proportion z test and throughput
+    as Poisson rates, a change is only flagged when it is both significant and larger than its threshold
+    :param current:     per-label table of the new run
+    :param baseline:    per-label table of the baseline run
+    :return:            pandas DataFrame indexed by label with the baseline and current values, the changes,
+                        the flags and a verdict per label
+    """
+    labels = current.index.union(baseline.index, sort=False)
+    new, base = current.reindex(labels), baseline.reindex(labels)
+    diff = pd.DataFrame(index=labels)
+
+    n_new, n_base = new['count'], base['count']
+    enough = (n_new >= constants.COMPARISON_MIN_SAMPLES) & (n_base >= constants.COMPARISON_MIN_SAMPLES)
+    z = constants.COMPARISON_Z
+    worse = pd.Series('', index=labels)
+    better = pd.Series('', index=labels)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for stat in LATENCY_STATS:
+            column = f'elapsed_{stat}'
+            if column in new.columns and column in base.columns:
+                diff[f'{stat}_base'], diff[stat] = base[column], new[column]
+                diff[f'{stat}_change'] = (new[column] - base[column]) / base[column] * 100
+
+        moments = {'elapsed_mean', 'elapsed_std'}
+        if moments.issubset(new.columns) and moments.issubset(base.columns):
+            standard_error = np.sqrt(new['elapsed_std'] ** 2 / n_new + base['elapsed_std'] ** 2 / n_base)
+            t = (new['elapsed_mean'] - base['elapsed_mean']) / standard_error
+            # A shifted tail counts as much as a shifted mean, once the mean moved significantly
+            change = diff[[f'{stat}_change' for stat in ['p95', 'mean'] if f'{stat}_change' in diff.columns]]
+            slower = enough & (t > z) & (change.max(axis=1) > constants.LATENCY_THRESHOLD_PCT)
+            faster = enough & (t < -z) & (change.min(axis=1) < -constants.LATENCY_THRESHOLD_PCT)
+            worse, better = worse + np.where(slower, 'latency ', ''), better + np.where(faster, 'latency ', '')
+
+        rate_new, rate_base = new['errors'] / n_new, base['errors'] / n_base
+        diff['error_rate_base'], diff['error_rate'] = rate_base * 100, rate_new * 100
+        diff['error_rate_change'] = (rate_new - rate_base) * 100
+        pooled = (new['errors'] + base['errors']) / (n_new + n_base)
+        error_z = (rate_new - rate_base) / np.sqrt(pooled * (1 - pooled) * (1 / n_new + 1 / n_base))
+        more = enough & (error_z > z) & (diff['error_rate_change'] > constants.ERROR_RATE_THRESHOLD)
+        fewer = enough & (error_z < -z) & (diff['error_rate_change'] < -constants.ERROR_RATE_THRESHOLD)
+        worse, better = worse + np.where(more, 'errors ', ''), better + np.where(fewer, 'errors ', '')
+
+        if 'throughput' in new.columns and 'throughput' in base.columns:
+            diff['throughput_base'], diff['throughput'] = base['throughput'], new['throughput']
+            diff['throughput_change'] = (new['throughput'] - base['throughput']) / base['throughput'] * 100
+            rate_z = _rate_z(n_base, n_base / base['throughput'], n_new, n_new / new['throughput'])
+            lower = enough & (rate_z < -z) & (diff['throughput_change'] < -constants.THROUGHPUT_THRESHOLD_PCT)
+            higher = enough & (rate_z > z) & (diff['throughput_change'] > constants.THROUGHPUT_THRESHOLD_PCT)
+            worse, better = worse + np.where(lower, 'throughput ', ''), better + np.where(higher, 'throughput ', '')
+
+    diff['count_base'], diff['count'] = n_base.astype('Int64'), n_new.astype('Int64')
+    diff['worse'], diff['better'] = worse.str.strip(), better.str.strip()
+    diff['verdict'] = np.select(
+        [n_base.isna(), n_new.isna(), diff['worse'] != '', diff['better'] != '', ~enough],
+        ['new', 'missing', 'regression', 'improvement', 'inconclusive'], 'unchanged')
+    return diff
+
+
+def verdict_of(diff):
+    """
+    :param diff:    DataFrame returned by compare_runs
+    :return:        verdict of the whole run: regression, improvement or unchanged
+    """
+    verdicts = set(diff['verdict'])
+    if 'regression' in verdicts:
+        return 'regression'
+    return 'improvement' if 'improvement' in verdicts else 'unchanged'
+
+
+def changed_labels(diff):
+    """
+    :param diff:    DataFrame returned by compare_runs
+    :return:        the overall row and the labels that changed, most severe first, then by samples
+    """
+    ranked = diff.assign(_order=diff['verdict'].map(VERDICT_ORDER),
+                         _overall=diff.index != OVERALL_LABEL, _count=diff['count'].fillna(diff['count_base']))
+    ranked = ranked.sort_values(['_overall', '_order', '_count'], ascending=[True, True, False], kind='stable')
+    keep = (ranked.index == OVERALL_LABEL) | ranked['verdict'].isin(['regression', 'improvement', 'new', 'missing'])
+    return ranked[keep].drop(columns=['_order', '_overall', '_count'])
+
+
+def format_comparison(diff, labels=None):
+    """
+    renders the comparison as compact text for the prompt, the verdicts are already decided
+    :param diff:    DataFrame returned by compare_runs
+    :param labels:  number of changed labels to show, all of them by default
+    :return:        comparison text
+    """
+    counts = diff.loc[diff.index != OVERALL_LABEL, 'verdict'].value_counts()
+    changed = changed_labels(diff)
+    shown = changed if labels is None else changed.head(labels + 1)
+    columns = [column for column in diff.columns if column not in ['worse', 'better', 'verdict']]
+    table = shown[['verdict', 'worse', 'better'] + columns]
+    lines = ['Comparison of a performance test run against its baseline run (times in ms, throughput in '
+             'requests/sec, changes in %, error rate changes in percentage points).',
+             f'Verdict: {verdict_of(diff)}. Labels: ' +
+             ', '.join(f'{count} {verdict}' for verdict, count in counts.items()) + '.',
+             'Verdicts and flags come from significance tests (Welch t on mean latency, two-proportion z on '
+             f'errors, Poisson rate on throughput, |z| > {constants.COMPARISON_Z:g}) and thresholds '
+             f'(latency {constants.LATENCY_THRESHOLD_PCT}%, errors {constants.ERROR_RATE_THRESHOLD} points, '
+             f'throughput {constants.THROUGHPUT_THRESHOLD_PCT}%).',
+             'Overall and changed labels:',
+             table.to_csv(float_format='%.2f', na_rep='-').strip()]
+    if len(shown) < len(changed):
+        lines.append(f'(showing {len(shown) - 1} of {len(changed) - 1} changed labels, the most severe first)')
+    return '\n'.join(lines)
+
+
+def format_comparison_html(diff, baseline):
+    """
+    renders the locally computed verdicts as an HTML table shown next to the GPT narrative
+    :param diff:        DataFrame returned by compare_runs
+    :param baseline:    run record of the baseline
+    :return:            HTML text
+    """
+    table = changed_labels(diff)
+    columns = ['verdict', 'worse', 'better', 'p95_base', 'p95', 'p95_change', 'error_rate_base', 'error_rate',
+               'throughput_base', 'throughput', 'throughput_change']
+    table = table[[column for column in columns if column in table.columns]]
+    title = (f"<p><b>{verdict_of(diff).capitalize()}</b> against the {html.escape(baseline['test_name'])} run of "
+             f"{baseline['created']}</p>")
+    return title + table.to_html(classes='table table-sm', float_format=lambda value: f'{value:.2f}', na_rep='-')
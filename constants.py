@@ -10,3 +10,138 @@ presence_penalty = 0.0
 dynamodb_table = "perfgpt"
 upload_quota = 10
 
+# Streaming ingestion of uploaded results
+CHUNK_SIZE = 100_000
+# CSV uploads are parsed by the multi-threaded Arrow reader when pyarrow is installed ("pyarrow"), else by pandas ("c")
+CSV_ENGINE = "pyarrow"
+ARROW_BLOCK_SIZE = 16 * 1024 * 1024
+# Bytes read from the head of an upload to sniff its format (parsers.py)
+SNIFF_BYTES = 64 * 1024
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Buckets kept by a quantile sketch, the lowest ones are collapsed beyond it (1% accuracy spans 1 ms to hours in ~1100)
+SKETCH_MAX_BUCKETS = 2048
+# Uniform random rows kept per label while streaming, offered to the model next to the aggregates
+SAMPLE_ROWS_PER_LABEL = 200
+
+# Uploads of several results files, or a zip archive of them, are aggregated file by file in a process pool
+# None shares the cores between the web workers of the host (WEB_CONCURRENCY, as read by gunicorn), up to the maximum
+INGEST_PROCESSES = None
+INGEST_MAX_PROCESSES = 4
+# Workers start from a fresh interpreter, forking the threaded web worker could copy a held lock
+INGEST_START_METHOD = "spawn"
+UPLOAD_MAX_FILES = 64
+UPLOAD_MAX_EXTRACTED_BYTES = 4 * 1024 ** 3
+# Rows read from the head of every file to find when its generator started
+CLOCK_SKEW_PROBE_ROWS = 1000
+# When the user asks for it, generators starting further apart than the tolerance, and less than the maximum, are
+# aligned to the median start
+CLOCK_SKEW_TOLERANCE = 1000  # ms
+CLOCK_SKEW_MAX = 10 * 60 * 1000  # ms
+
+# Number of analysis prompts sent to OpenAI concurrently
+PROMPT_WORKERS = 4
+
+# Cache of GPT analysis results, keyed by the uploaded contents, prompt and model parameters
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 7 * 24 * 60 * 60
+RESULT_CACHE_DIR = "/tmp/perfgpt-cache"
+# Expired files of the disk caches (results and jobs) are removed in the background at most once per interval
+DISK_CACHE_PURGE_INTERVAL = 60 * 60
+# Do not charge the upload quota when every result is served from the cache
+FREE_CACHED_ANALYSIS = True
+
+# How long the GitHub login of a session is trusted before asking api.github.com again
+GITHUB_IDENTITY_TTL = 5 * 60
+
+# Connections kept alive by the shared DynamoDB client
+DYNAMODB_MAX_POOL_CONNECTIONS = 25
+
+# Per user settings cached between DynamoDB reads
+USER_SETTINGS_CACHE_SIZE = 1024
+USER_SETTINGS_TTL = 30
+
+# Reserved usernames of the usage table items holding the global analytics counters and the distinct users index
+ANALYTICS_COUNTERS_KEY = "#analytics"
+ANALYTICS_USERS_KEY = "#users"
+
+# Homepage analytics are served from memory and refreshed in the background
+ANALYTICS_REFRESH_INTERVAL = 60
+ANALYTICS_REQUEST_TIMEOUT = 5
+# Longest a homepage request waits for the very first load before rendering without the totals
+ANALYTICS_FALLBACK_TIMEOUT = 0.5
+
+# Secrets fetched from AWS Secrets Manager at startup and kept in memory
+PRODUCTION_SECRETS = ['GITHUB_OAUTH_CLIENT_ID', 'GITHUB_OAUTH_CLIENT_SECRET', 'MIXPANEL_US', 'OPENAI_API_KEY',
+                      'ANALYTICS_URL', 'SENTRY_KEY']
+SECRETS_TTL = 60 * 60
+
+# Background analysis jobs, sized independently from the web workers
+ANALYSIS_WORKERS = 4
+JOBS_DIR = "/tmp/perfgpt-jobs"
+JOBS_TTL = 24 * 60 * 60
+# A queued or running job is failed when its worker stopped refreshing its heartbeat or exited,
+# or when it has not finished within the timeout
+JOBS_HEARTBEAT_INTERVAL = 30
+JOBS_STALE_AFTER = 3 * JOBS_HEARTBEAT_INTERVAL
+JOBS_TIMEOUT = 15 * 60
+
+# Token budget of the prompt input, the completion gets whatever is left of the context window
+CONTEXT_WINDOW = 8192
+PROMPT_TOKEN_BUDGET = 4000
+MIN_COMPLETION_TOKENS = 1500
+
+# Usage records are buffered and written with batch_write_item (at most 25 items per batch)
+USAGE_BATCH_SIZE = 25
+USAGE_FLUSH_INTERVAL = 5
+USAGE_MAX_RETRIES = 5
+USAGE_RETRY_BACKOFF = 0.1
+
+# Buckets of the latency histograms exported on /metrics, in seconds
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Shared by the gunicorn workers, each writes its metrics there at this interval (seconds) so a scrape sees them all
+METRICS_DIR = "/tmp/perfgpt-metrics"
+METRICS_FLUSH_INTERVAL = 5
+# Addresses allowed to scrape /metrics when no METRICS_TOKEN is set
+METRICS_LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Sentry tracing: base sample rate (SENTRY_TRACES_SAMPLE_RATE in the environment overrides it), per path prefix
+# rates, and a cap on the traces sent per minute by each process
+SENTRY_TRACES_SAMPLE_RATE = 0.05
+SENTRY_TRACES_PATH_RATES = {'/metrics': 0.0, '/ready': 0.0, '/static/': 0.0, '/favicon.ico': 0.0, '/analyze': 0.25}
+SENTRY_TRACES_PER_MINUTE = 30
+
+# Startup: warm-up tasks run in parallel, and a preloading master waits for them before forking workers
+STARTUP_WORKERS = 4
+STARTUP_TIMEOUT = 30
+# Key read from the settings table to open the DynamoDB connections before reporting ready
+READINESS_PROBE_KEY = "#readiness"
+
+# Run history: one record per analyzed run, stored in the usage table under a reserved username per user
+HISTORY_KEY_PREFIX = "#runs#"
+# Small copy of every run sorted by creation time, listed without reading the per-label tables and sketches
+HISTORY_INDEX_PREFIX = "#runs-by-date#"
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_LABELS = 500
+HISTORY_TEST_NAME_LENGTH = 100
+# Serialized elapsed sketches stored with a run, those of the labels with the fewest samples are dropped beyond it
+HISTORY_SKETCH_BYTES = 150_000
+
+# Comparison against the baseline run: a change is flagged when it is significant (|z| above COMPARISON_Z, strict
+# as every label is tested) and larger than its threshold, labels with fewer samples are inconclusive
+COMPARISON_Z = 3.0
+COMPARISON_MIN_SAMPLES = 20
+LATENCY_THRESHOLD_PCT = 10
+ERROR_RATE_THRESHOLD = 1.0
+THROUGHPUT_THRESHOLD_PCT = 10
+
+# Series over time: windows of 1 s, 10 s or 1 min (TIMESERIES_WINDOW fixes one, else the finest holding
+# TIMESERIES_MIN_SAMPLES samples on average), widened while folding if a test spans more than TIMESERIES_MAX_WINDOWS,
+# then downsampled with LTTB to a point budget for the prompt and the charts
+TIMESERIES_WINDOWS = (1, 10, 60, 300, 600, 3600)
+TIMESERIES_WINDOW = None
+TIMESERIES_MIN_SAMPLES = 20
+TIMESERIES_MAX_WINDOWS = 20_000
+TIMESERIES_RELATIVE_ACCURACY = 0.02
+TIMESERIES_PROMPT_POINTS = 40
+TIMESERIES_CHART_POINTS = 300
+TIMESERIES_WINDOWS_PER_POINT = 4
@@ -0,0 +1,34 @@
+import os
+
+import constants
+import metrics
+
+# Import the application once in the master: workers are forked with the modules, configuration, secrets,
+# STS credentials and homepage analytics already loaded, and only open their own connections
+preload_app = True
+
+
+def on_starting(server):
+    # The workers share their metrics through a directory, so that any of them serves the totals on /metrics
+    os.environ.setdefault('METRICS_DIR', constants.METRICS_DIR)
+    metrics.clear_directory()
+
+
+def when_ready(server):
+    # Let the warm-up of the master finish before forking, so no worker inherits a half loaded state
+    if server.cfg.preload_app:
+        import application
+        if not application.readiness.wait(constants.STARTUP_TIMEOUT):
+            server.log.warning("Warm-up did not finish in time, starting the workers anyway.")
+
+
+def post_fork(server, worker):
+    # Every worker warms up its own DynamoDB connections, /ready reports healthy once they are open
+    metrics.reset()
+    import application
+    application.warm_up()
+
+
+def child_exit(server, worker):
+    # Keep the counts of a recycled or killed worker, so the totals never go backwards
+    metrics.retire_process(worker.pid)
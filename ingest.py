@@ -0,0 +1,449 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import constants
+import metrics
+import parsers
+import schema
+
+
+# Files kept from zip archives, simulation.log for Gatling
+RESULTS_EXTENSIONS = ('.csv', '.jtl', '.json', '.ndjson', '.jsonl', '.log')
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class FileTooLargeError(Exception):
+    """Raised when an upload that has to be held in memory exceeds constants.FILE_SIZE."""
+
+
+def _rewind(file):
+    # Paths are simply opened again, uploaded file objects are seeked back
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+
+def _csv_header(file):
+    """
+    :param file:    uploaded file object, or path of a saved upload
+    :return:        list of the column names
+    """
+    columns = list(pd.read_csv(file, nrows=0).columns)
+    _rewind(file)
+    return columns
+
+
+def _csv_chunks(file, chunksize, dtypes, arrow=True):
+    """
+    parses a CSV in chunks, with the multi-threaded Arrow reader when pyarrow is installed
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of rows parsed at a time by pandas, Arrow reads blocks of constants.ARROW_BLOCK_SIZE
+    :param dtypes:      columns with an explicit type, see schema.csv_dtypes, or None to infer them
+    :param arrow:       use the Arrow reader if available, it infers the types of the other columns from the first
+                        block and fails on a later block that does not fit them, pandas infers them per chunk
+    :return:            generator of pandas DataFrames
+    """
+    if arrow and schema.pyarrow is not None and constants.CSV_ENGINE == 'pyarrow':
+        read_options = schema.pyarrow.csv.ReadOptions(block_size=constants.ARROW_BLOCK_SIZE, use_threads=True)
+        convert_options = schema.arrow_convert_options(dtypes) if dtypes else None
+        for batch in schema.pyarrow.csv.open_csv(file, read_options=read_options, convert_options=convert_options):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file, chunksize=chunksize, dtype=dtypes)
+
+
+def _fold_chunks(chunks, operation, jtl=None, typed=True, offset=0, seed=0):
+    """
+    folds parsed chunks into running aggregates for JMeter results, else collects them
+    :param chunks:      iterable of pandas DataFrames
+    :param operation:   format the chunks are parsed from, timed as the parse stage
+    :param jtl:         whether the chunks are JMeter results, decided on the first chunk if None
+    :param typed:       chunks of JMeter results already have the compact dtypes, else they are converted
+    :param offset:      milliseconds subtracted from the timestamps of JMeter results
+    :param seed:        seed of the sample rows kept by the aggregator
+    :return:            tuple of the ResultsAggregator, or None if not a JMeter result, and the collected frames
+    """
+    aggregator = aggregation.ResultsAggregator(seed=seed) if jtl else None
+    frames = []
+    memory_usage = 0
+    chunks = iter(chunks)
+    while True:
+        with metrics.timed('parse', operation):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        if jtl is None:
+            jtl = aggregation.is_jtl(chunk)
+            aggregator = aggregation.ResultsAggregator(seed=seed) if jtl else None
+        if aggregator is not None:
+            if not typed:
+                chunk = schema.apply_schema(chunk)
+            if offset and 'timeStamp' in chunk.columns:
+                chunk['timeStamp'] = chunk['timeStamp'] - offset
+            with metrics.timed('aggregate'):
+                aggregator.update(chunk)
+            continue
+        memory_usage += chunk.memory_usage().sum()
+        if memory_usage > constants.FILE_SIZE:
+            raise FileTooLargeError('File size too large.')
+        frames.append(chunk)
+    return aggregator, frames
+
+
+def _fold_csv(file, chunksize, typed, offset=0, seed=0):
+    """
+    folds the chunks of a CSV into running aggregates for JMeter results, else collects them
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of rows parsed at a time
+    :param typed:       parse JMeter results with the explicit schema, else infer the types of each chunk with pandas
+                        and convert them after
+    :param offset:      milliseconds subtracted from the timestamps of JMeter results
+    :param seed:        seed of the sample rows kept by the aggregator
+    :return:            tuple of the ResultsAggregator, or None if not a JMeter result, and the collected frames
+    """
+    columns = _csv_header(file)
+    jtl = aggregation.REQUIRED_COLUMNS.issubset(columns)
+    reader = _csv_chunks(file, chunksize, schema.csv_dtypes(columns) if jtl and typed else None, typed)
+    return _fold_chunks(reader, 'csv', jtl, typed, offset, seed)
+
+
+def _aggregate_csv(file, chunksize, offset=0, seed=0):
+    """
+    folds a CSV with the JTL schema, falling back to inferred types when a value does not fit it
+    :return:    tuple of the ResultsAggregator, or None if not a JMeter result, and the collected frames
+    """
+    try:
+        return _fold_csv(file, chunksize, True, offset, seed)
+    except ValueError as e:
+        # A value outside the schema, e.g. a formatted timeStamp or an empty elapsed, or a column changing type
+        # after the first block, parse it the lenient way
+        logging.info(f"Results do not fit the JTL schema, inferring the column types: {e}")
+        _rewind(file)
+        return _fold_csv(file, chunksize, False, offset, seed)
+
+
+def _results(aggregator, frames):
+    """
+    :return:    summary dict of the aggregated JMeter results, else the collected frames as one DataFrame
+    """
+    if aggregator is not None and aggregator.labels is not None and len(aggregator.labels):
+        with metrics.timed('aggregate'):
+            return aggregator.summary()
+    if not frames:
+        raise ValueError('No data found in the uploaded file.')
+    return pd.concat(frames, ignore_index=True)
+
+
+def stream_csv(file, chunksize=constants.CHUNK_SIZE):
+    """
+    parses a CSV/JTL upload in bounded-size chunks
+    JMeter results are parsed with compact dtypes (schema.py) and folded into running aggregates so memory stays
+    flat regardless of the file size, any other CSV is collected as a DataFrame up to constants.FILE_SIZE
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of rows parsed at a time
+    :return:            summary dict for JMeter results, else a pandas DataFrame
+    """
+    return _results(*_aggregate_csv(file, chunksize))
+
+
+def stream_parsed(file, results_format, chunksize=constants.CHUNK_SIZE):
+    """
+    parses an upload with the streaming parser of a registered format (parsers.py)
+    samples are folded into running aggregates chunk by chunk like a JTL, aggregated formats are summarized as is
+    :param file:            uploaded file object, or path of a saved upload
+    :param results_format:  name of the format
+    :param chunksize:       number of lines parsed at a time
+    :return:                summary dict for samples, else a pandas DataFrame
+    """
+    parser = parsers.FORMATS[results_format]
+    if parser.aggregated:
+        with metrics.timed('parse', results_format):
+            return parser.parse(file, chunksize)
+    return _results(*_fold_chunks(parser.parse(file, chunksize), results_format))
+
+
+def _head(file):
+    """
+    :param file:    uploaded file object, or path of a saved upload
+    :return:        first constants.SNIFF_BYTES of the file, decoded
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as opened:
+            head = opened.read(constants.SNIFF_BYTES)
+    else:
+        head = file.read(constants.SNIFF_BYTES)
+        _rewind(file)
+    return head.decode('utf-8', errors='replace').lstrip('\ufeff')
+
+
+def detect_format(file, filename=None):
+    """
+    sniffs the format of a results file from its first bytes rather than its extension
+    :param file:        uploaded file object, or path of a saved upload
+    :param filename:    uploaded filename, defaults to file.filename
+    :return:            name of a format registered in parsers.py, else 'json' for a JSON document or 'csv'
+    """
+    filename = filename or file.filename
+    head = _head(file)
+    results_format = parsers.detect(head, filename)
+    if results_format is not None:
+        return results_format
+    if head.lstrip().startswith(('[', '{')):
+        return 'json'
+    if filename.lower().endswith(('.csv', '.jtl')) or ',' in head.split('\n', 1)[0]:
+        return 'csv'
+    raise Exception('Invalid file type.')
+
+
+def read_upload(file, filename=None):
+    """
+    reads an uploaded results file
+    :param file:        uploaded file object, or path of a saved upload
+    :param filename:    uploaded filename, defaults to file.filename
+    :return:            summary dict for streamed results, else a pandas DataFrame
+    """
+    results_format = detect_format(file, filename)
+    if results_format == 'csv':
+        return stream_csv(file)
+    elif results_format == 'json':
+        with metrics.timed('parse', 'json'):
+            contents = pd.read_json(file)
+        if aggregation.is_jtl(contents):
+            contents = schema.apply_schema(contents)
+        if contents.memory_usage().sum() > constants.FILE_SIZE:
+            raise FileTooLargeError('File size too large.')
+        return contents
+    return stream_parsed(file, results_format)
+
+
+def _is_results_file(name):
+    # Skips folders, hidden files and the resource forks macOS adds to archives
+    basename = os.path.basename(name)
+    return (not name.endswith('/') and not basename.startswith('.') and '__MACOSX' not in name
+            and basename.lower().endswith(RESULTS_EXTENSIONS))
+
+
+def save_uploads(files, directory):
+    """
+    saves the uploaded files in a directory, extracting the results files of zip archives
+    :param files:       uploaded file objects
+    :param directory:   directory the files are saved to
+    :raises FileTooLargeError:  more than constants.UPLOAD_MAX_FILES files, or archives expanding past
+                                constants.UPLOAD_MAX_EXTRACTED_BYTES
+    :return:            list of (path, filename) tuples
+    """
+    uploads = []
+    extracted = 0
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                members = [member for member in archive.infolist() if _is_results_file(member.filename)]
+                extracted += sum(member.file_size for member in members)
+                if extracted > constants.UPLOAD_MAX_EXTRACTED_BYTES:
+                    raise FileTooLargeError('Archive too large.')
+                if len(uploads) + len(members) > constants.UPLOAD_MAX_FILES:
+                    raise FileTooLargeError('Too many files.')
+                for member in members:
+                    # Saved under a generated name, the member name may hold any path
+                    path = os.path.join(directory, f'{len(uploads)}{os.path.splitext(member.filename)[1].lower()}')
+                    with archive.open(member) as source, open(path, 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                    uploads.append((path, os.path.basename(member.filename)))
+        else:
+            if len(uploads) + 1 > constants.UPLOAD_MAX_FILES:
+                raise FileTooLargeError('Too many files.')
+            path = os.path.join(directory, f'{len(uploads)}{os.path.splitext(file.filename)[1].lower()}')
+            file.save(path)
+            uploads.append((path, file.filename))
+    if not uploads:
+        raise ValueError('No results files found in the upload.')
+    return uploads
+
+
+def pool_size():
+    """
+    :return:    number of processes of the pool of every web worker, so that all the pools of the host fit its cores
+    """
+    if constants.INGEST_PROCESSES:
+        return constants.INGEST_PROCESSES
+    try:
+        web_workers = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+    except ValueError:
+        web_workers = 1
+    return max(1, min(constants.INGEST_MAX_PROCESSES, (os.cpu_count() or 1) // web_workers))
+
+
+def _process_pool():
+    """
+    :return:    ProcessPoolExecutor shared by the requests of this process, created again after a fork
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            context = multiprocessing.get_context(constants.INGEST_START_METHOD)
+            _pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=context)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and _pool_pid == os.getpid():
+        # a broken pool has lost a worker, the others are stopped without waiting for the requests still using it
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _not_mergeable(filename):
+    return ValueError(f'{filename} holds aggregated statistics, it cannot be merged with other files.')
+
+
+def start_time(path, filename):
+    """
+    finds when the generator of a results file started, from the first rows of the file
+    :param path:        path of the saved file
+    :param filename:    name of the file in the upload
+    :raises ValueError: not load test samples
+    :return:            earliest timeStamp in epoch milliseconds, None without numeric timestamps
+    """
+    results_format = detect_format(path, filename)
+    if results_format == 'json':
+        contents = pd.read_json(path).head(constants.CLOCK_SKEW_PROBE_ROWS)
+    elif results_format == 'csv':
+        contents = pd.read_csv(path, nrows=constants.CLOCK_SKEW_PROBE_ROWS)
+    elif parsers.FORMATS[results_format].aggregated:
+        raise _not_mergeable(filename)
+    else:
+        chunks = parsers.FORMATS[results_format].parse(path, constants.CLOCK_SKEW_PROBE_ROWS)
+        contents = next(chunks, None)
+        chunks.close()
+    if not aggregation.is_jtl(contents):
+        raise ValueError(f'{filename} holds no load test samples.')
+    if 'timeStamp' not in contents.columns:
+        return None
+    start = pd.to_numeric(contents['timeStamp'], errors='coerce').min()
+    return None if pd.isna(start) else float(start)
+
+
+def clock_offsets(starts):
+    """
+    estimates the clock skew of every load generator
+    the generators of a distributed test start together, so a file starting apart from the median start is taken
+    as a skewed clock when the gap is over constants.CLOCK_SKEW_TOLERANCE and up to constants.CLOCK_SKEW_MAX,
+    larger gaps are kept as is, e.g. files of tests run one after the other
+    :param starts:  start time of every file in epoch milliseconds, None if unknown
+    :return:        list of the milliseconds to subtract from the timestamps of every file
+    """
+    known = [start for start in starts if start is not None]
+    if len(known) < 2:
+        return [0] * len(starts)
+    reference = np.median(known)
+    offsets = []
+    for start in starts:
+        skew = 0 if start is None else int(round(start - reference))
+        offsets.append(skew if constants.CLOCK_SKEW_TOLERANCE < abs(skew) <= constants.CLOCK_SKEW_MAX else 0)
+    return offsets
+
+
+def aggregate_file(path, filename, offset=0, seed=0):
+    """
+    folds one saved results file into running aggregates, run in a worker process by read_files
+    :param path:        path of the saved file
+    :param filename:    name of the file in the upload
+    :param offset:      milliseconds subtracted from the timestamps, the clock skew of its generator
+    :param seed:        seed of the sample rows, different for every file so their samples merge uniformly
+    :raises ValueError: not load test samples
+    :return:            ResultsAggregator
+    """
+    results_format = detect_format(path, filename)
+    if results_format == 'json':
+        contents = pd.read_json(path)
+        if not aggregation.is_jtl(contents):
+            raise ValueError(f'{filename} holds no load test samples.')
+        contents = schema.apply_schema(contents)
+        if offset and 'timeStamp' in contents.columns:
+            contents['timeStamp'] = contents['timeStamp'] - offset
+        return aggregation.ResultsAggregator(seed=seed).update(contents)
+    if results_format == 'csv':
+        aggregator, _ = _aggregate_csv(path, constants.CHUNK_SIZE, offset, seed)
+    elif parsers.FORMATS[results_format].aggregated:
+        raise _not_mergeable(filename)
+    else:
+        chunks = parsers.FORMATS[results_format].parse(path, constants.CHUNK_SIZE)
+        aggregator, _ = _fold_chunks(chunks, results_format, offset=offset, seed=seed)
+    if aggregator is None:
+        raise ValueError(f'{filename} holds no load test samples.')
+    return aggregator
+
+
+def read_files(uploads, align_clocks=False):
+    """
+    reads saved results files, several JMeter results are aggregated in parallel and merged into one summary
+    every file is parsed and folded by a worker of the process pool, after its timestamps are shifted by the clock
+    skew of its generator if asked, and the per-label aggregates, sketches and time series are merged as they are
+    exact
+    :param uploads:     list of (path, filename) tuples, as returned by save_uploads
+    :param align_clocks: shift the files of generators starting apart to the median start, see clock_offsets
+    :raises ValueError: several files that do not all hold load test samples
+    :return:            summary dict for JMeter results, listing the files, or a pandas DataFrame for a single
+                        other file
+    """
+    if len(uploads) == 1:
+        return read_upload(*uploads[0])
+    paths, filenames = zip(*uploads)
+    pool = _process_pool()
+    try:
+        if align_clocks:
+            with metrics.timed('parse', 'probe'):
+                starts = list(pool.map(start_time, paths, filenames))
+            offsets = clock_offsets(starts)
+        else:
+            offsets = [0] * len(uploads)
+        with metrics.timed('parse', 'files'):
+            aggregators = list(pool.map(aggregate_file, paths, filenames, offsets, range(len(uploads))))
+    except BrokenProcessPool:
+        # A worker died, e.g. killed out of memory, the next upload starts a new pool
+        _reset_pool()
+        raise
+
+    files = []
+    for filename, aggregator, offset in zip(filenames, aggregators, offsets):
+        samples = int(aggregator.labels['count'].sum()) if aggregator.labels is not None else 0
+        files.append({'file': filename, 'samples': samples, 'clock_offset': offset / 1000})
+    with metrics.timed('aggregate'):
+        aggregator = aggregators[0]
+        for other in aggregators[1:]:
+            aggregator.merge(other)
+        if aggregator.labels is None or not len(aggregator.labels):
+            raise ValueError('No data found in the uploaded files.')
+        summary = aggregator.summary()
+    summary['files'] = files
+    return summary
+
+
+def read_uploads(files, align_clocks=False):
+    """
+    reads the files of an upload request, a single results file is streamed as is while several files and zip
+    archives are saved to a temporary directory and read by read_files
+    :param files:   uploaded file objects
+    :param align_clocks: shift the files of generators starting apart to the median start, see clock_offsets
+    :return:        summary dict for JMeter results, else a pandas DataFrame
+    """
+    if len(files) == 1 and not files[0].filename.lower().endswith('.zip'):
+        return read_upload(files[0])
+    with tempfile.TemporaryDirectory() as directory:
+        return read_files(save_uploads(files, directory), align_clocks)
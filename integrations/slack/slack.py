@@ -1,19 +1,50 @@
+import logging
+import queue
+import threading
+import time
+
 import requests
 import json
 import datetime
+from requests.adapters import HTTPAdapter
 
-def send_slack_notifications(msg, webhook, title, filename):
+import metrics
+
+SLACK_WEBHOOK_URL = 'https://hooks.slack.com/services/{webhook}'
+# Seconds to wait for Slack before giving up on an attempt
+SLACK_TIMEOUT = 10
+SLACK_MAX_RETRIES = 4
+SLACK_BACKOFF = 1
+# Notifications waiting to be delivered, further ones are dropped
+SLACK_QUEUE_SIZE = 1000
+# Slack rejects section blocks longer than this
+SLACK_SECTION_LIMIT = 3000
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+
+def build_blocks(sections, filename):
+    """
+    builds the Slack blocks for an upload, one header and section per analysis result
+    :param sections:    dict of the results title and the message
+    :param filename:    uploaded filename
+    :return:            list of Slack blocks
+    """
     emoji = False
 
     blocks = [
-            {
-                "type": "header",
-                "text": {
-                    "type": "plain_text",
-                    "text": f"PerfGPT analysis for {filename} at {datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC",
-                    "emoji": emoji
-                }
-            },
+        {
+            "type": "header",
+            "text": {
+                "type": "plain_text",
+                "text": f"PerfGPT analysis for {filename} at {datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC",
+                "emoji": emoji
+            }
+        }
+    ]
+    for title, msg in sections.items():
+        blocks += [
             {
                 "type": "header",
                 "text": {
@@ -26,14 +57,88 @@ def send_slack_notifications(msg, webhook, title, filename):
                 "type": "section",
                 "text": {
                     "type": "plain_text",
-                    "text": f"{msg}",
+                    "text": f"{msg}"[:SLACK_SECTION_LIMIT],
                     "emoji": emoji
                 }
             }
         ]
+    return blocks
+
 
+def post_blocks(webhook, blocks):
+    """
+    posts the blocks to the webhook, retrying with exponential backoff
+    :param webhook:     Slack webhook path
+    :param blocks:      list of Slack blocks
+    :return:            True if delivered, else False
+    """
     data = {
         'blocks': json.dumps(blocks)
     }
 
-    requests.post(f'https://hooks.slack.com/services/{webhook}', json=data)
+    for attempt in range(SLACK_MAX_RETRIES + 1):
+        delay = SLACK_BACKOFF * 2 ** attempt
+        try:
+            with metrics.timed('slack', 'post'):
+                response = session.post(SLACK_WEBHOOK_URL.format(webhook=webhook), json=data, timeout=SLACK_TIMEOUT)
+            if response.status_code < 400:
+                return True
+            if response.status_code != 429 and response.status_code < 500:
+                logging.error(f"Slack rejected the notification: {response.status_code} {response.text}")
+                return False
+            delay = float(response.headers.get('Retry-After', delay))
+        except requests.RequestException as e:
+            logging.error(f"Slack notification attempt {attempt + 1} failed: {e}")
+        if attempt < SLACK_MAX_RETRIES:
+            time.sleep(delay)
+    return False
+
+
+class SlackNotifier:
+    """
+    Delivers Slack notifications from a background worker so the analysis request never waits for Slack.
+    """
+
+    def __init__(self, maxsize=SLACK_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='slack-notifier', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            webhook, blocks = self.queue.get()
+            try:
+                post_blocks(webhook, blocks)
+            except Exception as e:
+                logging.error(f"Slack notification failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def enqueue(self, webhook, sections, filename):
+        """
+        queues one notification holding all the results of an upload
+        :param webhook:     Slack webhook path
+        :param sections:    dict of the results title and the message
+        :param filename:    uploaded filename
+        :return:            True if queued, False if the queue is full
+        """
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait((webhook, build_blocks(sections, filename)))
+            return True
+        except queue.Full:
+            logging.error("Slack notification queue is full, dropping the notification.")
+            return False
+
+
+notifier = SlackNotifier()
+
+
+def send_slack_notifications(msg, webhook, title, filename):
+    post_blocks(webhook, build_blocks({title: msg}, filename))
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sentry_sdk import capture_exception
+
+import constants
+from cache import DiskCache
+
+
+class JobError(Exception):
+    """Raised by a job function with a message that can be shown to the user."""
+
+
+class JobRunner:
+    """
+    Runs analysis jobs on a worker pool sized independently from the web workers.
+    Job records are kept as JSON files, so any web worker on the host can answer a status poll.
+    The owner process refreshes the heartbeat of its unfinished jobs, a job whose owner exited, stopped beating
+    or ran past the timeout is failed on the next status poll.
+    """
+
+    def __init__(self, max_workers=constants.ANALYSIS_WORKERS, directory=constants.JOBS_DIR, ttl=constants.JOBS_TTL,
+                 on_abandoned=None, heartbeat_interval=constants.JOBS_HEARTBEAT_INTERVAL,
+                 stale_after=constants.JOBS_STALE_AFTER, timeout=constants.JOBS_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis')
+        self.store = DiskCache(directory, ttl)
+        self.on_abandoned = on_abandoned
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.active = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def submit(self, username, func, *args, credit=False, **kwargs):
+        """
+        queues a job
+        :param username:    owner of the job
+        :param func:        job function, its return value must be JSON serializable
+        :param credit:      an upload credit was reserved for the job, passed to on_abandoned if the job is abandoned
+        :return:            job id
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.store.set(job_id, {'id': job_id, 'username': username, 'status': 'queued', 'credit': credit,
+                                'pid': os.getpid(), 'created': now, 'heartbeat': now, 'result': None, 'error': None})
+        with self._lock:
+            self.active.add(job_id)
+        self._start_heartbeat()
+        self.executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def get(self, job_id):
+        """
+        :param job_id:  job id
+        :return:        job record, or None if unknown or expired
+        """
+        job = self.store.get(job_id)
+        if job is not None and job['status'] in ('queued', 'running') and self._is_stale(job):
+            job = self._abandon(job)
+        return job
+
+    def _is_stale(self, job):
+        """
+        :param job: unfinished job record
+        :return:    True if the job will never finish
+        """
+        now = time.time()
+        if job.get('heartbeat', job['created']) + self.stale_after < now:
+            return True
+        if job.get('started', job['created']) + self.timeout < now:
+            return True
+        return job.get('pid') is not None and not _pid_alive(job['pid'])
+
+    def _abandon(self, job):
+        """
+        fails a stale job, the first process to get here calls on_abandoned
+        :param job: stale job record
+        :return:    failed job record
+        """
+        try:
+            os.close(os.open(self._marker(job['id']), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return self.store.get(job['id']) or job
+        logging.error(f"Analysis job {job['id']} of process {job.get('pid')} was abandoned in {job['status']} state")
+        job.update(status='failed', abandoned=True, finished=time.time(),
+                   error="The analysis was interrupted. Please try again, your upload credit was not used.")
+        self.store.set(job['id'], job)
+        if self.on_abandoned is not None:
+            try:
+                self.on_abandoned(job)
+            except Exception as e:
+                capture_exception(e)
+        return job
+
+    def _marker(self, job_id):
+        return os.path.join(self.store.directory, f'{job_id}.abandoned')
+
+    def _update(self, job_id, **fields):
+        """
+        :return:    False if the job was abandoned meanwhile, its record is left as is
+        """
+        with self._lock:
+            job = self.store.get(job_id) or {'id': job_id}
+            if job.get('abandoned') or os.path.exists(self._marker(job_id)):
+                return False
+            job.update(fields)
+            self.store.set(job_id, job)
+            return True
+
+    def _start_heartbeat(self):
+        # started on the first submit, so a preloading gunicorn master does not fork it away
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._heartbeat = threading.Thread(target=self._beat, name='analysis-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                active = list(self.active)
+            for job_id in active:
+                try:
+                    self._update(job_id, heartbeat=time.time())
+                except Exception as e:
+                    capture_exception(e)
+
+    def _run(self, job_id, func, args, kwargs):
+        try:
+            if not self._update(job_id, status='running', started=time.time(), heartbeat=time.time()):
+                return
+            try:
+                result = func(*args, **kwargs)
+                self._update(job_id, status='done', result=result, finished=time.time())
+            except JobError as e:
+                self._update(job_id, status='failed', error=str(e), finished=time.time())
+            except Exception as e:
+                logging.error(f"Analysis job {job_id} failed: {e}")
+                capture_exception(e)
+                self._update(job_id, status='failed', error=str(e), finished=time.time())
+        finally:
+            with self._lock:
+                self.active.discard(job_id)
+
+
+def _pid_alive(pid):
+    """
+    :param pid: process id on this host
+    :return:    False if no such process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
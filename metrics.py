@@ -0,0 +1,448 @@
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import sentry_sdk
+
+import constants
+
+
+def _escape(value):
+    return f"{value}".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else f"{value}"
+
+
+class Counter:
+    """
+    Monotonic counter with labels, exported in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _start_flusher()
+
+    def snapshot(self):
+        """
+        :return:    JSON serializable values of this process
+        """
+        with self._lock:
+            return self.dump(self._values)
+
+    def dump(self, values):
+        """
+        :param values:  values by label
+        :return:        JSON serializable values
+        """
+        return [[list(key), value] for key, value in values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def merge(self, values, snapshot):
+        """
+        adds the values of a snapshot of another process
+        :param values:      values by label, as collected
+        :param snapshot:    list returned by snapshot
+        :return:            values
+        """
+        for key, value in snapshot:
+            values[tuple(key)] = values.get(tuple(key), 0) + value
+        return values
+
+    def collect(self, snapshots=()):
+        """
+        :param snapshots:   snapshots of other processes added to the values of this one
+        :return:            lines of the Prometheus text format
+        """
+        values = self.merge({}, self.snapshot())
+        for snapshot in snapshots:
+            self.merge(values, snapshot)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels_text(self.labelnames, key)} {_format_number(value)}')
+        return lines
+
+
+class Histogram:
+    """
+    Histogram with cumulative buckets and labels, exported in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=constants.METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per label values: count of every bucket (not cumulative), sum and count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+        _start_flusher()
+
+    def snapshot(self):
+        """
+        :return:    JSON serializable values of this process
+        """
+        with self._lock:
+            return self.dump(self._values)
+
+    def dump(self, values):
+        """
+        :param values:  values by label
+        :return:        JSON serializable values
+        """
+        return [[list(key), list(counts), total, count] for key, (counts, total, count) in values.items()]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def merge(self, values, snapshot):
+        """
+        adds the values of a snapshot of another process
+        :param values:      values by label, as collected
+        :param snapshot:    list returned by snapshot
+        :return:            values
+        """
+        for key, counts, total, count in snapshot:
+            merged_counts, merged_total, merged_count = values.get(tuple(key)) or ([0] * len(self.buckets), 0.0, 0)
+            values[tuple(key)] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total,
+                                  merged_count + count)
+        return values
+
+    def collect(self, snapshots=()):
+        """
+        :param snapshots:   snapshots of other processes added to the values of this one
+        :return:            lines of the Prometheus text format
+        """
+        values = self.merge({}, self.snapshot())
+        for snapshot in snapshots:
+            self.merge(values, snapshot)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _labels_text(self.labelnames, key, [('le', _format_number(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels_text(self.labelnames, key)} {_format_number(total)}')
+            lines.append(f'{self.name}_count{_labels_text(self.labelnames, key)} {count}')
+        return lines
+
+
+stage_seconds = Histogram('perfgpt_stage_duration_seconds',
+                          'Time spent in each stage of serving a request.', ['stage', 'operation'])
+stage_errors = Counter('perfgpt_stage_errors_total',
+                       'Stages that raised an exception.', ['stage', 'operation'])
+openai_tokens = Counter('perfgpt_openai_tokens_total',
+                        'Tokens sent to and received from OpenAI.', ['model', 'kind'])
+request_seconds = Histogram('perfgpt_request_duration_seconds',
+                            'Time to the response of each request, by endpoint and status.', ['endpoint', 'status'])
+
+registry = [stage_seconds, stage_errors, openai_tokens, request_seconds]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Several worker processes: every process writes its values to METRICS_DIR, and a scrape served by any of them
+# adds up the values of the live workers and of the retired ones
+ARCHIVE_FILE = 'archive.json'
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def metrics_directory():
+    """
+    :return:    directory shared by the worker processes, None when every process exports only its own values
+    """
+    return os.getenv('METRICS_DIR') or None
+
+
+def _snapshot():
+    return {metric.name: metric.snapshot() for metric in registry}
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def flush():
+    """
+    writes the values of this process to the shared directory
+    :return:    None
+    """
+    directory = metrics_directory()
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        _write_json(os.path.join(directory, f'{os.getpid()}.json'), _snapshot())
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(constants.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logging.error(f"Could not write the metrics of process {os.getpid()}: {e}")
+
+
+def _start_flusher():
+    # One writer thread per process, started again in a forked worker
+    global _flusher_pid
+    if _flusher_pid == os.getpid() or metrics_directory() is None:
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+
+
+def retire_process(pid):
+    """
+    adds the last values of an exited worker to the archive, called by the gunicorn master only
+    :param pid: process id of the worker
+    :return:    None
+    """
+    directory = metrics_directory()
+    if directory is None:
+        return
+    path = os.path.join(directory, f'{pid}.json')
+    snapshot = _read_json(path)
+    if snapshot:
+        archive = _read_json(os.path.join(directory, ARCHIVE_FILE))
+        for metric in registry:
+            values = {}
+            for part in [archive.get(metric.name, []), snapshot.get(metric.name, [])]:
+                metric.merge(values, part)
+            archive[metric.name] = metric.dump(values)
+        _write_json(os.path.join(directory, ARCHIVE_FILE), archive)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def reset():
+    """
+    forgets the values inherited from the gunicorn master, called in a worker right after the fork
+    :return:    None
+    """
+    for metric in registry:
+        metric.reset()
+
+
+atexit.register(lambda: metrics_directory() is not None and flush())
+
+
+def clear_directory():
+    """
+    removes the values of a previous run, called by the gunicorn master before starting the workers
+    :return:    None
+    """
+    directory = metrics_directory()
+    if directory is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, name))
+
+
+def _other_snapshots():
+    directory = metrics_directory()
+    if directory is None or not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        if name == ARCHIVE_FILE:
+            snapshots.append(_read_json(os.path.join(directory, name)))
+            continue
+        pid = name[:-len('.json')]
+        # The values of this process are read live, those of an exited worker not yet retired are skipped
+        if name.endswith('.json') and pid.isdigit() and int(pid) != os.getpid() and _is_alive(int(pid)):
+            snapshots.append(_read_json(os.path.join(directory, name)))
+    return snapshots
+
+
+def render():
+    """
+    :return:    every metric in the Prometheus text format, added up over the worker processes sharing METRICS_DIR
+    """
+    snapshots = _other_snapshots()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect([snapshot.get(metric.name, []) for snapshot in snapshots]))
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timed(stage, operation=''):
+    """
+    times a stage into the stage histogram, inside a Sentry span of the same name
+    :param stage:       stage name, e.g. parse or openai
+    :param operation:   what the stage worked on, e.g. the DynamoDB operation
+    :return:            context manager
+    """
+    started = time.perf_counter()
+    with sentry_sdk.start_span(op=stage, description=operation or None):
+        try:
+            yield
+        except Exception:
+            stage_errors.inc(stage=stage, operation=operation)
+            raise
+        finally:
+            stage_seconds.observe(time.perf_counter() - started, stage=stage, operation=operation)
+
+
+def record_openai_usage(prompt_tokens, completion_tokens, model=constants.openai_model):
+    """
+    counts the tokens of an OpenAI call
+    :param prompt_tokens:       tokens sent
+    :param completion_tokens:   tokens received
+    :param model:               OpenAI model
+    :return:                    None
+    """
+    openai_tokens.inc(prompt_tokens, model=model, kind='prompt')
+    openai_tokens.inc(completion_tokens, model=model, kind='completion')
+
+
+def _before_aws_call(context, **kwargs):
+    context['metrics_started'] = time.perf_counter()
+
+
+def _after_aws_call(context, event_name, http_response=None, parsed=None, **kwargs):
+    # Events are named like after-call.dynamodb.GetItem, the error event carries no operation model
+    operation = event_name.rsplit('.', 1)[-1]
+    started = context.pop('metrics_started', None)
+    if started is not None:
+        stage_seconds.observe(time.perf_counter() - started, stage='dynamodb', operation=operation)
+    # Errors answered by DynamoDB, e.g. a failed condition, throttling or an expired token, come back as responses
+    status = getattr(http_response, 'status_code', None)
+    if (status is not None and status >= 400) or (isinstance(parsed, dict) and parsed.get('Error')):
+        stage_errors.inc(stage='dynamodb', operation=operation)
+
+
+def _after_aws_call_error(context, event_name, **kwargs):
+    # Transport errors, raised before any response
+    stage_errors.inc(stage='dynamodb', operation=event_name.rsplit('.', 1)[-1])
+    _after_aws_call(context, event_name)
+
+
+def instrument_dynamodb(client):
+    """
+    times every API call made by a DynamoDB client, by operation
+    :param client:  boto3 DynamoDB client, e.g. resource.meta.client
+    :return:        None
+    """
+    client.meta.events.register('before-call.dynamodb.*', _before_aws_call)
+    client.meta.events.register('after-call.dynamodb.*', _after_aws_call)
+    client.meta.events.register('after-call-error.dynamodb.*', _after_aws_call_error)
+
+
+class TracesSampler:
+    """
+    Sentry traces sampler: a configurable base rate, per path overrides, and an adaptive cap on the traces
+    sent per minute so busy periods do not pay for tracing every request.
+    """
+
+    def __init__(self, rate=constants.SENTRY_TRACES_SAMPLE_RATE, path_rates=constants.SENTRY_TRACES_PATH_RATES,
+                 traces_per_minute=constants.SENTRY_TRACES_PER_MINUTE):
+        self.rate = rate
+        self.path_rates = path_rates
+        self.traces_per_minute = traces_per_minute
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._previous_requests = 0
+        self._lock = threading.Lock()
+
+    def _traffic(self):
+        # Requests seen in the last full minute, or so far in this one if busier
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 60:
+                self._previous_requests = self._window_requests if now - self._window_start < 120 else 0
+                self._window_start, self._window_requests = now, 0
+            self._window_requests += 1
+            return max(self._previous_requests, self._window_requests)
+
+    def sample_rate(self, path):
+        """
+        :param path:    request path
+        :return:        probability of tracing a request to the path
+        """
+        rate = self.rate
+        for prefix, path_rate in self.path_rates.items():
+            if path.startswith(prefix):
+                rate = path_rate
+                break
+        if rate <= 0:
+            return 0.0
+        traffic = self._traffic()
+        if self.traces_per_minute and traffic * rate > self.traces_per_minute:
+            rate = self.traces_per_minute / traffic
+        return rate
+
+    def __call__(self, sampling_context):
+        # Follow the decision of an upstream service
+        if sampling_context.get('parent_sampled') is not None:
+            return float(sampling_context['parent_sampled'])
+        environ = sampling_context.get('wsgi_environ') or {}
+        return self.sample_rate(environ.get('PATH_INFO', ''))
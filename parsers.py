@@ -0,0 +1,298 @@
+"""
+Results formats of other load testing tools, sniffed from the first bytes of an upload.
+
+Every format registers a parser that streams the file line by line and yields pandas DataFrames of samples in the
+columns of a JMeter result (aggregation.SAMPLE_COLUMNS), so they are folded by the same ResultsAggregator:
+timeStamp in epoch milliseconds at the start of the request, elapsed in milliseconds, label, responseCode,
+success, failureMessage and allThreads. Formats holding statistics that are already aggregated return a summary
+dict instead. JMeter CSV/JTL and JSON documents are read by ingest.py when no registered format matches.
+"""
+import csv
+import io
+import json
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import constants
+import schema
+
+Format = namedtuple('Format', ['name', 'sniff', 'parse', 'aggregated'])
+
+# Registered formats, sniffed in registration order
+FORMATS = {}
+
+# Record types of a Gatling simulation.log
+GATLING_RECORDS = {'RUN', 'USER', 'REQUEST', 'GROUP', 'ERROR', 'ASSERTION'}
+# Fields read per simulation.log line, enough for the layouts of every Gatling 3 release writing a text log
+GATLING_FIELDS = 9
+# k6 metrics kept from its JSON output, a request sample is written once per metric of the request
+K6_DURATION = 'http_req_duration'
+K6_VUS = 'vus'
+# Columns of a Locust --csv stats file, the percentiles are in per cent
+LOCUST_COLUMNS = {'Type', 'Name', 'Request Count', 'Failure Count'}
+
+
+def register(name, sniff, aggregated=False):
+    """
+    registers the parser of a results format
+    :param name:        format name
+    :param sniff:       function(head, filename) telling whether a file starting with the head text is in the format
+    :param aggregated:  the parser returns a summary dict of aggregated statistics rather than sample chunks
+    :return:            decorator of the parser, function(file, chunksize)
+    """
+    def decorator(parse):
+        FORMATS[name] = Format(name, sniff, parse, aggregated)
+        return parse
+
+    return decorator
+
+
+def detect(head, filename):
+    """
+    :param head:        first bytes of the file, decoded
+    :param filename:    uploaded filename
+    :return:            name of the first registered format matching, or None
+    """
+    for results_format in FORMATS.values():
+        if results_format.sniff(head, filename):
+            return results_format.name
+    return None
+
+
+def _first_lines(head, count=2):
+    lines = head.splitlines()
+    if len(head) >= constants.SNIFF_BYTES:
+        # The last line of a head cut from a longer file may be incomplete
+        lines = lines[:-1]
+    return [line for line in lines if line.strip()][:count]
+
+
+def _json_object(line):
+    try:
+        value = json.loads(line)
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+@contextmanager
+def _text_lines(file):
+    """
+    :param file:    uploaded file object, or path of a saved upload
+    :return:        context manager of a text stream iterating over the lines of the file
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, encoding='utf-8', errors='replace', newline='') as text:
+            yield text
+        return
+    text = io.TextIOWrapper(getattr(file, 'stream', file), encoding='utf-8', errors='replace', newline='')
+    try:
+        yield text
+    finally:
+        # Leaves the upload open for the caller
+        text.detach()
+
+
+def _is_gatling(head, filename):
+    lines = _first_lines(head, 1)
+    return bool(lines) and '\t' in lines[0] and lines[0].split('\t', 1)[0] in GATLING_RECORDS
+
+
+@register('gatling', _is_gatling)
+def parse_gatling(file, chunksize):
+    """
+    streams the text simulation.log of Gatling 3
+    request records become samples, user start and end records give the active users of every request
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of lines parsed at a time
+    :return:            generator of pandas DataFrames of samples
+    """
+    reader = pd.read_csv(file, sep='\t', header=None, names=range(GATLING_FIELDS), dtype=str, keep_default_na=False,
+                         quoting=csv.QUOTE_NONE, on_bad_lines='skip', chunksize=chunksize)
+    active_users = 0
+    for chunk in reader:
+        kind = chunk[0].to_numpy()
+        # Gatling 3.4 and later log "USER scenario START", earlier releases put the user id before START
+        event = np.where(chunk[2].isin(['START', 'END']), chunk[2], chunk[3])
+        started = (kind == 'USER') & (event == 'START')
+        ended = (kind == 'USER') & (event == 'END')
+        users = active_users + np.cumsum(started.astype(np.int64) - ended)
+        active_users = int(users[-1])
+
+        requests = chunk[kind == 'REQUEST']
+        threads = users[kind == 'REQUEST']
+        # The status follows the name, start and end, at field 5 since Gatling 3.4 and later before
+        parts = []
+        unmatched = np.ones(len(requests), dtype=bool)
+        for position in range(5, GATLING_FIELDS - 1):
+            matched = unmatched & requests[position].isin(['OK', 'KO']).to_numpy()
+            unmatched &= ~matched
+            if matched.any():
+                rows = requests[matched]
+                parts.append(pd.DataFrame({'label': rows[position - 3], 'start': rows[position - 2],
+                                           'end': rows[position - 1], 'status': rows[position],
+                                           'message': rows[position + 1], 'allThreads': threads[matched]},
+                                          index=rows.index))
+        if not parts:
+            continue
+        records = pd.concat(parts).sort_index()
+        start = pd.to_numeric(records['start'], errors='coerce')
+        end = pd.to_numeric(records['end'], errors='coerce')
+        valid = (start.notna() & end.notna()).to_numpy()
+        records, start, end = records[valid], start[valid], end[valid]
+        success = (records['status'] == 'OK').to_numpy()
+        yield pd.DataFrame({
+            'timeStamp': start.astype('int64').to_numpy(),
+            'elapsed': (end - start).astype('int32').to_numpy(),
+            'label': pd.Categorical(records['label']),
+            'success': success,
+            'failureMessage': pd.Categorical(np.where(success, '', records['message'])),
+            'allThreads': records['allThreads'].astype('int32').to_numpy(),
+        })
+
+
+def _is_k6(head, filename):
+    first = _first_lines(head, 1)
+    record = _json_object(first[0]) if first else None
+    return record is not None and record.get('type') in ('Metric', 'Point') and 'metric' in record
+
+
+@register('k6', _is_k6)
+def parse_k6(file, chunksize):
+    """
+    streams the NDJSON written by k6 run --out json
+    lines are filtered as text before decoding, so only the request durations and the virtual user counts are parsed
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of lines read at a time
+    :return:            generator of pandas DataFrames of samples
+    """
+    duration_key, vus_key = f'"{K6_DURATION}"', f'"{K6_VUS}"'
+    vus = np.nan
+    with _text_lines(file) as lines:
+        while True:
+            batch = list(islice(lines, chunksize))
+            if not batch:
+                break
+            points = [json.loads(line) for line in batch
+                      if '"Point"' in line and (duration_key in line or vus_key in line)]
+            points = [point for point in points if point.get('type') == 'Point'
+                      and point.get('metric') in (K6_DURATION, K6_VUS)]
+            if not points:
+                continue
+            is_vus = np.array([point['metric'] == K6_VUS for point in points])
+            values = np.array([point['data'].get('value', np.nan) for point in points], dtype=float)
+            # Virtual users are sampled every second, each request gets the last count written before it
+            threads = pd.Series(np.where(is_vus, values, np.nan)).ffill().fillna(vus).to_numpy()
+            vus = threads[-1]
+
+            requests = [point['data'] for point, flag in zip(points, is_vus) if not flag]
+            if not requests:
+                continue
+            tags = [data.get('tags') or {} for data in requests]
+            elapsed = values[~is_vus]
+            ended = pd.to_datetime(pd.Series([data.get('time') for data in requests]), utc=True, errors='coerce')
+            # k6 stamps a request sample when the request ends
+            timestamps = ((ended - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(milliseconds=1) - elapsed).round()
+            status = pd.to_numeric(pd.Series([tag.get('status') for tag in tags]), errors='coerce')
+            expected = pd.Series([tag.get('expected_response') for tag in tags], dtype=object)
+            success = np.where(expected.notna(), expected.astype(str) == 'true', (status > 0) & (status < 400))
+            yield pd.DataFrame({
+                'timeStamp': timestamps.astype('int64') if timestamps.notna().all() else timestamps,
+                'elapsed': elapsed,
+                'label': pd.Categorical([tag.get('name') or tag.get('url') or '' for tag in tags]),
+                'responseCode': pd.Categorical([str(tag.get('status', '')) for tag in tags]),
+                'success': success.astype(bool),
+                'failureMessage': pd.Categorical([tag.get('error', '') for tag in tags]),
+                'allThreads': threads[~is_vus],
+            })
+
+
+def _is_locust(head, filename):
+    lines = _first_lines(head, 1)
+    return bool(lines) and LOCUST_COLUMNS.issubset(next(csv.reader([lines[0]])))
+
+
+@register('locust', _is_locust, aggregated=True)
+def parse_locust(file, chunksize=None):
+    """
+    reads the per-request statistics of locust --csv (the _stats.csv file), one row per request and an
+    Aggregated row for the whole test
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   unused, the file holds one row per request name
+    :return:            summary dict like ResultsAggregator.summary, without samples, time series or sketches
+    """
+    stats = pd.read_csv(file)
+    names = stats['Name'].astype(str)
+    types = stats['Type'].fillna('').astype(str)
+    aggregated = names.eq('Aggregated') & types.eq('')
+    labels = (types + ' ' + names).str.strip()
+
+    def numbers(column):
+        if column not in stats.columns:
+            return pd.Series(np.nan, index=stats.index)
+        return pd.to_numeric(stats[column], errors='coerce')
+
+    table = pd.DataFrame({'count': numbers('Request Count'), 'errors': numbers('Failure Count'),
+                          'throughput': numbers('Requests/s'), 'elapsed_min': numbers('Min Response Time'),
+                          'elapsed_max': numbers('Max Response Time'),
+                          'elapsed_mean': numbers('Average Response Time')})
+    for q in aggregation.PERCENTILES:
+        table[f'elapsed_{aggregation.percentile_name(q)}'] = numbers(f'{q * 100:g}%')
+    table['bytes'] = (numbers('Average Content Size') * table['count']).round()
+    table['error_rate'] = table['errors'] / table['count'] * 100
+    table.index = pd.Index(labels, name='label')
+
+    per_label = table[~aggregated.to_numpy()].copy()
+    for column in ['count', 'errors', 'bytes']:
+        per_label[column] = per_label[column].fillna(0).astype('int64')
+    per_label = aggregation.order_columns(per_label, ['elapsed']).sort_index()
+    if aggregated.any():
+        totals = table[aggregated.to_numpy()].iloc[0]
+    else:
+        totals = per_label.sum(numeric_only=True)
+        totals['elapsed_mean'] = (per_label['elapsed_mean'] * per_label['count']).sum() / totals['count']
+        totals['elapsed_min'], totals['elapsed_max'] = per_label['elapsed_min'].min(), per_label['elapsed_max'].max()
+        totals = totals.drop([f'elapsed_{aggregation.percentile_name(q)}' for q in aggregation.PERCENTILES])
+
+    samples, errors = int(totals['count']), int(totals['errors'])
+    throughput = totals['throughput'] if pd.notna(totals['throughput']) and totals['throughput'] > 0 else None
+    overall = {'samples': samples, 'errors': errors, 'labels': int(len(per_label)),
+               'error_rate': errors / samples * 100 if samples else 0.0,
+               'duration': samples / throughput if throughput else None, 'throughput': throughput}
+    overall.update({column: totals[column] for column in totals.index
+                    if column.startswith('elapsed_') and pd.notna(totals[column])})
+    if pd.notna(totals.get('bytes')):
+        overall['bytes'] = int(totals['bytes'])
+    return {'overall': overall, 'response_codes': {}, 'per_label': per_label, 'samples': None, 'timeseries': None,
+            'sketches': {}}
+
+
+def _is_ndjson(head, filename):
+    lines = _first_lines(head)
+    return bool(lines) and all(_json_object(line) is not None for line in lines)
+
+
+@register('ndjson', _is_ndjson)
+def parse_ndjson(file, chunksize):
+    """
+    streams newline-delimited JSON records, e.g. JMeter samples exported one object per line
+    :param file:        uploaded file object, or path of a saved upload
+    :param chunksize:   number of lines parsed at a time
+    :return:            generator of pandas DataFrames, converted to the compact JTL dtypes for JMeter samples
+    """
+    with _text_lines(file) as lines:
+        while True:
+            batch = ''.join(islice(lines, chunksize))
+            if not batch:
+                break
+            if not batch.strip():
+                continue
+            # Epoch milliseconds in a timeStamp column are kept as numbers, not converted to dates
+            chunk = pd.read_json(io.StringIO(batch), lines=True, convert_dates=False, keep_default_dates=False)
+            yield schema.apply_schema(chunk) if aggregation.is_jtl(chunk) else chunk
@@ -0,0 +1,167 @@
+import aggregation
+import comparison
+import constants
+import timeseries
+import tokenizer
+
+# Tokens of the chat message framing that are not part of the message contents
+MESSAGE_OVERHEAD = 12
+
+
+def input_token_budget(system_prompts=()):
+    """
+    tokens the uploaded data may take in the prompt
+    :param system_prompts:  system prompts the input is sent with, the longest one is reserved
+    :return:                number of tokens
+    """
+    system_tokens = max([tokenizer.count_tokens(prompt) for prompt in system_prompts] or [0])
+    room = constants.CONTEXT_WINDOW - constants.MIN_COMPLETION_TOKENS - system_tokens - MESSAGE_OVERHEAD
+    return min(constants.PROMPT_TOKEN_BUDGET, room)
+
+
+def completion_token_limit(messages):
+    """
+    picks max_tokens from the room left in the context window by the messages
+    :param messages:    chat messages sent to OpenAI
+    :return:            max_tokens for the completion
+    """
+    room = constants.CONTEXT_WINDOW - tokenizer.count_message_tokens(messages)
+    return max(1, min(constants.max_tokens, room))
+
+
+def _largest_fitting(render, upper, budget):
+    """
+    binary searches the largest n in [0, upper] whose rendering fits the budget
+    :param render:  function returning the text for n
+    :param upper:   largest n to try
+    :param budget:  number of tokens
+    :return:        tuple of n and its text, n is -1 if even 0 does not fit
+    """
+    best, best_text = -1, None
+    low, high = 0, upper
+    while low <= high:
+        middle = (low + high) // 2
+        text = render(middle)
+        if tokenizer.count_tokens(text) <= budget:
+            best, best_text = middle, text
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best, best_text
+
+
+def _rows_text(title, rows):
+    return f'{title}\n' + rows.to_csv(index=False, float_format='%.2f').strip()
+
+
+def _fit_summary(summary, budget):
+    """
+    renders the aggregates, keeping only the labels with the most samples if the table does not fit
+    :param summary: dict returned by summarize_results or ResultsAggregator.summary
+    :param budget:  number of tokens
+    :return:        summary text
+    """
+    text = aggregation.format_summary(summary)
+    if tokenizer.count_tokens(text) <= budget:
+        return text
+
+    per_label = summary['per_label'].sort_values('count', ascending=False)
+
+    def render(labels):
+        note = f'(showing the {labels} of {len(per_label)} labels with the most samples)'
+        return aggregation.format_summary({**summary, 'per_label': per_label.head(labels)}) + f'\n{note}'
+
+    labels, text = _largest_fitting(render, len(per_label), budget)
+    return text if labels >= 0 else render(0)
+
+
+def _fit_series(aggregator, budget):
+    """
+    renders the series over time with as many LTTB points as fit in the budget
+    :param aggregator:  TimeSeriesAggregator of the summary, or None
+    :param budget:      number of tokens
+    :return:            series text, or None if not even the first and last windows fit
+    """
+    if aggregator is None or budget <= 0:
+        return None
+    points, text = _largest_fitting(lambda n: timeseries.format_series(aggregator, n),
+                                    constants.TIMESERIES_PROMPT_POINTS, budget)
+    return text if points >= 2 else None
+
+
+def _fit_samples(samples, budget):
+    """
+    renders as many stratified sample rows per label as fit in the budget
+    :param samples: rows from aggregation.sample_rows
+    :param budget:  number of tokens
+    :return:        sample text, or None if no row fits
+    """
+    if samples is None or samples.empty or budget <= 0:
+        return None
+    grouped = samples.groupby('label', sort=False, observed=True)
+    columns = [column for column in samples.columns if column != aggregation.SAMPLE_KEY]
+
+    def render(rows_per_label):
+        rows = grouped.head(rows_per_label)
+        if 'timeStamp' in rows.columns:
+            rows = rows.sort_values('timeStamp', kind='stable')
+        return _rows_text(f'Random sample of up to {rows_per_label} rows per label:', rows[columns])
+
+    rows_per_label, text = _largest_fitting(render, int(grouped.size().max()), budget)
+    return text if rows_per_label > 0 else None
+
+
+def build_comparison_input(diff, system_prompts=()):
+    """
+    builds the user message for the comparison against a baseline run within the token budget
+    :param diff:            DataFrame returned by comparison.compare_runs
+    :param system_prompts:  system prompts the input is sent with
+    :return:                prompt input text, the most severe changes are kept if not all of them fit
+    """
+    budget = input_token_budget(system_prompts)
+    text = comparison.format_comparison(diff)
+    if tokenizer.count_tokens(text) <= budget:
+        return text
+    labels, text = _largest_fitting(lambda n: comparison.format_comparison(diff, n), len(diff), budget)
+    return text if labels >= 0 else comparison.format_comparison(diff, 0)
+
+
+def build_prompt_input(contents, system_prompts=(), summary=None):
+    """
+    builds the user message for the uploaded data within the token budget
+    aggregates come first, then stratified sample rows, and all the raw rows when they fit
+    :param contents:        pandas DataFrame of the uploaded file, or a summary streamed by ResultsAggregator
+    :param system_prompts:  system prompts the input is sent with
+    :param summary:         summary of the DataFrame if already computed
+    :return:                prompt input text
+    """
+    budget = input_token_budget(system_prompts)
+
+    if isinstance(contents, dict):
+        summary, raw, samples = contents, None, contents.get('samples')
+    elif aggregation.is_jtl(contents):
+        summary = summary if summary is not None else aggregation.summarize_results(contents)
+        raw, samples = contents, None
+    else:
+        # Not a JMeter result, send as many leading rows as fit
+        rows, text = _largest_fitting(lambda n: _rows_text('Raw results:', contents.head(n)), len(contents), budget)
+        return text if rows > 0 else f"{contents}"
+
+    text = _fit_summary(summary, budget)
+    remaining = budget - tokenizer.count_tokens(text) - 1
+    series_text = _fit_series(summary.get('timeseries'), remaining)
+    if series_text:
+        text = f'{text}\n{series_text}'
+        remaining -= tokenizer.count_tokens(series_text) + 1
+
+    # Every raw row takes a few tokens at least, skip rendering files that cannot fit anyway
+    if raw is not None and len(raw) * 5 <= remaining:
+        columns = [column for column in aggregation.SAMPLE_COLUMNS if column in raw.columns]
+        raw_text = _rows_text('Raw results:', raw[columns])
+        if tokenizer.count_tokens(raw_text) <= remaining:
+            return f'{text}\n{raw_text}'
+    if raw is not None:
+        samples = aggregation.sample_rows(raw, constants.SAMPLE_ROWS_PER_LABEL)
+
+    samples_text = _fit_samples(samples, remaining)
+    return f'{text}\n{samples_text}' if samples_text else text
@@ -0,0 +1,72 @@
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+# Repeated strings of a JMeter result, stored once per distinct value
+CATEGORY_COLUMNS = ['label', 'responseCode', 'responseMessage', 'threadName', 'dataType', 'failureMessage', 'URL',
+                    'Hostname']
+# Milliseconds, byte counts and thread counts fit 32 bits, epoch milliseconds do not
+INTEGER_COLUMNS = {'timeStamp': 'int64', 'elapsed': 'int32', 'Latency': 'int32', 'Connect': 'int32',
+                   'IdleTime': 'int32', 'bytes': 'int32', 'sentBytes': 'int32', 'grpThreads': 'int32',
+                   'allThreads': 'int32', 'SampleCount': 'int32', 'ErrorCount': 'int32'}
+BOOLEAN_COLUMNS = ['success']
+
+
+def csv_dtypes(columns):
+    """
+    dtypes of the JTL columns present, for pandas.read_csv
+    :param columns: header of the file
+    :return:        dict of column to dtype
+    """
+    dtypes = {}
+    for column in columns:
+        if column in CATEGORY_COLUMNS:
+            dtypes[column] = 'category'
+        elif column in INTEGER_COLUMNS:
+            dtypes[column] = INTEGER_COLUMNS[column]
+        elif column in BOOLEAN_COLUMNS:
+            dtypes[column] = 'bool'
+    return dtypes
+
+
+def arrow_convert_options(columns):
+    """
+    column types of the JTL columns present, for the Arrow CSV reader
+    :param columns: header of the file
+    :return:        pyarrow.csv.ConvertOptions, string columns are dictionary encoded and come out as categoricals
+    """
+    column_types = {}
+    for column in columns:
+        if column in CATEGORY_COLUMNS:
+            column_types[column] = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        elif column in INTEGER_COLUMNS:
+            column_types[column] = getattr(pyarrow, INTEGER_COLUMNS[column])()
+        elif column in BOOLEAN_COLUMNS:
+            column_types[column] = pyarrow.bool_()
+    return pyarrow.csv.ConvertOptions(column_types=column_types, strings_can_be_null=False)
+
+
+def apply_schema(contents):
+    """
+    converts an already parsed JTL to the compact dtypes, values that do not fit are coerced rather than rejected
+    :param contents:    pandas DataFrame
+    :return:            converted DataFrame
+    """
+    contents = contents.copy()
+    for column in contents.columns:
+        if column in CATEGORY_COLUMNS:
+            contents[column] = contents[column].astype('category')
+        elif column in INTEGER_COLUMNS:
+            values = pd.to_numeric(contents[column], errors='coerce')
+            # Integer dtypes cannot hold missing values
+            contents[column] = values.astype(INTEGER_COLUMNS[column]) if values.notna().all() else values
+        elif column in BOOLEAN_COLUMNS:
+            values = contents[column]
+            if values.dtype != bool:
+                values = values.astype(str).str.strip().str.lower().eq('true')
+            contents[column] = values
+    return contents
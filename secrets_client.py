@@ -3,6 +3,13 @@ from botocore.exceptions import ClientError
 import json
 from sentry_sdk import capture_exception
 import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
 
 
 class STSCredentials:
@@ -11,8 +18,13 @@ class STSCredentials:
         self.session_name = "my_session"
         self.credentials = None
         self.expiration = None
+        self._lock = threading.Lock()
 
     def get_credentials(self, sts_client):
+        with self._lock:
+            return self._get_credentials(sts_client)
+
+    def _get_credentials(self, sts_client):
         now_utc = datetime.datetime.utcnow()
         now_utc_str = now_utc.strftime('%Y-%m-%d %H:%M:%S+00:00')
         now_utc = datetime.datetime.strptime(now_utc_str, '%Y-%m-%d %H:%M:%S+00:00')
@@ -38,32 +50,138 @@ class STSCredentials:
         self.role_arn = role_arn
 
 
-def get_secret(secret_name, region_name, credentials):
-    """Get secrets from AWS Secret Manager
+class SecretsCache:
+    """
+    In-memory cache of Secrets Manager values sharing one client per set of credentials.
+    Values expire after the TTL; when a refresh fails the last known value keeps being served.
+    """
 
-    :param str secret_name: secret name
+    def __init__(self, ttl=constants.SECRETS_TTL):
+        self.ttl = ttl
+        self.secrets = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, region_name, credentials):
+        # A forked worker must not reuse the connections of its parent
+        key = (region_name, credentials['AccessKeyId'], os.getpid())
+        with self._lock:
+            if key not in self._clients:
+                # Clients built for rotated credentials or by the parent process are not needed anymore
+                self._clients = {k: v for k, v in self._clients.items() if k[0] != region_name}
+                self._clients[key] = boto3.client(
+                    'secretsmanager',
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken'],
+                    region_name=region_name)
+            return self._clients[key]
+
+    def _store(self, region_name, secret_name, secret_string):
+        value = json.loads(secret_string)[secret_name]
+        with self._lock:
+            self.secrets[(region_name, secret_name)] = (time.time() + self.ttl, value)
+        return value
+
+    def _cached(self, region_name, secret_name, allow_expired=False):
+        item = self.secrets.get((region_name, secret_name))
+        if item is None or (item[0] < time.time() and not allow_expired):
+            return None
+        return item[1]
+
+    def fetch(self, secret_name, region_name, credentials):
+        """
+        fetches a secret from Secrets Manager and caches it
+        :param str secret_name: secret name
+        :param str region_name: region name
+        :param Sts credentials: Sts credentials object
+        :return str: value of the secret
+        """
+        response = self._client(region_name, credentials).get_secret_value(SecretId=secret_name)
+        return self._store(region_name, secret_name, response['SecretString'])
+
+    def prefetch(self, secret_names, region_name, credentials):
+        """
+        fetches all the given secrets in one batched call, or in parallel if batching is unavailable
+        :param list secret_names: secret names
+        :param str region_name: region name
+        :param Sts credentials: Sts credentials object
+        :return dict: secret name to value
+        """
+        client = self._client(region_name, credentials)
+        if hasattr(client, 'batch_get_secret_value'):
+            response = client.batch_get_secret_value(SecretIdList=list(secret_names))
+            for error in response.get('Errors', []):
+                logging.error(f"Could not prefetch secret {error.get('SecretId')}: {error.get('Message')}")
+            for item in response['SecretValues']:
+                self._store(region_name, item['Name'], item['SecretString'])
+        else:
+            with ThreadPoolExecutor(max_workers=len(secret_names) or 1) as executor:
+                list(executor.map(lambda name: self.fetch(name, region_name, credentials), secret_names))
+        return {name: self._cached(region_name, name) for name in secret_names}
+
+    def get(self, secret_name, region_name, credentials):
+        """
+        returns the cached secret, fetching it when missing or expired
+        :param str secret_name: secret name
+        :param str region_name: region name
+        :param Sts credentials: Sts credentials object
+        :return str: value of the secret
+        """
+        value = self._cached(region_name, secret_name)
+        if value is not None:
+            return value
+        try:
+            return self.fetch(secret_name, region_name, credentials)
+        except ClientError:
+            stale = self._cached(region_name, secret_name, allow_expired=True)
+            if stale is None:
+                raise
+            logging.error(f"Could not refresh secret {secret_name}, serving the cached value.")
+            return stale
+
+    def invalidate(self, secret_name=None):
+        """
+        drops a cached secret, e.g. after it was rotated, or all of them
+        :param str secret_name: secret name, None for all
+        """
+        with self._lock:
+            if secret_name is None:
+                self.secrets.clear()
+            else:
+                self.secrets = {k: v for k, v in self.secrets.items() if k[1] != secret_name}
+
+
+secrets_cache = SecretsCache()
+
+
+def prefetch_secrets(secret_names, region_name, credentials):
+    """Fetch several secrets from AWS Secret Manager at once into the in-memory cache
+
+    :param list secret_names: secret names
     :param str region_name: region name
     :param Sts credentials: Sts credentials object
     :raises e: ClientError
-    :return str: value of the secret
+    :return dict: secret name to value
     """
     try:
+        return secrets_cache.prefetch(secret_names, region_name, credentials)
+    except ClientError as e:
+        capture_exception(e)
+        raise e
 
-        secrets_client = boto3.client(
-            'secretsmanager',
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken'],
-            region_name=region_name)
 
-        get_secret_value_response = secrets_client.get_secret_value(
-            SecretId=secret_name
-        )
+def get_secret(secret_name, region_name, credentials):
+    """Get secrets from AWS Secret Manager, served from memory once fetched
 
+    :param str secret_name: secret name
+    :param str region_name: region name
+    :param Sts credentials: Sts credentials object
+    :raises e: ClientError
+    :return str: value of the secret
+    """
+    try:
+        return secrets_cache.get(secret_name, region_name, credentials)
     except ClientError as e:
         capture_exception(e)
         raise e
-
-    secret = json.loads(get_secret_value_response['SecretString'])
-
-    return secret[secret_name]
@@ -0,0 +1,167 @@
+import math
+import struct
+import zlib
+
+import numpy as np
+
+import constants
+
+# Version, relative accuracy, maximum number of buckets, zero count, count and number of buckets
+_HEADER = struct.Struct('<BdIQQI')
+_VERSION = 1
+
+
+class QuantileSketch:
+    """
+    Mergeable log-bucketed quantile sketch.
+
+    Every value is counted in a bucket whose bounds grow geometrically, so a
+    quantile is answered within ``relative_accuracy`` of the exact value while
+    memory only depends on the range of the values, not on their number.
+    Past ``max_buckets`` the lowest buckets are collapsed into one, so memory
+    stays bounded and only quantiles below the collapsed range lose accuracy.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=constants.SKETCH_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add_many(self, values):
+        """
+        adds a batch of values to the sketch
+        :param values:  iterable or numpy array of numbers, NaN are ignored
+        :return:        None
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        positive = values[values > 0]
+        self.zero_count += int(values.size - positive.size)
+        self.count += int(values.size)
+        if positive.size:
+            indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+                                        return_counts=True)
+            for index, count in zip(indexes.tolist(), counts.tolist()):
+                self.buckets[index] = self.buckets.get(index, 0) + count
+            self._collapse()
+
+    def merge(self, other):
+        """
+        merges another sketch with the same accuracy into this one
+        :param other:   QuantileSketch
+        :return:        self
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with a different relative accuracy.')
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self._collapse()
+        return self
+
+    def _collapse(self):
+        if len(self.buckets) <= self.max_buckets:
+            return
+        indexes = sorted(self.buckets)
+        lowest = indexes[-self.max_buckets]
+        for index in indexes[:-self.max_buckets]:
+            self.buckets[lowest] += self.buckets.pop(index)
+
+    def quantiles(self, qs):
+        """
+        estimates the values at several quantiles in one pass over the buckets
+        :param qs:  quantiles between 0 and 1
+        :return:    list of estimated values, None if the sketch is empty
+        """
+        if self.count == 0:
+            return [None] * len(qs)
+        ranks = np.asarray(qs, dtype=float) * (self.count - 1)
+        if not self.buckets:
+            return [0.0] * len(qs)
+        indexes = np.fromiter(sorted(self.buckets), dtype=np.int64, count=len(self.buckets))
+        cumulative = self.zero_count + np.cumsum([self.buckets[index] for index in indexes.tolist()])
+        # First bucket whose cumulative count passes the rank
+        positions = np.minimum(np.searchsorted(cumulative, ranks, side='right'), len(indexes) - 1)
+        values = 2 * self.gamma ** indexes[positions].astype(float) / (self.gamma + 1)
+        return np.where(ranks < self.zero_count, 0.0, values).tolist()
+
+    def quantile(self, q):
+        """
+        estimates the value at the given quantile
+        :param q:   quantile between 0 and 1
+        :return:    estimated value, or None if the sketch is empty
+        """
+        return self.quantiles([q])[0]
+
+    def to_bytes(self):
+        """
+        serializes the sketch compactly, e.g. for a DynamoDB binary attribute
+        :return:    bytes, bucket indexes are delta encoded and compressed
+        """
+        indexes = np.fromiter(sorted(self.buckets), dtype=np.int64, count=len(self.buckets))
+        counts = np.array([self.buckets[index] for index in indexes.tolist()], dtype=np.uint64)
+        deltas = np.diff(indexes, prepend=0).astype(np.int32)
+        header = _HEADER.pack(_VERSION, self.relative_accuracy, self.max_buckets, self.zero_count, self.count,
+                              len(indexes))
+        return header + zlib.compress(deltas.tobytes() + counts.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data:    bytes written by to_bytes
+        :return:        QuantileSketch
+        """
+        version, relative_accuracy, max_buckets, zero_count, count, size = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f'Unsupported sketch version {version}.')
+        body = zlib.decompress(bytes(data[_HEADER.size:]))
+        indexes = np.cumsum(np.frombuffer(body, dtype=np.int32, count=size), dtype=np.int64)
+        counts = np.frombuffer(body, dtype=np.uint64, count=size, offset=size * 4)
+        sketch = cls(relative_accuracy, max_buckets)
+        sketch.buckets = dict(zip(indexes.tolist(), counts.tolist()))
+        sketch.zero_count, sketch.count = zero_count, count
+        return sketch
+
+
+def encode_sketches(sketches, max_bytes=None):
+    """
+    serializes sketches by name into one blob, keeping the sketches holding the most values if over max_bytes
+    :param sketches:    dict of name to QuantileSketch
+    :param max_bytes:   size limit of the blob
+    :return:            bytes
+    """
+    parts = []
+    size = 0
+    for name, sketch in sorted(sketches.items(), key=lambda item: item[1].count, reverse=True):
+        key, data = name.encode('utf-8'), sketch.to_bytes()
+        part = struct.pack('<HI', len(key), len(data)) + key + data
+        if max_bytes is not None and size + len(part) > max_bytes:
+            break
+        parts.append(part)
+        size += len(part)
+    return b''.join(parts)
+
+
+def decode_sketches(data):
+    """
+    :param data:    bytes written by encode_sketches
+    :return:        dict of name to QuantileSketch
+    """
+    data = bytes(data)
+    sketches = {}
+    offset = 0
+    while offset < len(data):
+        key_size, data_size = struct.unpack_from('<HI', data, offset)
+        offset += 6
+        name = data[offset:offset + key_size].decode('utf-8')
+        offset += key_size
+        sketches[name] = QuantileSketch.from_bytes(data[offset:offset + data_size])
+        offset += data_size
+    return sketches
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sentry_sdk import capture_exception
+
+import constants
+
+
+class LazyClient:
+    """
+    Builds a client on first use, then forwards attribute access to it.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        :return:    the client, built by the factory on the first call
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class Readiness:
+    """
+    Runs the warm-up tasks of a process in parallel and reports whether it is ready to serve.
+    The state belongs to the process that ran the tasks: a forked worker starts cold and warms up its own
+    connections, while inheriting everything the parent already loaded (credentials, secrets, caches).
+    """
+
+    def __init__(self, max_workers=constants.STARTUP_WORKERS):
+        self.max_workers = max_workers
+        self.checks = {}
+        self._pid = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, tasks):
+        """
+        starts the warm-up in a background thread, once per process
+        :param tasks:   dict of task name to (function, critical), the process is ready once every critical task
+                        succeeded
+        :return:        None
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._done = threading.Event()
+            self.checks = {name: {'status': 'pending', 'critical': critical}
+                           for name, (func, critical) in tasks.items()}
+        threading.Thread(target=self._run, args=(tasks, self._done), name='warm-up', daemon=True).start()
+
+    def _run_task(self, name, func):
+        started = time.perf_counter()
+        try:
+            func()
+            self.checks[name].update(status='ok')
+        except Exception as e:
+            logging.error(f"Warm-up task {name} failed: {e}")
+            capture_exception(e)
+            self.checks[name].update(status='failed', error=str(e))
+        self.checks[name]['seconds'] = round(time.perf_counter() - started, 3)
+
+    def _run(self, tasks, done):
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='warm-up') as executor:
+                for name, (func, critical) in tasks.items():
+                    executor.submit(self._run_task, name, func)
+        finally:
+            done.set()
+
+    def wait(self, timeout=None):
+        """
+        waits for the warm-up of this process
+        :param timeout: seconds
+        :return:        True if the warm-up finished
+        """
+        return self._pid == os.getpid() and self._done.wait(timeout)
+
+    @property
+    def ready(self):
+        """
+        :return:    True once the warm-up of this process finished and every critical task succeeded
+        """
+        return (self._pid == os.getpid() and self._done.is_set() and
+                all(check['status'] == 'ok' for check in self.checks.values() if check['critical']))
+
+    def report(self):
+        """
+        :return:    readiness and the status of every warm-up task
+        """
+        checks = self.checks if self._pid == os.getpid() else {}
+        return {'ready': self.ready, 'checks': {name: dict(check) for name, check in checks.items()}}
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+# The application modules live at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Read by utils at import time, AWS is emulated by moto
+AWS_ENVIRONMENT = {
+    'ARN': 'arn:aws:iam::123456789012:role/perfgpt-test',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_DYNAMODB_KEY': 'test',
+    'AWS_DYNAMODB_SECRET': 'test',
+    'DYNAMODB_PERFGPT_TABLE': 'perfgpt-test',
+    'DYNAMODB_SETTINGS_TABLE': 'perfgpt-settings-test',
+}
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    """
+    usage and settings tables in moto
+    :return:    utils module connected to the tables
+    """
+    moto = pytest.importorskip('moto')
+    import boto3
+
+    for name, value in AWS_ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        resource = boto3.resource('dynamodb', region_name=AWS_ENVIRONMENT['AWS_DEFAULT_REGION'])
+        resource.create_table(TableName=AWS_ENVIRONMENT['DYNAMODB_PERFGPT_TABLE'],
+                              KeySchema=[{'AttributeName': 'username', 'KeyType': 'HASH'},
+                                         {'AttributeName': 'datetime', 'KeyType': 'RANGE'}],
+                              AttributeDefinitions=[{'AttributeName': 'username', 'AttributeType': 'S'},
+                                                    {'AttributeName': 'datetime', 'AttributeType': 'S'}],
+                              BillingMode='PAY_PER_REQUEST')
+        resource.create_table(TableName=AWS_ENVIRONMENT['DYNAMODB_SETTINGS_TABLE'],
+                              KeySchema=[{'AttributeName': 'username', 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': 'username', 'AttributeType': 'S'}],
+                              BillingMode='PAY_PER_REQUEST')
+        import utils
+        # Every test connects again and starts without the users seen by the previous ones
+        monkeypatch.setattr(utils, 'dynamodb', None)
+        monkeypatch.setattr(utils, 'known_users', set())
+        utils.init_dynamodb()
+        yield utils
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregation
+import constants
+
+LABELS = ['add_to_cart', 'home', 'search']
+
+
+def results(size=30_000, seed=0):
+    random = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'timeStamp': 1_700_000_000_000 + np.sort(random.integers(0, 600_000, size)),
+        'elapsed': np.round(random.lognormal(5, 0.8, size)).astype('int64'),
+        'Latency': np.round(random.lognormal(4, 0.5, size)).astype('int64'),
+        'label': random.choice(LABELS, size),
+        'responseCode': random.choice([200, 200, 200, 500], size),
+        'success': random.random(size) > 0.05,
+        'bytes': random.integers(100, 5000, size),
+    })
+
+
+def streamed(contents, chunksize):
+    aggregator = aggregation.ResultsAggregator()
+    for start in range(0, len(contents), chunksize):
+        aggregator.update(contents.iloc[start:start + chunksize])
+    return aggregator.summary()
+
+
+def assert_percentile(estimate, values, q):
+    # the sketch answers within its relative accuracy of a sample ranked around q
+    lower = np.quantile(values, q, method='lower') * (1 - constants.SKETCH_RELATIVE_ACCURACY)
+    higher = np.quantile(values, q, method='higher') * (1 + constants.SKETCH_RELATIVE_ACCURACY)
+    assert lower - 1e-9 <= estimate <= higher + 1e-9
+
+
+@pytest.mark.parametrize('chunksize', [1_000, 7_777])
+def test_streamed_summary_matches_the_exact_summary(chunksize):
+    contents = results()
+    exact = aggregation.summarize_results(contents)
+    summary = streamed(contents, chunksize)
+
+    for key in ['samples', 'errors', 'labels', 'bytes']:
+        assert summary['overall'][key] == exact['overall'][key]
+    for key in ['error_rate', 'duration', 'throughput', 'elapsed_min', 'elapsed_max', 'elapsed_mean', 'elapsed_std',
+                'Latency_mean', 'Latency_std']:
+        assert summary['overall'][key] == pytest.approx(exact['overall'][key], rel=1e-9)
+    assert summary['response_codes'] == exact['response_codes']
+
+    per_label, exact_per_label = summary['per_label'], exact['per_label']
+    assert list(per_label.index) == list(exact_per_label.index) == LABELS
+    for column in ['count', 'errors', 'bytes', 'elapsed_min', 'elapsed_max']:
+        assert per_label[column].tolist() == exact_per_label[column].tolist()
+    for column in ['error_rate', 'throughput', 'elapsed_mean', 'elapsed_std', 'Latency_mean', 'Latency_std']:
+        np.testing.assert_allclose(per_label[column], exact_per_label[column], rtol=1e-9)
+
+    for q in aggregation.PERCENTILES:
+        column = f'elapsed_{aggregation.percentile_name(q)}'
+        assert_percentile(summary['overall'][column], contents['elapsed'], q)
+        for label in LABELS:
+            assert_percentile(per_label.at[label, column], contents.loc[contents['label'] == label, 'elapsed'], q)
+
+
+def test_merged_aggregators_match_a_single_pass():
+    contents = results(10_000, seed=1)
+    single = streamed(contents, 10_000)
+    merged = aggregation.ResultsAggregator().update(contents.iloc[:4_000])
+    merged.merge(aggregation.ResultsAggregator().update(contents.iloc[4_000:])).merge(aggregation.ResultsAggregator())
+    merged = merged.summary()
+
+    assert merged['overall']['samples'] == single['overall']['samples'] == 10_000
+    assert merged['overall']['elapsed_std'] == pytest.approx(single['overall']['elapsed_std'], rel=1e-9)
+    pd.testing.assert_frame_equal(merged['per_label'], single['per_label'])
@@ -0,0 +1,77 @@
+import os
+import time
+
+import cache
+import constants
+
+
+def test_make_key_ignores_whitespace_only_changes():
+    key = cache.make_key('label,count\nhome,10\n', 'prompt')
+    assert key == cache.make_key('\n label,count  \r\nhome,10\t\r\n\n', 'prompt')
+    assert key != cache.make_key('label,count\nhome,11\n', 'prompt')
+    assert key != cache.make_key('label,count\nhome,10\n', 'other prompt')
+    # parts are separated, moving text from one to the other changes the key
+    assert cache.make_key('ab', 'c') != cache.make_key('a', 'bc')
+
+
+def test_make_key_changes_with_the_model_parameters(monkeypatch):
+    key = cache.make_key('contents', 'prompt')
+    monkeypatch.setattr(constants, 'temperature', constants.temperature + 0.5)
+    assert cache.make_key('contents', 'prompt') != key
+    monkeypatch.undo()
+    monkeypatch.setattr(constants, 'openai_model', 'another-model')
+    assert cache.make_key('contents', 'prompt') != key
+
+
+def test_result_cache_reads_through_to_disk(tmp_path):
+    results = {'Summary': '<p>fine</p>'}
+    cache.ResultCache(directory=str(tmp_path)).set('key', results)
+
+    restarted = cache.ResultCache(directory=str(tmp_path))
+    assert restarted.memory.get('key') is None
+    assert restarted.get('key') == results
+    assert restarted.memory.get('key') == results
+    assert restarted.get('missing') is None
+
+
+def test_result_cache_evicts_from_memory_only(tmp_path):
+    results_cache = cache.ResultCache(maxsize=2, directory=str(tmp_path))
+    for key in ['a', 'b', 'c']:
+        results_cache.set(key, key.upper())
+
+    assert results_cache.memory.get('a') is None
+    assert results_cache.get('a') == 'A'
+    assert [results_cache.get(key) for key in ['b', 'c']] == ['B', 'C']
+
+
+def test_result_cache_entries_expire(tmp_path, monkeypatch):
+    results_cache = cache.ResultCache(ttl=60, directory=str(tmp_path))
+    results_cache.set('key', 'value')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+
+    assert results_cache.get('key') is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_result_cache_without_directory_caches_in_memory(tmp_path):
+    blocked = tmp_path / 'file'
+    blocked.write_text('')
+    results_cache = cache.ResultCache(directory=str(blocked / 'cache'))
+
+    assert results_cache.disk is None
+    results_cache.set('key', 'value')
+    assert results_cache.get('key') == 'value'
+
+
+def test_purge_removes_expired_entries_and_leftovers(tmp_path, monkeypatch):
+    disk = cache.DiskCache(str(tmp_path), ttl=60)
+    disk.set('old', 1)
+    (tmp_path / 'killed.tmp').write_text('{')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    disk.set('new', 2)
+
+    assert disk.purge_expired() == 2
+    assert os.listdir(tmp_path) == ['new.json']
+    assert disk.get('new') == 2
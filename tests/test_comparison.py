@@ -0,0 +1,56 @@
+import pandas as pd
+
+import comparison
+
+
+def labels(rows):
+    """
+    :param rows:    dict of label to (count, errors, throughput, mean, std, p95)
+    :return:        per-label table of a run
+    """
+    return pd.DataFrame.from_dict(rows, orient='index', dtype=float,
+                                  columns=['count', 'errors', 'throughput', 'elapsed_mean', 'elapsed_std',
+                                           'elapsed_p95'])
+
+
+BASELINE = labels({'home': (1000, 5, 20, 200, 40, 280), 'search': (1000, 5, 20, 300, 60, 420),
+                   'login': (10, 0, 1, 150, 30, 200), 'logout': (500, 0, 10, 100, 20, 140)})
+
+
+def test_compare_runs_flags_significant_changes():
+    current = labels({'home': (1000, 5, 20, 260, 40, 360), 'search': (1000, 5, 20, 240, 60, 330),
+                      'login': (10, 5, 1, 600, 30, 900), 'checkout': (800, 0, 16, 350, 50, 450)})
+    diff = comparison.compare_runs(current, BASELINE)
+
+    assert diff.at['home', 'verdict'] == 'regression'
+    assert diff.at['home', 'worse'] == 'latency'
+    assert diff.at['search', 'verdict'] == 'improvement'
+    # Too few samples to tell, however large the change
+    assert diff.at['login', 'verdict'] == 'inconclusive'
+    assert diff.at['checkout', 'verdict'] == 'new'
+    assert diff.at['logout', 'verdict'] == 'missing'
+    assert round(diff.at['home', 'p95_change'], 2) == round((360 - 280) / 280 * 100, 2)
+    assert comparison.verdict_of(diff) == 'regression'
+
+
+def test_compare_runs_ignores_noise():
+    current = labels({'home': (1000, 6, 20.5, 202, 40, 285), 'search': (1000, 4, 19.8, 298, 60, 418),
+                      'login': (10, 0, 1, 151, 30, 201), 'logout': (500, 0, 10, 101, 20, 141)})
+    diff = comparison.compare_runs(current, BASELINE)
+
+    assert set(diff['verdict']) <= {'unchanged', 'inconclusive'}
+    assert comparison.verdict_of(diff) == 'unchanged'
+
+
+def test_compare_runs_flags_errors_and_throughput():
+    current = labels({'home': (1000, 80, 20, 200, 40, 280), 'search': (1000, 5, 12, 300, 60, 420),
+                      'login': (10, 0, 1, 150, 30, 200), 'logout': (500, 0, 10, 100, 20, 140)})
+    diff = comparison.compare_runs(current, BASELINE)
+
+    assert diff.at['home', 'worse'] == 'errors'
+    assert diff.at['search', 'worse'] == 'throughput'
+
+
+def test_labels_survive_the_history_encoding():
+    decoded = comparison.decode_labels(comparison.encode_labels(BASELINE))
+    pd.testing.assert_frame_equal(decoded, BASELINE)
@@ -0,0 +1,24 @@
+import pytest
+
+import constants
+
+
+def quota(utils, username):
+    return utils.settings_table.get_item(Key={'username': username})['Item']['initial_upload_quota']
+
+
+def test_first_reservation_creates_the_user_with_the_initial_quota(dynamodb):
+    assert 'Item' not in dynamodb.settings_table.get_item(Key={'username': 'octocat'})
+    assert dynamodb.reserve_upload_credit('octocat') == constants.upload_quota - 1
+    assert quota(dynamodb, 'octocat') == constants.upload_quota - 1
+
+
+def test_reservation_stops_at_zero_and_refund_gives_the_credit_back(dynamodb):
+    dynamodb.settings_table.put_item(Item={'username': 'octocat', 'initial_upload_quota': 1})
+    assert dynamodb.reserve_upload_credit('octocat') == 0
+    with pytest.raises(dynamodb.QuotaExceededError):
+        dynamodb.reserve_upload_credit('octocat')
+    assert quota(dynamodb, 'octocat') == 0
+
+    assert dynamodb.refund_upload_credit('octocat') == 1
+    assert dynamodb.get_upload_count('octocat') == 1
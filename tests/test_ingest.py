@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import constants
+import ingest
+
+START = 1_700_000_000_000
+
+
+@pytest.mark.parametrize('starts, offsets', [
+    ([], []),
+    ([START], [0]),
+    ([START, None], [0, 0]),
+    # within the tolerance, generators never start at the same millisecond
+    ([START, START + 400, START + 1000], [0, 0, 0]),
+    # one skewed clock among three, measured from the median start
+    ([START, START + 200, START + 5_000], [0, 0, 4_800]),
+    ([START - 30_000, START, START + 100], [-30_000, 0, 0]),
+    # two generators, the median is halfway
+    ([START, START + 4_000], [-2_000, 2_000]),
+    # beyond the maximum skew, e.g. tests run one after the other
+    ([START, START + 100, START + constants.CLOCK_SKEW_MAX + 1_000], [0, 0, 0]),
+    ([START, None, START + 100, START + 3_000], [0, 0, 0, 2_900]),
+])
+def test_clock_offsets(starts, offsets):
+    assert ingest.clock_offsets(starts) == offsets
+
+
+def results_file(path, start, size=200):
+    contents = pd.DataFrame({'timeStamp': start + np.arange(size) * 100, 'elapsed': 100, 'label': 'home',
+                             'responseCode': 200, 'success': True})
+    contents.to_csv(path, index=False)
+    return str(path), path.name
+
+
+@pytest.mark.parametrize('align_clocks, duration', [(True, 20.1), (False, 28)])
+def test_read_files_aligns_the_clocks_of_skewed_generators(tmp_path, align_clocks, duration):
+    uploads = [results_file(tmp_path / 'a.csv', START), results_file(tmp_path / 'b.csv', START + 100),
+               results_file(tmp_path / 'c.csv', START + 8_000)]
+    summary = ingest.read_files(uploads, align_clocks)
+
+    assert summary['overall']['samples'] == 600
+    assert summary['overall']['duration'] == pytest.approx(duration)
+    assert [file['clock_offset'] for file in summary['files']] == ([0, 0, 7.9] if align_clocks else [0, 0, 0])
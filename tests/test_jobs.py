@@ -0,0 +1,77 @@
+import subprocess
+import sys
+import threading
+import time
+
+import jobs
+
+
+def runner(tmp_path, abandoned, **kwargs):
+    return jobs.JobRunner(max_workers=1, directory=str(tmp_path), ttl=60, on_abandoned=abandoned.append, **kwargs)
+
+
+def wait_for(job_runner, job_id, status):
+    deadline = time.time() + 5
+    while job_runner.get(job_id)['status'] != status:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return job_runner.get(job_id)
+
+
+def test_job_result_is_stored(tmp_path):
+    abandoned = []
+    job_runner = runner(tmp_path, abandoned)
+    job_id = job_runner.submit('octocat', lambda x: x * 2, 21)
+    assert wait_for(job_runner, job_id, 'done')['result'] == 42
+    assert abandoned == []
+
+
+def test_job_of_an_exited_worker_fails_once(tmp_path):
+    abandoned = []
+    job_runner = runner(tmp_path, abandoned)
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    now = time.time()
+    job_runner.store.set('orphan', {'id': 'orphan', 'username': 'octocat', 'status': 'running', 'credit': True,
+                                    'pid': process.pid, 'created': now, 'started': now, 'heartbeat': now})
+
+    job = job_runner.get('orphan')
+    assert job['status'] == 'failed' and job['error']
+    assert job_runner.get('orphan')['status'] == 'failed'
+    assert [job['username'] for job in abandoned] == ['octocat']
+    assert runner(tmp_path, abandoned).get('orphan')['status'] == 'failed'
+    assert len(abandoned) == 1
+
+
+def test_job_without_heartbeat_or_past_the_timeout_fails(tmp_path):
+    abandoned = []
+    job_runner = runner(tmp_path, abandoned, stale_after=10, timeout=100)
+    now = time.time()
+    job_runner.store.set('silent', {'id': 'silent', 'username': 'octocat', 'status': 'queued', 'created': now - 20,
+                                    'heartbeat': now - 20})
+    job_runner.store.set('slow', {'id': 'slow', 'username': 'octocat', 'status': 'running', 'created': now - 200,
+                                  'started': now - 200, 'heartbeat': now})
+    job_runner.store.set('fresh', {'id': 'fresh', 'username': 'octocat', 'status': 'running', 'created': now,
+                                   'started': now, 'heartbeat': now})
+
+    assert job_runner.get('silent')['status'] == 'failed'
+    assert job_runner.get('slow')['status'] == 'failed'
+    assert job_runner.get('fresh')['status'] == 'running'
+    assert len(abandoned) == 2
+
+
+def test_heartbeat_keeps_a_long_job_alive_and_an_abandoned_job_stays_failed(tmp_path):
+    abandoned = []
+    release = threading.Event()
+    job_runner = runner(tmp_path, abandoned, heartbeat_interval=0.05, stale_after=1, timeout=2.5)
+    job_id = job_runner.submit('octocat', release.wait, credit=True)
+
+    time.sleep(1.5)
+    assert job_runner.get(job_id)['status'] == 'running'
+    time.sleep(1.5)
+    assert job_runner.get(job_id)['status'] == 'failed'
+
+    release.set()
+    job_runner.executor.shutdown(wait=True)
+    assert job_runner.get(job_id)['status'] == 'failed'
+    assert [job['credit'] for job in abandoned] == [True]
@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def shared_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    for metric in metrics.registry:
+        monkeypatch.setattr(metric, '_values', {})
+    return tmp_path
+
+
+def write_snapshot(directory, name, snapshot):
+    with open(os.path.join(directory, name), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def test_scrape_adds_up_the_live_workers_and_the_retired_ones(shared_directory):
+    metrics.stage_errors.inc(stage='openai', operation='summary')
+    metrics.stage_seconds.observe(0.2, stage='openai', operation='summary')
+    snapshot = {metrics.stage_errors.name: [[['openai', 'summary'], 2]],
+                metrics.stage_seconds.name: metrics.stage_seconds.snapshot()}
+    # The parent of the test runner is alive, and no process runs with the largest pid
+    write_snapshot(shared_directory, f'{os.getppid()}.json', snapshot)
+    write_snapshot(shared_directory, f'{2 ** 22 + 1}.json', snapshot)
+    write_snapshot(shared_directory, metrics.ARCHIVE_FILE, {metrics.stage_errors.name: [[['openai', 'summary'], 4]]})
+
+    text = metrics.render()
+    assert 'perfgpt_stage_errors_total{stage="openai",operation="summary"} 7' in text
+    assert 'perfgpt_stage_duration_seconds_count{stage="openai",operation="summary"} 2' in text
+
+
+def test_retired_worker_is_kept_in_the_archive(shared_directory):
+    write_snapshot(shared_directory, '1234.json', {metrics.stage_errors.name: [[['parse', ''], 3]]})
+    write_snapshot(shared_directory, metrics.ARCHIVE_FILE, {metrics.stage_errors.name: [[['parse', ''], 4]]})
+
+    metrics.retire_process(1234)
+    assert not os.path.exists(os.path.join(shared_directory, '1234.json'))
+    assert 'perfgpt_stage_errors_total{stage="parse",operation=""} 7' in metrics.render()
+
+
+def test_flush_writes_the_values_of_this_process(shared_directory):
+    metrics.openai_tokens.inc(10, model='gpt-4', kind='prompt')
+    metrics.flush()
+    with open(os.path.join(shared_directory, f'{os.getpid()}.json')) as f:
+        assert json.load(f)[metrics.openai_tokens.name] == [[['gpt-4', 'prompt'], 10]]
+
+
+def test_dynamodb_error_responses_are_counted(dynamodb, monkeypatch):
+    monkeypatch.setattr(metrics.stage_errors, '_values', {})
+    dynamodb.settings_table.put_item(Item={'username': 'octocat', 'initial_upload_quota': 0})
+    with pytest.raises(dynamodb.QuotaExceededError):
+        dynamodb.reserve_upload_credit('octocat')
+    assert metrics.stage_errors.snapshot() == [[['dynamodb', 'UpdateItem'], 1]]
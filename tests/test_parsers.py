@@ -0,0 +1,58 @@
+import io
+import os
+
+import pytest
+
+import aggregation
+import constants
+import ingest
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+# sample file, detected format, samples, errors and labels of the file
+CASES = [
+    ('gatling/simulation-3.3.log', 'gatling', 40, 3, ['add_to_cart', 'home', 'product', 'search']),
+    ('gatling/simulation-3.9.log', 'gatling', 40, 3, ['add_to_cart', 'home', 'product', 'search']),
+    ('k6/results.json', 'k6', 155, 6, ['contacts', 'https://test.k6.io/', 'https://test.k6.io/news.php']),
+    ('locust/example_stats.csv', 'locust', 6547, 17, ['GET /', 'GET /item/[id]', 'POST /cart/add', 'POST /login']),
+    ('ndjson/jmeter-results.ndjson', 'ndjson', 120, 5, ['add_to_cart', 'home', 'product', 'search']),
+    ('jmeter/run.csv', 'csv', 112, 0, ['HTTP Request']),
+]
+
+
+@pytest.mark.parametrize('sample, results_format, samples, errors, labels', CASES)
+def test_sample_is_detected_and_summarized(sample, results_format, samples, errors, labels):
+    path = os.path.join(SAMPLES, sample)
+    filename = os.path.basename(path)
+    assert ingest.detect_format(path, filename) == results_format
+
+    summary = aggregation.summarize_upload(ingest.read_upload(path, filename))
+    overall = summary['overall']
+    assert (overall['samples'], overall['errors']) == (samples, errors)
+    assert sorted(summary['per_label'].index) == labels
+    assert overall['elapsed_min'] <= overall['elapsed_p50'] <= overall['elapsed_p95'] <= overall['elapsed_max']
+    assert f'samples={samples}' in aggregation.format_summary(summary)
+
+
+def test_gatling_layouts_agree():
+    # Gatling 3.4 dropped the user id from the USER and REQUEST records, both layouts give the same samples
+    summaries = [aggregation.summarize_upload(ingest.read_upload(os.path.join(SAMPLES, 'gatling', name), name))
+                 for name in ['simulation-3.3.log', 'simulation-3.9.log']]
+    for summary in summaries:
+        per_label = summary['per_label']
+        assert per_label['count'].tolist() == [10, 10, 10, 10]
+        assert summary['overall']['duration'] > 0
+
+
+@pytest.mark.parametrize('csv_engine', ['pyarrow', 'pandas'])
+def test_column_changing_type_after_the_first_block_is_parsed_leniently(monkeypatch, csv_engine):
+    # Arrow infers the type of customVar from the first block only, the last row does not fit it
+    monkeypatch.setattr(constants, 'ARROW_BLOCK_SIZE', 1024)
+    monkeypatch.setattr(constants, 'CSV_ENGINE', csv_engine)
+    rows = ['timeStamp,elapsed,label,responseCode,success,threadName,customVar']
+    rows += [f'{1700000000000 + i},{10 + i % 7},home,200,true,t1,{i}' for i in range(400)]
+    rows.append('1700000000500,20,home,500,false,t1,abc')
+
+    overall = ingest.stream_csv(io.BytesIO('\n'.join(rows).encode()), chunksize=100)['overall']
+    assert (overall['samples'], overall['errors']) == (401, 1)
+    assert overall['elapsed_max'] == 20
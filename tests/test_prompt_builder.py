@@ -0,0 +1,45 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+import constants
+import prompt_builder
+import tokenizer
+
+# Splits text the way cl100k_base does at worst: numbers in groups of up to 3 digits, words, spaces and every
+# punctuation mark on its own
+WORST_CASE_TOKENS = re.compile(r"\d{1,3}|[A-Za-z]+|\s+|[^\sA-Za-z\d]")
+SYSTEM_PROMPT = 'You are a performance engineer. Analyze the aggregated results below. ' * 30
+
+
+def worst_case_count(messages):
+    return sum(3 + len(WORST_CASE_TOKENS.findall(message['content'])) for message in messages) + 3
+
+
+def numeric_results(size=200_000, labels=400):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'timeStamp': 1_700_000_000_000 + np.sort(rng.integers(0, 3_600_000, size)),
+        'elapsed': rng.lognormal(6, 1, size).astype(int),
+        'label': rng.choice([f'/api/v2/items/{i}' for i in range(labels)], size),
+        'responseCode': rng.choice([200, 500, 404], size, p=[.97, .02, .01]),
+        'success': rng.random(size) > .03,
+        'allThreads': 50,
+        'bytes': rng.integers(100, 99_999, size),
+    })
+
+
+def test_length_estimate_keeps_numeric_prompts_within_the_context_window(monkeypatch):
+    monkeypatch.setattr(tokenizer, 'tiktoken', None)
+    contents = prompt_builder.build_prompt_input(numeric_results(), [SYSTEM_PROMPT])
+    messages = [{'role': 'system', 'content': SYSTEM_PROMPT}, {'role': 'user', 'content': contents}]
+    max_tokens = prompt_builder.completion_token_limit(messages)
+
+    assert max_tokens >= constants.MIN_COMPLETION_TOKENS
+    assert worst_case_count(messages) + max_tokens <= constants.CONTEXT_WINDOW
+
+
+def test_length_estimate_is_not_below_the_worst_case():
+    text = ','.join(f'{value:.2f}' for value in np.random.default_rng(1).lognormal(6, 1, 5000))
+    assert tokenizer.estimate_tokens(text) >= len(WORST_CASE_TOKENS.findall(text))
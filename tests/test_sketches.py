@@ -0,0 +1,68 @@
+import io
+
+import numpy as np
+import pandas as pd
+from werkzeug.datastructures import FileStorage
+
+import aggregation
+import ingest
+import sketches
+from sketches import QuantileSketch
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99, 0.999]
+
+
+def filled_sketch(seed=0, size=50_000):
+    sketch = QuantileSketch(0.01)
+    sketch.add_many(np.random.default_rng(seed).lognormal(5, 0.6, size))
+    sketch.add_many([0, 0, np.nan])
+    return sketch
+
+
+def test_to_bytes_round_trip():
+    sketch = filled_sketch()
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+
+    assert restored.buckets == sketch.buckets
+    assert (restored.count, restored.zero_count) == (sketch.count, sketch.zero_count) == (50_002, 2)
+    assert restored.relative_accuracy == sketch.relative_accuracy
+    assert restored.max_buckets == sketch.max_buckets
+    assert restored.quantiles(QUANTILES) == sketch.quantiles(QUANTILES)
+
+
+def test_restored_sketch_merges_and_stays_accurate():
+    values = np.random.default_rng(1).lognormal(5, 0.6, 50_000)
+    merged = QuantileSketch.from_bytes(filled_sketch(1).to_bytes()).merge(filled_sketch(2))
+    merged_values = np.concatenate([values, np.random.default_rng(2).lognormal(5, 0.6, 50_000), [0, 0, 0, 0]])
+
+    for q, estimate in zip(QUANTILES, merged.quantiles(QUANTILES)):
+        exact = np.quantile(merged_values, q)
+        assert abs(estimate - exact) <= 0.02 * exact
+
+
+def test_empty_sketch_round_trip():
+    restored = QuantileSketch.from_bytes(QuantileSketch(0.01).to_bytes())
+    assert restored.count == 0 and restored.buckets == {}
+
+
+def test_encoded_sketches_keep_the_largest_within_the_limit():
+    by_label = {'big': filled_sketch(3), 'small': filled_sketch(4, 100)}
+    decoded = sketches.decode_sketches(sketches.encode_sketches(by_label))
+    assert decoded.keys() == by_label.keys()
+    assert decoded['small'].quantiles(QUANTILES) == by_label['small'].quantiles(QUANTILES)
+
+    limited = sketches.decode_sketches(sketches.encode_sketches(by_label, len(by_label['big'].to_bytes()) + 9))
+    assert list(limited) == ['big']
+
+
+def test_summary_quantiles_stay_within_min_and_max():
+    # A constant latency falls inside a bucket, whose estimate is above it
+    size = 2000
+    results = pd.DataFrame({'timeStamp': 1_700_000_000_000 + np.arange(size), 'elapsed': 1234, 'label': 'home',
+                            'responseCode': 200, 'success': True})
+    upload = FileStorage(io.BytesIO(results.to_csv(index=False).encode()), filename='run.csv')
+    summary = ingest.read_upload(upload)
+
+    assert QuantileSketch(0.01).merge(summary['sketches']['home']).quantile(0.99) != 1234
+    for statistics in [summary['overall'], summary['per_label'].loc['home']]:
+        assert [statistics[f'elapsed_{aggregation.percentile_name(q)}'] for q in QUANTILES] == [1234] * len(QUANTILES)
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import aggregation
+import constants
+import timeseries
+
+
+def results(seconds=120, rate=50, seed=0):
+    random = np.random.default_rng(seed)
+    size = seconds * rate
+    return pd.DataFrame({
+        'timeStamp': 1_700_000_000_000 + np.sort(random.integers(0, seconds * 1000, size)),
+        'elapsed': np.round(random.lognormal(5, 0.5, size)).astype('int64'),
+        'label': 'home',
+        'success': random.random(size) > 0.1,
+        'allThreads': random.integers(1, 50, size),
+    })
+
+
+def aggregate(contents, chunksize=None):
+    aggregator = aggregation.ResultsAggregator()
+    chunksize = chunksize or len(contents)
+    for start in range(0, len(contents), chunksize):
+        aggregator.update(contents.iloc[start:start + chunksize])
+    return aggregator.timeseries
+
+
+def test_lttb_keeps_the_ends_and_the_spike():
+    series = pd.DataFrame({'throughput': np.ones(100), 'p95': np.full(100, 200.0)}, index=np.arange(100) * 10)
+    series.iloc[37, 1] = 5000
+
+    kept = timeseries.lttb(series, 10)
+    assert len(kept) == 10
+    assert kept.index[0] == 0 and kept.index[-1] == 990
+    assert kept.index.is_monotonic_increasing
+    assert 370 in kept.index
+
+    assert timeseries.lttb(series, 100) is series
+    assert timeseries.lttb(series, 2).index.tolist() == [0, 990]
+    assert timeseries.lttb(series, 1).index.tolist() == [0]
+
+
+def test_windows_count_every_sample():
+    contents = results()
+    series = aggregation.summarize_results(contents)['timeseries'].series(10)
+    assert series['window'] == 10
+
+    frame = series['series']
+    seconds = (contents['timeStamp'] - contents['timeStamp'].min() // 10_000 * 10_000) // 10_000 * 10
+    np.testing.assert_allclose(frame['throughput'], seconds.value_counts().sort_index().to_numpy() / 10)
+    errors = (~contents['success']).groupby(seconds).mean() * 100
+    np.testing.assert_allclose(frame['error_rate'], errors.to_numpy())
+    assert frame['threads'].tolist() == contents['allThreads'].groupby(seconds).max().astype(float).tolist()
+
+    for window, p95 in zip(frame.index, frame['p95']):
+        elapsed = contents.loc[seconds == window, 'elapsed']
+        lower = np.quantile(elapsed, 0.95, method='lower') * (1 - constants.TIMESERIES_RELATIVE_ACCURACY)
+        higher = np.quantile(elapsed, 0.95, method='higher') * (1 + constants.TIMESERIES_RELATIVE_ACCURACY)
+        assert lower <= p95 <= higher
+
+
+def test_chunks_and_merges_match_a_single_pass():
+    contents = results()
+    single = aggregate(contents).series(1)['series']
+
+    pd.testing.assert_frame_equal(aggregate(contents, 1_000).series(1)['series'], single)
+    merged = aggregate(contents.iloc[:2_500]).merge(aggregate(contents.iloc[2_500:]))
+    pd.testing.assert_frame_equal(merged.series(1)['series'], single)
+
+
+def test_empty_windows_are_kept_in_the_series():
+    contents = results(seconds=30)
+    gap = results(seconds=30, seed=1)
+    gap['timeStamp'] += 60_000
+    frame = aggregate(pd.concat([contents, gap], ignore_index=True)).series(10)['series']
+
+    assert frame.index.tolist() == list(range(0, 90, 10))
+    assert frame.loc[[30, 40, 50], 'throughput'].tolist() == [0, 0, 0]
+    assert frame.loc[[30, 40, 50], 'p95'].isna().all()
+
+
+def test_long_tests_are_folded_into_wider_windows(monkeypatch):
+    monkeypatch.setattr(constants, 'TIMESERIES_MAX_WINDOWS', 50)
+    contents = results(seconds=600, rate=2)
+    aggregator = aggregate(contents, 100)
+
+    assert aggregator.width == 60
+    assert len(aggregator.windows) <= 50
+    assert aggregator.windows['count'].sum() == len(contents)
+    assert aggregator.series()['window'] >= 60
+    frame = pd.DataFrame({'timeStamp': contents['timeStamp'], 'elapsed': contents['elapsed'], 'error': False})
+    with pytest.raises(ValueError):
+        aggregator.merge(timeseries.TimeSeriesAggregator(0.05).update(frame))
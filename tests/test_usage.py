@@ -0,0 +1,105 @@
+from botocore.exceptions import EndpointConnectionError
+
+import constants
+
+
+def usage_items(utils, username):
+    response = utils.table.query(KeyConditionExpression=utils.Key('username').eq(username))
+    return response['Items']
+
+
+def test_completions_of_the_same_second_are_all_recorded(dynamodb):
+    writer = dynamodb.UsageWriter()
+    for openai_id in ['chatcmpl-1', 'chatcmpl-2', None, None]:
+        writer.add({'username': 'octocat', 'datetime': f'1679047200#{openai_id or dynamodb.uuid.uuid4().hex}',
+                    'open_id': openai_id, 'openai_prompt_tokens': 10, 'openai_completion_tokens': 5,
+                    'openai_total_tokens': 15})
+    writer.flush()
+
+    assert len(usage_items(dynamodb, 'octocat')) == 4
+    counters = dynamodb.table.get_item(Key={'username': constants.ANALYTICS_COUNTERS_KEY,
+                                            'datetime': constants.ANALYTICS_COUNTERS_KEY})['Item']
+    assert (counters['total_uploads'], counters['total_tokens'], counters['total_users']) == (2, 30, 1)
+
+
+def test_log_db_keys_records_by_completion(dynamodb, monkeypatch):
+    writer = dynamodb.UsageWriter()
+    monkeypatch.setattr(dynamodb, 'usage_writer', writer)
+    for openai_id in ['chatcmpl-1', 'chatcmpl-2']:
+        dynamodb.log_db('octocat', openai_id, 10, 5, 15, 1679047200)
+    writer.flush()
+
+    assert sorted(item['datetime'] for item in usage_items(dynamodb, 'octocat')) == [
+        '1679047200#chatcmpl-1', '1679047200#chatcmpl-2']
+
+
+def test_failed_batch_is_kept_for_the_next_flush(dynamodb, monkeypatch):
+    writer = dynamodb.UsageWriter()
+    writer.add({'username': 'octocat', 'datetime': '1679047200#chatcmpl-1', 'open_id': 'chatcmpl-1',
+                'openai_prompt_tokens': 10, 'openai_completion_tokens': 5, 'openai_total_tokens': 15})
+    write = dynamodb.dynamodb.batch_write_item
+
+    def unreachable(**kwargs):
+        raise EndpointConnectionError(endpoint_url='https://dynamodb.us-east-2.amazonaws.com/')
+
+    monkeypatch.setattr(dynamodb.dynamodb, 'batch_write_item', unreachable)
+    writer.flush()
+    assert len(writer.buffer) == 1 and not usage_items(dynamodb, 'octocat')
+
+    monkeypatch.setattr(dynamodb.dynamodb, 'batch_write_item', write)
+    writer.flush()
+    assert not writer.buffer and len(usage_items(dynamodb, 'octocat')) == 1
+
+
+def test_record_is_dropped_after_max_retries(dynamodb, monkeypatch):
+    writer = dynamodb.UsageWriter(max_retries=2)
+    writer.add({'username': 'octocat', 'datetime': '1679047200#chatcmpl-1', 'open_id': 'chatcmpl-1',
+                'openai_prompt_tokens': 10, 'openai_completion_tokens': 5, 'openai_total_tokens': 15})
+
+    def failing(**kwargs):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(dynamodb.dynamodb, 'batch_write_item', failing)
+    for _ in range(3):
+        writer.flush()
+    assert not writer.buffer and not writer.attempts
+
+
+def test_unprocessed_records_are_not_counted_until_written(dynamodb, monkeypatch):
+    writer = dynamodb.UsageWriter(max_retries=1)
+    monkeypatch.setattr(dynamodb.time, 'sleep', lambda seconds: None)
+    for openai_id in ['chatcmpl-1', 'chatcmpl-2']:
+        writer.add({'username': 'octocat', 'datetime': f'1679047200#{openai_id}', 'open_id': openai_id,
+                    'openai_prompt_tokens': 10, 'openai_completion_tokens': 5, 'openai_total_tokens': 15})
+    write = dynamodb.dynamodb.batch_write_item
+
+    def throttled(RequestItems):
+        # DynamoDB leaves the second record unprocessed on every attempt
+        requests = RequestItems[dynamodb.table.name]
+        kept = [request for request in requests if request['PutRequest']['Item']['open_id'] != 'chatcmpl-2']
+        if kept:
+            write(RequestItems={dynamodb.table.name: kept})
+        left = [request for request in requests if request not in kept]
+        return {'UnprocessedItems': {dynamodb.table.name: left} if left else {}}
+
+    monkeypatch.setattr(dynamodb.dynamodb, 'batch_write_item', throttled)
+    writer.flush()
+    counters = dynamodb.get_analytics_counters()
+    assert (counters['total_uploads'], counters['total_tokens']) == (1, 15)
+    assert [item['open_id'] for item in writer.buffer] == ['chatcmpl-2']
+
+    monkeypatch.setattr(dynamodb.dynamodb, 'batch_write_item', write)
+    writer.flush()
+    counters = dynamodb.get_analytics_counters()
+    assert (counters['total_uploads'], counters['total_tokens']) == (2, 30)
+
+
+def test_rebuild_analytics_counters_backfills_existing_records(dynamodb):
+    for username, openai_id in [('octocat', 'chatcmpl-1'), ('octocat', 'chatcmpl-2'), ('hubot', 'chatcmpl-3')]:
+        dynamodb.table.put_item(Item={'username': username, 'datetime': f'1679047200#{openai_id}',
+                                      'open_id': openai_id, 'openai_total_tokens': 15})
+    dynamodb.table.put_item(Item={'username': f'{constants.HISTORY_KEY_PREFIX}octocat', 'datetime': 'run#1'})
+
+    assert dynamodb.rebuild_analytics_counters() == {'total_users': 2, 'total_uploads': 3, 'total_tokens': 45}
+    assert dynamodb.get_total_users_count() == 2
+    assert dynamodb.get_upload_counts_all() == 3
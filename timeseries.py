@@ -0,0 +1,250 @@
+import html
+import json
+
+import numpy as np
+import pandas as pd
+
+import constants
+
+
+# Slots per window in the histogram keys, elapsed buckets of 1 ms up to gamma ** BUCKET_SLOTS ms
+BUCKET_SLOTS = 1024
+
+
+class TimeSeriesAggregator:
+    """
+    Per-window aggregates of a JTL over time, folded chunk by chunk.
+
+    Samples are binned by their timeStamp into windows of the finest width in constants.TIMESERIES_WINDOWS that
+    keeps the test under constants.TIMESERIES_MAX_WINDOWS windows. Every window holds its sample and error counts,
+    the most active threads and a log-bucketed histogram of elapsed, so windows merge into wider ones exactly.
+    """
+
+    def __init__(self, relative_accuracy=constants.TIMESERIES_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.width = constants.TIMESERIES_WINDOWS[0]
+        # Indexed by window start in epoch seconds
+        self.windows = None
+        # Sorted keys (window start * BUCKET_SLOTS + elapsed bucket) and their number of samples
+        self.keys = None
+        self.counts = None
+
+    def update(self, frame):
+        """
+        folds a chunk of samples into the windows
+        :param frame:   pandas DataFrame prepared by aggregation._prepare_frame, with timeStamp, elapsed and error
+        :return:        self
+        """
+        if 'timeStamp' not in frame.columns or 'elapsed' not in frame.columns:
+            return self
+        frame = frame[frame['timeStamp'].notna() & frame['elapsed'].notna()]
+        if frame.empty:
+            return self
+        starts = (frame['timeStamp'].to_numpy(dtype=float) // (self.width * 1000) * self.width).astype('int64')
+        windows = pd.DataFrame({'window': starts, 'error': frame['error'].to_numpy()})
+        aggregations = {'count': ('error', 'size'), 'errors': ('error', 'sum')}
+        if 'allThreads' in frame.columns:
+            windows['threads'] = frame['allThreads'].to_numpy(dtype=float)
+            aggregations['threads'] = ('threads', 'max')
+        partial = windows.groupby('window').agg(**aggregations).astype(float)
+        # Sub-millisecond samples are counted as 1 ms
+        buckets = np.ceil(np.log(np.clip(frame['elapsed'].to_numpy(dtype=float), 1, None)) / self.log_gamma)
+        keys = starts * BUCKET_SLOTS + np.minimum(buckets, BUCKET_SLOTS - 1).astype('int64')
+        self._merge(partial, *_sum_by_key(keys, np.ones(len(keys))))
+        self._coarsen()
+        return self
+
+    def merge(self, other):
+        """
+        merges the windows of another aggregator with the same accuracy into this one
+        :param other:   TimeSeriesAggregator
+        :return:        self
+        """
+        if other.windows is None:
+            return self
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge time series with a different relative accuracy.')
+        self.width = max(self.width, other.width)
+        if self.windows is not None:
+            self.windows, self.keys, self.counts = _rebin(self.windows, self.keys, self.counts, self.width)
+        self._merge(*_rebin(other.windows, other.keys, other.counts, self.width))
+        self._coarsen()
+        return self
+
+    def _merge(self, windows, keys, counts):
+        if self.windows is None:
+            self.windows, self.keys, self.counts = windows, keys, counts
+            return
+        left, right = self.windows.align(windows, join='outer')
+        merged = left[['count', 'errors']].fillna(0) + right[['count', 'errors']].fillna(0)
+        if 'threads' in left.columns:
+            merged['threads'] = np.fmax(left['threads'], right['threads'])
+        self.windows = merged
+        self.keys, self.counts = _sum_by_key(np.concatenate([self.keys, keys]), np.concatenate([self.counts, counts]))
+
+    def _coarsen(self):
+        # Wider windows once the test spans too many of them, e.g. a soak test read second by second
+        span = self.windows.index.max() - self.windows.index.min()
+        widest = constants.TIMESERIES_WINDOWS[-1]
+        while span / self.width >= constants.TIMESERIES_MAX_WINDOWS and self.width < widest:
+            self.width = next(width for width in constants.TIMESERIES_WINDOWS if width > self.width)
+            self.windows, self.keys, self.counts = _rebin(self.windows, self.keys, self.counts, self.width)
+
+    def window_width(self, points=None):
+        """
+        :param points:  number of points the series is downsampled to, wider windows are picked for fewer points
+        :return:        window width in seconds, constants.TIMESERIES_WINDOW if set, else the finest width holding
+                        constants.TIMESERIES_MIN_SAMPLES samples per window on average and, for a point budget, at
+                        most constants.TIMESERIES_WINDOWS_PER_POINT windows per point
+        """
+        if constants.TIMESERIES_WINDOW:
+            return max(constants.TIMESERIES_WINDOW, self.width)
+        samples = self.windows['count'].sum()
+        span = self.windows.index.max() - self.windows.index.min()
+        for width in constants.TIMESERIES_WINDOWS:
+            windows = span // width + 1
+            if (width >= self.width and samples / windows >= constants.TIMESERIES_MIN_SAMPLES and
+                    (points is None or windows <= points * constants.TIMESERIES_WINDOWS_PER_POINT)):
+                return width
+        return constants.TIMESERIES_WINDOWS[-1]
+
+    def series(self, width=None):
+        """
+        throughput, error rate, p95 and active threads per window, empty windows included
+        :param width:   window width in seconds, defaults to window_width()
+        :return:        dict with the window width in seconds and a pandas DataFrame indexed by the seconds since
+                        the start of the test
+        """
+        width = width or self.window_width()
+        windows, keys, counts = _rebin(self.windows, self.keys, self.counts, width)
+        start = windows.index.min()
+        windows = windows.reindex(np.arange(start, windows.index.max() + 1, width))
+
+        series = pd.DataFrame(index=pd.Index(windows.index - start, name='time'))
+        series['throughput'] = windows['count'].fillna(0).to_numpy() / width
+        with np.errstate(divide='ignore', invalid='ignore'):
+            series['error_rate'] = (windows['errors'] / windows['count'] * 100).to_numpy()
+        series['p95'] = self._quantiles(keys, counts, 0.95).reindex(windows.index).to_numpy()
+        if 'threads' in windows.columns:
+            series['threads'] = windows['threads'].to_numpy()
+        return {'window': width, 'series': series}
+
+    def _quantiles(self, keys, counts, q):
+        # Per window, the first bucket whose cumulative count within the window passes the rank of the quantile
+        windows = keys // BUCKET_SLOTS
+        firsts = np.flatnonzero(np.r_[True, windows[1:] != windows[:-1]])
+        sizes = np.diff(np.r_[firsts, len(keys)])
+        cumulative = np.cumsum(counts)
+        within = cumulative - np.repeat(cumulative[firsts] - counts[firsts], sizes)
+        rank = q * (np.repeat(np.add.reduceat(counts, firsts), sizes) - 1)
+        passed = np.flatnonzero(within > rank)
+        passed = passed[np.r_[True, windows[passed][1:] != windows[passed][:-1]]]
+        buckets = (keys[passed] % BUCKET_SLOTS).astype(float)
+        return pd.Series(2 * self.gamma ** buckets / (self.gamma + 1), index=windows[passed])
+
+
+def _sum_by_key(keys, counts):
+    """
+    :param keys:    histogram keys, in any order and repeated
+    :param counts:  samples of every key
+    :return:        tuple of the sorted distinct keys and their summed samples
+    """
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys))
+
+
+def _rebin(windows, keys, counts, width):
+    """
+    merges windows into wider ones
+    :param windows: per-window counts indexed by window start in epoch seconds
+    :param keys:    histogram keys
+    :param counts:  samples of every key
+    :param width:   new window width in seconds, a multiple of the current one
+    :return:        tuple of the rebinned windows, keys and counts
+    """
+    aggregations = {'count': 'sum', 'errors': 'sum'}
+    if 'threads' in windows.columns:
+        aggregations['threads'] = 'max'
+    windows = windows.groupby(windows.index // width * width).agg(aggregations)
+    keys = keys // BUCKET_SLOTS // width * width * BUCKET_SLOTS + keys % BUCKET_SLOTS
+    return (windows, *_sum_by_key(keys, counts))
+
+
+def lttb(series, points):
+    """
+    downsamples a series with Largest-Triangle-Three-Buckets, keeping the points that shape it the most
+    every column is scaled to [0, 1] and a point's triangle area is summed over columns, so the same rows are kept
+    for all of them
+    :param series:  pandas DataFrame indexed by a numeric, increasing x
+    :param points:  number of rows to keep
+    :return:        the kept rows, the first and last ones included
+    """
+    n = len(series)
+    if points >= n:
+        return series
+    if points < 3:
+        return series.iloc[[0, n - 1][:points]]
+    x = series.index.to_numpy(dtype=float)
+    # Windows without samples have no error rate or p95, they count as zero
+    values = np.nan_to_num(series.to_numpy(dtype=float))
+    low, high = values.min(axis=0), values.max(axis=0)
+    y = (values - low) / np.where(high > low, high - low, 1)
+
+    # points - 2 buckets between the first and the last row
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    kept = [0]
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket == points - 3:
+            next_x, next_y = x[n - 1], y[n - 1]
+        else:
+            next_x, next_y = x[end:edges[bucket + 2]].mean(), y[end:edges[bucket + 2]].mean(axis=0)
+        previous = kept[-1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end])[:, None] * (next_y - y[previous])).sum(axis=1)
+        kept.append(start + int(np.argmax(areas)))
+    kept.append(n - 1)
+    return series.iloc[kept]
+
+
+def _rounded(series):
+    series = series.round({'throughput': 1, 'error_rate': 1})
+    for column in ['p95', 'threads']:
+        if column in series.columns:
+            series[column] = series[column].round().astype('Int64')
+    return series
+
+
+def format_series(aggregator, points=constants.TIMESERIES_PROMPT_POINTS):
+    """
+    renders the series over time as compact text for the prompt
+    :param aggregator:  TimeSeriesAggregator holding samples
+    :param points:      number of windows kept by LTTB
+    :return:            series text
+    """
+    timeseries = aggregator.series(aggregator.window_width(points))
+    series = timeseries['series']
+    kept = lttb(series, points)
+    note = f', {len(kept)} of {len(series)} kept by LTTB' if len(kept) < len(series) else ''
+    title = (f"Over time ({timeseries['window']} s windows{note}; time in s from the start, throughput in "
+             f"requests/sec, error rate in %, p95 of elapsed in ms" +
+             (", active threads" if 'threads' in series.columns else '') + '):')
+    return f'{title}\n' + _rounded(kept).to_csv(na_rep='-').strip()
+
+
+def chart_html(aggregator, points=constants.TIMESERIES_CHART_POINTS):
+    """
+    canvas drawn by the charts script of upload.html
+    :param aggregator:  TimeSeriesAggregator holding samples
+    :param points:      number of windows kept by LTTB
+    :return:            HTML text
+    """
+    timeseries = aggregator.series(aggregator.window_width(points))
+    kept = _rounded(lttb(timeseries['series'], points))
+    data = {'window': timeseries['window'], 'time': kept.index.tolist()}
+    for column in kept.columns:
+        data[column] = [None if pd.isna(value) else float(value) for value in kept[column]]
+    return (f'<canvas class="timeseries-chart" height="110" data-series="{html.escape(json.dumps(data))}">'
+            f'</canvas><p class="text-muted small">{timeseries["window"]} s windows</p>')
@@ -0,0 +1,64 @@
+import logging
+import math
+
+import constants
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Without tiktoken the tokens are estimated from the length: numbers and CSV run at 2 to 3 characters per token,
+# the estimate takes the low end with a safety margin so that the prompt never overflows the context window
+CHARS_PER_TOKEN = 2
+ESTIMATE_MARGIN = 1.25
+
+_encodings = {}
+
+
+def _encoding(model):
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logging.error(f"No tokenizer known for {model}, using cl100k_base.")
+                _encodings[model] = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # The encodings are downloaded on first use, the length estimate is used if they cannot be
+            logging.error(f"Could not load the tokenizer of {model}, estimating tokens from the length: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def estimate_tokens(text):
+    """
+    :param text:    text to count
+    :return:        upper estimate of its number of tokens, from its length
+    """
+    return math.ceil(len(f"{text}") / CHARS_PER_TOKEN * ESTIMATE_MARGIN)
+
+
+def count_tokens(text, model=constants.openai_model):
+    """
+    counts the tokens of a text locally
+    :param text:    text to count
+    :param model:   OpenAI model the text is sent to
+    :return:        number of tokens, estimated from the length if tiktoken is not installed
+    """
+    text = f"{text}"
+    encoding = _encoding(model) if tiktoken is not None else None
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model=constants.openai_model):
+    """
+    counts the prompt tokens of chat messages, including the per message overhead
+    :param messages:    list of chat messages
+    :param model:       OpenAI model the messages are sent to
+    :return:            number of prompt tokens
+    """
+    # Every message is wrapped in 3 tokens, and the reply is primed with 3 more
+    return sum(3 + count_tokens(message['content'], model) for message in messages) + 3
@@ -1,45 +1,68 @@
+import atexit
+import hashlib
 import json
 import logging
 import os
 import re
+import threading
+import time
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 import boto3
 import requests
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from flask import g, has_request_context, session
 from flask_dance.contrib.github import github
 from sentry_sdk import capture_exception
 
+import comparison
 import constants
+import metrics
 import secrets_client
+import sketches
+import startup
+from cache import StaleWhileRevalidateCache, TTLCache
 from secrets_client import STSCredentials
 
 logging.basicConfig(level=logging.INFO)
 
-sts_client = boto3.client('sts',
-                          region_name=constants.AWS_DEFAULT_REGION,
-                          aws_access_key_id=os.environ['AWS_DYNAMODB_KEY'],
-                          aws_secret_access_key=os.environ['AWS_DYNAMODB_SECRET']
-                          )
+# Built on first use, importing this module makes no AWS client
+sts_client = startup.LazyClient(lambda: boto3.client('sts',
+                                                     region_name=constants.AWS_DEFAULT_REGION,
+                                                     aws_access_key_id=os.environ['AWS_DYNAMODB_KEY'],
+                                                     aws_secret_access_key=os.environ['AWS_DYNAMODB_SECRET']
+                                                     ))
 sts_credentials = STSCredentials(os.environ['ARN'])
 
 dynamodb = None
 table = None
 settings_table = None
+# Access key of the STS credentials the DynamoDB resource was built with, and the process it belongs to
+dynamodb_access_key = None
+dynamodb_pid = None
+dynamodb_lock = threading.Lock()
+# Users already recorded in the analytics user index by this process
+known_users = set()
 
 
 def load_env_vars(application):
-    global sts_credentials, dynamodb, table, settings_table
+    """
+    loads the configuration, DynamoDB and the other connections are warmed up separately by warm_dynamodb
+    :param application: Flask application
+    :return:            dict of the loaded variables
+    """
     load_dotenv()
     _vars = {}
     _vars['ARN'] = os.environ['ARN']
     sts_credentials.set_arn(_vars['ARN'])
-    credentials = sts_credentials.get_credentials(sts_client)
-
-    dynamodb = init_dynamodb()
+    # Bearer token required by /metrics, which is only served to localhost when it is not set
+    _vars['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
 
     if os.getenv('FLASK_ENV') == "development":
         application.secret_key = os.environ['FLASK_SECRET_KEY']
@@ -53,6 +76,12 @@ def load_env_vars(application):
     elif os.getenv('FLASK_ENV') == "production":
 
         application.secret_key = os.environ['FLASK_SECRET_KEY']
+        credentials = sts_credentials.get_credentials(sts_client)
+        # Fetch every secret in one pass while the DynamoDB client is built, the lookups below are then served
+        # from memory
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(init_dynamodb)
+            secrets_client.prefetch_secrets(constants.PRODUCTION_SECRETS, constants.AWS_DEFAULT_REGION, credentials)
         application.config["GITHUB_OAUTH_CLIENT_ID"] = secrets_client.get_secret('GITHUB_OAUTH_CLIENT_ID',
                                                                                  constants.AWS_DEFAULT_REGION,
                                                                                  credentials)
@@ -76,29 +105,42 @@ def load_env_vars(application):
     else:
         logging.error("No environment exists.")
         exit(1)
-    sts_credentials = STSCredentials(os.environ['ARN'])
     return _vars
 
 
 def print_exceptions(e):
-    logging.error("Exception occurred on line:", traceback.format_exc().split("\n"))
+    logging.error("Exception occurred on line: %s", traceback.format_exc().split("\n"))
 
 
 def init_dynamodb():
-    global dynamodb, sts_credentials, table, settings_table
+    """
+    returns the process wide DynamoDB resource, rebuilt only when the STS credentials are rotated
+    a forked worker builds its own, its connections cannot be shared with the parent
+    :return:    boto3 DynamoDB resource
+    """
+    global dynamodb, table, settings_table, dynamodb_access_key, dynamodb_pid
     try:
-
         credentials = sts_credentials.get_credentials(sts_client)
-
-        session = boto3.Session(
-            aws_access_key_id=credentials['AccessKeyId'],
-            aws_secret_access_key=credentials['SecretAccessKey'],
-            aws_session_token=credentials['SessionToken']
-        )
-        dynamodb = session.resource('dynamodb',
-                                    region_name=constants.AWS_DEFAULT_REGION)
-        table = dynamodb.Table(os.environ['DYNAMODB_PERFGPT_TABLE'])
-        settings_table = dynamodb.Table(os.environ['DYNAMODB_SETTINGS_TABLE'])
+        current = (credentials['AccessKeyId'], os.getpid())
+        if dynamodb is not None and (dynamodb_access_key, dynamodb_pid) == current:
+            return dynamodb
+
+        with dynamodb_lock:
+            if dynamodb is None or (dynamodb_access_key, dynamodb_pid) != current:
+                session = boto3.Session(
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken']
+                )
+                resource = session.resource('dynamodb',
+                                            region_name=constants.AWS_DEFAULT_REGION,
+                                            config=Config(max_pool_connections=constants.DYNAMODB_MAX_POOL_CONNECTIONS,
+                                                          tcp_keepalive=True))
+                metrics.instrument_dynamodb(resource.meta.client)
+                table = resource.Table(os.environ['DYNAMODB_PERFGPT_TABLE'])
+                settings_table = resource.Table(os.environ['DYNAMODB_SETTINGS_TABLE'])
+                dynamodb = resource
+                dynamodb_access_key, dynamodb_pid = current
 
         return dynamodb
     except Exception as e:
@@ -107,6 +149,69 @@ def init_dynamodb():
         logging.error(e)
 
 
+def warm_dynamodb():
+    """
+    opens the DynamoDB connections of this process with a read of each table, so the first request does not
+    pay for the STS call and the TLS handshakes
+    :return:    None
+    """
+    if init_dynamodb() is None:
+        raise RuntimeError("Could not connect to DynamoDB.")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        usage = executor.submit(table.get_item, Key={'username': constants.READINESS_PROBE_KEY, 'datetime': '0'})
+        settings = executor.submit(settings_table.get_item, Key={'username': constants.READINESS_PROBE_KEY})
+        usage.result()
+        settings.result()
+
+
+class UserSettings:
+    """
+    Settings row of a user, loaded with a single get_item
+    """
+
+    def __init__(self, username, item=None):
+        item = item or {}
+        self.username = username
+        self.exists = 'username' in item
+        self.upload_quota = int(item.get('initial_upload_quota', 0))
+        self.slack_webhook = item.get('slack_webhook')
+        self.send_notifications = item.get('send_notifications')
+
+
+user_settings_cache = TTLCache(constants.USER_SETTINGS_CACHE_SIZE, constants.USER_SETTINGS_TTL)
+
+
+def get_user_settings(username):
+    """
+    loads the settings of the user, cached for constants.USER_SETTINGS_TTL
+    :param username:    username
+    :return:            UserSettings, or None if the settings table cannot be read
+    """
+    settings = user_settings_cache.get(username)
+    if settings is not None:
+        return settings
+    try:
+        init_dynamodb()
+        db_response = settings_table.get_item(Key={'username': username})
+        settings = UserSettings(username, db_response.get('Item'))
+        user_settings_cache.set(username, settings)
+        return settings
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
+
+
+def invalidate_user_settings(username):
+    """
+    drops the cached settings of the user after a write
+    :param username:    username
+    :return:            None
+    """
+    user_settings_cache.delete(username)
+
+
 def update_slack_db(username, slack_webhook=None, send_notifications=None):
     """
 
@@ -129,6 +234,7 @@ def update_slack_db(username, slack_webhook=None, send_notifications=None):
             ExpressionAttributeValues={':val1': new_attributes['slack_webhook'],
                                        ':val2': new_attributes['send_notifications']}
         )
+        invalidate_user_settings(username)
 
         if (db_response['ResponseMetadata']['HTTPStatusCode']) == 200:
             db_status = "success"
@@ -161,6 +267,7 @@ def update_upload_count(username, upload_count):
                 ':val1': upload_count
             }
         )
+        invalidate_user_settings(username)
         return upload_count
     except ClientError as e:
         print_exceptions(e)
@@ -172,31 +279,92 @@ def update_upload_count(username, upload_count):
             capture_exception(e)
 
 
-def check_user_in_settings_db(username):
+class QuotaExceededError(Exception):
+    """Raised when a user has no upload credit left."""
+
+
+def ensure_user_settings(username):
     """
+    creates the settings of a new user with the initial upload quota, in a single idempotent update
+    :param username:    username
+    :return:            UserSettings, or None if the settings table cannot be written
+    """
+    try:
+        init_dynamodb()
+        db_response = settings_table.update_item(
+            Key={'username': username},
+            UpdateExpression='SET initial_upload_quota = if_not_exists(initial_upload_quota, :quota)',
+            ExpressionAttributeValues={':quota': constants.upload_quota},
+            ReturnValues='ALL_NEW'
+        )
+        settings = UserSettings(username, db_response['Attributes'])
+        user_settings_cache.set(username, settings)
+        return settings
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
 
+
+def reserve_upload_credit(username):
+    """
+    atomically takes one upload credit, if the balance is positive, creating new users with the initial quota
     :param username:    username
-    :return:            True if new user signs up in the db, else False
+    :raises QuotaExceededError: no upload credit left
+    :return:            uploads left after this one
     """
     try:
         init_dynamodb()
-        db_response = settings_table.get_item(
-            Key={
-                "username": username
-            }
+        db_response = settings_table.update_item(
+            Key={'username': username},
+            UpdateExpression='SET initial_upload_quota = if_not_exists(initial_upload_quota, :quota) - :one',
+            ConditionExpression='attribute_not_exists(initial_upload_quota) OR initial_upload_quota > :zero',
+            ExpressionAttributeValues={':quota': constants.upload_quota, ':one': 1, ':zero': 0},
+            ReturnValues='UPDATED_NEW'
         )
-        if 'Item' in db_response and 'username' in db_response['Item']:
-            return False
-        return True
+        return int(db_response['Attributes']['initial_upload_quota'])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise QuotaExceededError("You do not have enough credits. Please wait for the next month credit or "
+                                     "upgrade now.")
+        raise
+    finally:
+        invalidate_user_settings(username)
+
 
+def refund_upload_credit(username):
+    """
+    gives back an upload credit reserved with reserve_upload_credit
+    :param username:    username
+    :return:            uploads left
+    """
+    try:
+        init_dynamodb()
+        db_response = settings_table.update_item(
+            Key={'username': username},
+            UpdateExpression='ADD initial_upload_quota :one',
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        invalidate_user_settings(username)
+        return int(db_response['Attributes']['initial_upload_quota'])
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
-            print("The security token has expired. Please refresh your token.")
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
 
-        else:
-            print(f"An error occurred: {e}")
-            capture_exception(e)
+
+def check_user_in_settings_db(username):
+    """
+
+    :param username:    username
+    :return:            True if new user signs up in the db, else False
+    """
+    settings = get_user_settings(username)
+    if settings is not None:
+        return not settings.exists
 
 
 # def log_settings_db(username, initial_upload_quota=None):
@@ -227,7 +395,7 @@ def check_user_in_settings_db(username):
 def log_db(username, openai_id=None, openai_prompt_tokens=None, openai_completion_tokens=None, openai_total_tokens=None,
            openai_created=None):
     """
-
+    queues a usage record, written in batches by usage_writer
     :param username:
     :param openai_id:
     :param openai_prompt_tokens:
@@ -236,18 +404,160 @@ def log_db(username, openai_id=None, openai_prompt_tokens=None, openai_completio
     :param openai_created:
     :return:
     """
+    usage_writer.add({
+        "username": username,
+        # Several completions of a user are created in the same second, the id keeps their records apart
+        "datetime": f"{openai_created}#{openai_id or uuid.uuid4().hex}",
+        "open_id": openai_id,
+        "openai_prompt_tokens": openai_prompt_tokens,
+        "openai_completion_tokens": openai_completion_tokens,
+        "openai_total_tokens": openai_total_tokens,
+    })
+
+
+class UsageWriter:
+    """
+    Buffers usage records in memory and writes them with batch_write_item once the buffer is full,
+    on a timer, and at shutdown.
+    """
+
+    def __init__(self, batch_size=constants.USAGE_BATCH_SIZE, interval=constants.USAGE_FLUSH_INTERVAL,
+                 max_retries=constants.USAGE_MAX_RETRIES):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self.buffer = []
+        # Failed writes of the records put back in the buffer, by key
+        self.attempts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+
+    def add(self, item):
+        """
+        :param item:    usage record
+        :return:        None
+        """
+        with self._lock:
+            self.buffer.append(item)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._worker.start()
+            if len(self.buffer) >= self.batch_size:
+                self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Usage records flush failed: {e}")
+                capture_exception(e)
+
+    def flush(self):
+        """
+        writes all the buffered records
+        :return:    None
+        """
+        with self._flush_lock:
+            with self._lock:
+                items, self.buffer = self.buffer, []
+            for start in range(0, len(items), constants.USAGE_BATCH_SIZE):
+                self._write(items[start:start + constants.USAGE_BATCH_SIZE])
+
+    def _requeue(self, items):
+        """
+        puts records that could not be written back in the buffer, for the next flush
+        a record failing more than max_retries flushes is dropped and logged
+        :param items:   usage records
+        :return:        None
+        """
+        kept = []
+        for item in items:
+            key = (item['username'], item['datetime'])
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] > self.max_retries:
+                logging.error(f"Dropping usage record after {self.max_retries} failed flushes: {item}")
+                del self.attempts[key]
+            else:
+                kept.append(item)
+        with self._lock:
+            self.buffer[:0] = kept
+
+    def _write(self, items):
+        # A batch may not hold the same key twice, only a record added twice has the same key
+        unique = list({(item['username'], item['datetime']): item for item in items}.values())
+        pending = unique
+        try:
+            init_dynamodb()
+            for attempt in range(self.max_retries + 1):
+                response = dynamodb.batch_write_item(
+                    RequestItems={table.name: [{'PutRequest': {'Item': item}} for item in pending]})
+                pending = [request['PutRequest']['Item']
+                           for request in response.get('UnprocessedItems', {}).get(table.name, [])]
+                if not pending:
+                    break
+                time.sleep(constants.USAGE_RETRY_BACKOFF * 2 ** attempt)
+            unwritten = {(item['username'], item['datetime']) for item in pending}
+            written = [item for item in unique if (item['username'], item['datetime']) not in unwritten]
+            if pending:
+                logging.error(f"Could not write {len(pending)} usage records, they are retried on the next flush.")
+                self._requeue(pending)
+        except Exception as e:
+            print_exceptions(e)
+            if isinstance(e, ClientError) and e.response['Error']['Code'] == 'ExpiredTokenException':
+                logging.error("The security token has expired. Please refresh your token.")
+            capture_exception(e)
+            self._requeue(pending)
+            return
+        for item in written:
+            self.attempts.pop((item['username'], item['datetime']), None)
+        try:
+            # Only the stored records are counted, the unwritten ones are counted once a later flush stores them
+            if written:
+                record_analytics(written)
+        except Exception as e:
+            logging.error(f"Could not update the analytics counters: {e}")
+            capture_exception(e)
+
+
+usage_writer = UsageWriter()
+atexit.register(usage_writer.flush)
+
+
+def record_analytics(items):
+    """
+    atomically updates the global analytics counters for a batch of usage records
+    distinct users are tracked with one marker item per user, written only if it does not exist yet
+    :param items:   usage records
+    :return:
+    """
     try:
         init_dynamodb()
-        db_response = table.put_item(
-            Item={
-                "username": username,
-                "datetime": str(openai_created),
-                "open_id": openai_id,
-                "openai_prompt_tokens": openai_prompt_tokens,
-                "openai_completion_tokens": openai_completion_tokens,
-                "openai_total_tokens": openai_total_tokens,
-            }
-        )
+        new_users = 0
+        for username in {item['username'] for item in items} - known_users:
+            try:
+                table.put_item(
+                    Item={"username": constants.ANALYTICS_USERS_KEY, "datetime": username},
+                    ConditionExpression='attribute_not_exists(username)'
+                )
+                new_users += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            known_users.add(username)
+
+        completions = [item for item in items if item['open_id'] is not None]
+        if new_users or completions:
+            table.update_item(
+                Key={"username": constants.ANALYTICS_COUNTERS_KEY, "datetime": constants.ANALYTICS_COUNTERS_KEY},
+                UpdateExpression='ADD total_users :users, total_uploads :uploads, total_tokens :tokens',
+                ExpressionAttributeValues={':users': new_users, ':uploads': len(completions),
+                                           ':tokens': sum(item['openai_total_tokens'] or 0 for item in completions)}
+            )
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
@@ -255,6 +565,56 @@ def log_db(username, openai_id=None, openai_prompt_tokens=None, openai_completio
         capture_exception(e)
 
 
+def rebuild_analytics_counters():
+    """
+    recomputes the analytics counters and the user markers with a full, paginated scan of the usage table
+    only needed once to backfill existing data, concurrent usage records may be missed while it runs
+    :return:    the rebuilt counters
+    """
+    init_dynamodb()
+    users = set()
+    openai_ids = set()
+    total_tokens = Decimal('0')
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response['Items']:
+            # Analytics counters, the users index and run histories, GitHub logins never contain '#'
+            if item['username'].startswith('#'):
+                continue
+            users.add(item['username'])
+            if item.get('open_id') is not None:
+                openai_ids.add(item['open_id'])
+                total_tokens += item.get('openai_total_tokens') or 0
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    with table.batch_writer(overwrite_by_pkeys=['username', 'datetime']) as batch:
+        for username in users:
+            batch.put_item(Item={"username": constants.ANALYTICS_USERS_KEY, "datetime": username})
+    counters = {'total_users': len(users), 'total_uploads': len(openai_ids), 'total_tokens': total_tokens}
+    table.put_item(Item={"username": constants.ANALYTICS_COUNTERS_KEY, "datetime": constants.ANALYTICS_COUNTERS_KEY,
+                         **counters})
+    known_users.update(users)
+    return counters
+
+
+def get_analytics_counters():
+    """
+
+    :return:    the global analytics counters, read from a single item
+    """
+    init_dynamodb()
+    response = table.get_item(
+        Key={"username": constants.ANALYTICS_COUNTERS_KEY, "datetime": constants.ANALYTICS_COUNTERS_KEY}
+    )
+    item = response.get('Item', {})
+    return {'total_users': int(item.get('total_users', 0)),
+            'total_uploads': int(item.get('total_uploads', 0)),
+            'total_tokens': item.get('total_tokens', Decimal('0'))}
+
+
 def insert_initial_upload_quota_db(username):
     try:
         init_dynamodb()
@@ -265,6 +625,7 @@ def insert_initial_upload_quota_db(username):
                 "initial_upload_quota": constants.upload_quota
             }
         )
+        invalidate_user_settings(username)
 
     except ClientError as e:
         print_exceptions(e)
@@ -282,16 +643,53 @@ def get_upload_count(username):
     :param username:    username
     :return:            returns the upload count of the user
     """
+    settings = get_user_settings(username)
+    if settings is not None:
+        return settings.upload_quota
+
+
+def check_authorized_status():
+    """
+
+    :return:    checks the authorized status, then returns boolean
+    """
+    if github.authorized:
+        username = get_username()
+        return {'logged_in': True, 'username': username, 'upload_status': 1}
+    else:
+        return {'logged_in': False, 'username': None, 'upload_status': 0}
+
+
+def _run_from_item(item):
+    return {'run_id': item.get('run_id', item['datetime']), 'test_name': item['test_name'], 'created': item['created'],
+            'samples': int(item['samples']), 'verdict': item.get('verdict'), 'baseline': item.get('baseline'),
+            'digest': item.get('digest'),
+            'labels': comparison.decode_labels(item['labels']) if 'labels' in item else None,
+            'sketches': sketches.decode_sketches(item['sketches'].value) if 'sketches' in item else {}}
+
+
+def save_run(username, run):
+    """
+    stores the compact per-label aggregate and elapsed sketches of an analyzed run in the run history of the user
+    :param username:    username
+    :param run:         run record from comparison.make_run, with the verdict and baseline run id if compared
+    :return:            None
+    """
     try:
         init_dynamodb()
-        total_count = 0
-        key = {'username': username}
-        # response = settings_table.query(KeyConditionExpression=Key('username').eq(username))
-        response = settings_table.get_item(Key=key)
-        if 'Item' in response and 'initial_upload_quota' in response['Item']:
-            total_count = response['Item']['initial_upload_quota']
-            return int(total_count)
-        return int(total_count)
+        item = {"username": f"{constants.HISTORY_KEY_PREFIX}{username}", "datetime": run['run_id'],
+                "test_name": run['test_name'], "created": run['created'], "samples": run['samples'],
+                "labels": comparison.encode_labels(run['labels']),
+                "sketches": sketches.encode_sketches(run['sketches'], constants.HISTORY_SKETCH_BYTES)}
+        if run.get('verdict') is not None:
+            item.update(verdict=run['verdict'], baseline=run['baseline'])
+        if run.get('digest') is not None:
+            item['digest'] = run['digest']
+        table.put_item(Item=item)
+        entry = {key: value for key, value in item.items() if key not in ['labels', 'sketches', 'digest']}
+        entry.update(username=f"{constants.HISTORY_INDEX_PREFIX}{username}",
+                     datetime=f"{run['created']}#{run['test_name']}", run_id=run['run_id'])
+        table.put_item(Item=entry)
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
@@ -299,30 +697,91 @@ def get_upload_count(username):
         capture_exception(e)
 
 
-def check_authorized_status():
+def get_run(username, run_id):
     """
+    :param username:    username
+    :param run_id:      run id, the test name and creation time of the run
+    :return:            run record, or None if the user has no such run
+    """
+    try:
+        init_dynamodb()
+        response = table.get_item(Key={"username": f"{constants.HISTORY_KEY_PREFIX}{username}", "datetime": run_id})
+        return _run_from_item(response['Item']) if 'Item' in response else None
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
 
-    :return:    checks the authorized status, then returns boolean
+
+def get_latest_run(username, test_name):
     """
-    if github.authorized:
-        resp = github.get("/user")
-        username = resp.json()["login"]
-        return {'logged_in': True, 'username': username, 'upload_status': 1}
-    else:
-        return {'logged_in': False, 'username': None, 'upload_status': 0}
+    :param username:    username
+    :param test_name:   test name
+    :return:            the latest run of the test, or None if the user never ran it
+    """
+    # Run ids sort by test name, then by creation time
+    condition = (Key('username').eq(f"{constants.HISTORY_KEY_PREFIX}{username}") &
+                 Key('datetime').begins_with(f"{test_name}#"))
+    try:
+        init_dynamodb()
+        response = table.query(KeyConditionExpression=condition, ScanIndexForward=False, Limit=1)
+        return _run_from_item(response['Items'][0]) if response['Items'] else None
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
 
 
-def get_analysis(username):
-    # response = table.query(KeyConditionExpression=Key('username').eq(username))
-    # total_count = response['Count']
-    # print(json.dumps(response['Items']))
-    # for i, j in json.dumps(response['Items']).items():
-    # print(i, j)
-    # pass
+def get_analysis(username, limit=constants.HISTORY_PAGE_SIZE):
+    """
+    run history of the user, newest first, without the per-label tables
+    :param username:    username
+    :param limit:       number of runs
+    :return:            list of run records
+    """
+    try:
+        init_dynamodb()
+        # The index items sort by creation time and only hold the fields listed here
+        response = table.query(KeyConditionExpression=Key('username').eq(
+            f"{constants.HISTORY_INDEX_PREFIX}{username}"), ScanIndexForward=False, Limit=limit)
+        return [_run_from_item(item) for item in response['Items']]
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
+        return []
 
-    # for k,v in response.items():
-    #     print(k, type(k), v, type(v))
-    pass
+
+def delete_run_history(username):
+    """
+    deletes every run of the user, with the per-label statistics and sketches kept for comparisons
+    :param username:    username
+    :return:            number of runs deleted, or None if the deletion failed
+    """
+    deleted = 0
+    try:
+        init_dynamodb()
+        with table.batch_writer() as batch:
+            for prefix in [constants.HISTORY_KEY_PREFIX, constants.HISTORY_INDEX_PREFIX]:
+                query_kwargs = {'KeyConditionExpression': Key('username').eq(f"{prefix}{username}"),
+                                'ProjectionExpression': '#run', 'ExpressionAttributeNames': {'#run': 'datetime'}}
+                while True:
+                    response = table.query(**query_kwargs)
+                    for item in response['Items']:
+                        batch.delete_item(Key={"username": f"{prefix}{username}", "datetime": item['datetime']})
+                        deleted += prefix == constants.HISTORY_KEY_PREFIX
+                    if 'LastEvaluatedKey' not in response:
+                        break
+                    query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return deleted
+    except ClientError as e:
+        print_exceptions(e)
+        if e.response['Error']['Code'] == 'ExpiredTokenException':
+            logging.error("The security token has expired. Please refresh your token.")
+        capture_exception(e)
 
 
 def beautify_response(text):
@@ -342,15 +801,36 @@ def beautify_response(text):
     return text
 
 
-def get_username():
+def _github_token_fingerprint():
+    """
+
+    :return:    hash of the current GitHub access token, to tie the cached identity to it
     """
+    token = github.token or {}
+    return hashlib.sha256(str(token.get('access_token')).encode('utf-8')).hexdigest()
 
+
+def get_username():
+    """
+    resolves the GitHub login once per request, and caches it in the session for constants.GITHUB_IDENTITY_TTL
     :return:    return the username if logged in
     """
+    if has_request_context() and g.get('github_username'):
+        return g.github_username
+
     username = None
     try:
-        resp = github.get("/user")
-        username = resp.json()["login"]
+        fingerprint = _github_token_fingerprint()
+        cached = session.get('github_identity')
+        if cached and cached['token'] == fingerprint and cached['expires'] > time.time():
+            username = cached['login']
+        else:
+            with metrics.timed('github', 'user'):
+                resp = github.get("/user")
+            username = resp.json()["login"]
+            session['github_identity'] = {'login': username, 'token': fingerprint,
+                                          'expires': time.time() + constants.GITHUB_IDENTITY_TTL}
+        g.github_username = username
         return username
     except Exception as e:
         print_exceptions(e)
@@ -363,20 +843,9 @@ def get_webhook():
     get the saved webhook
     :return:
     """
-    try:
-        init_dynamodb()
-        response = settings_table.query(KeyConditionExpression=Key('username').eq(get_username()))
-        if response['Items']:
-            if 'slack_webhook' in response['Items'][0]:
-                return response['Items'][0]['slack_webhook']
-            else:
-                return None
-
-    except ClientError as e:
-        print_exceptions(e)
-        if e.response['Error']['Code'] == 'ExpiredTokenException':
-            logging.error("The security token has expired. Please refresh your token.")
-        capture_exception(e)
+    settings = get_user_settings(get_username())
+    if settings is not None:
+        return settings.slack_webhook
 
 
 def save_webhook_url(integration_type=None, webhook_url=None):
@@ -395,12 +864,7 @@ def get_total_users_count():
     :return:    total users count
     """
     try:
-        init_dynamodb()
-        response = table.scan()
-        users = set()
-        for item in response['Items']:
-            users.add(item['username'])
-        return len(users)
+        return get_analytics_counters()['total_users']
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
@@ -414,13 +878,7 @@ def get_upload_counts_all():
     :return:    count of open_id count
     """
     try:
-        init_dynamodb()
-        response = table.scan()
-        unique_openids = set()
-        for item in response['Items']:
-            unique_openids.add(item['open_id'])
-
-        return len(unique_openids)
+        return get_analytics_counters()['total_uploads']
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
@@ -434,18 +892,7 @@ def get_total_tokens_all():
     :return:    count of all the tokens from all the users
     """
     try:
-        init_dynamodb()
-        response = table.scan()
-        openai_total_tokens = set()
-        for item in response['Items']:
-            openai_total_tokens.add(item['openai_total_tokens'])
-
-        total_tokens = Decimal('0')
-        for item in openai_total_tokens:
-            if item is not None:
-                total_tokens += item
-
-        return total_tokens
+        return get_analytics_counters()['total_tokens']
     except ClientError as e:
         print_exceptions(e)
         if e.response['Error']['Code'] == 'ExpiredTokenException':
@@ -461,35 +908,27 @@ def get_slack_notification_status():
 
     :return:    the Slack notifications status true or false
     """
-    try:
-        init_dynamodb()
-        response = settings_table.query(KeyConditionExpression=Key('username').eq(get_username()))
-        if response['Items']:
-            if 'send_notifications' in response['Items'][0]:
-                return response['Items'][0]['send_notifications']
-            else:
-                return None
-    except ClientError as e:
-        print_exceptions(e)
-        if e.response['Error']['Code'] == 'ExpiredTokenException':
-            logging.error("The security token has expired. Please refresh your token.")
-        capture_exception(e)
+    settings = get_user_settings(get_username())
+    if settings is not None:
+        return settings.send_notifications
 
 
-def get_analytics_data():
+def fetch_analytics_data():
     """
 
-    :return:    get analytics data from dynamodb
+    :return:    get analytics data from the analytics gateway
     """
     try:
         init_dynamodb()
         credentials = sts_credentials.get_credentials(sts_client)
         if os.getenv('FLASK_ENV') == "development":
-            get_analytics = requests.get(os.environ['AWS_GATEWAY_URL']).text
+            get_analytics = requests.get(os.environ['AWS_GATEWAY_URL'],
+                                         timeout=constants.ANALYTICS_REQUEST_TIMEOUT).text
         elif os.getenv('FLASK_ENV') == "production":
             get_analytics = requests.get(secrets_client.get_secret('ANALYTICS_URL',
                                                                    constants.AWS_DEFAULT_REGION,
-                                                                   credentials)).text
+                                                                   credentials),
+                                         timeout=constants.ANALYTICS_REQUEST_TIMEOUT).text
         else:
             logging.error("No environment exits")
 
@@ -498,5 +937,19 @@ def get_analytics_data():
         print_exceptions(e)
         capture_exception(e)
 
+
+analytics_cache = StaleWhileRevalidateCache(fetch_analytics_data,
+                                            interval=constants.ANALYTICS_REFRESH_INTERVAL,
+                                            wait_timeout=constants.ANALYTICS_FALLBACK_TIMEOUT)
+
+
+def get_analytics_data():
+    """
+
+    :return:    the last known analytics data, refreshed in the background
+    """
+    return analytics_cache.get()
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file